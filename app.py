@@ -7,6 +7,7 @@ from stacks.back_end.s3_stack.s3_stack import S3Stack
 from stacks.back_end.eks_cluster_stacks.eks_cluster_stack import EksClusterStack
 from stacks.back_end.eks_cluster_stacks.eks_ssm_daemonset_stack.eks_ssm_daemonset_stack import EksSsmDaemonSetStack
 from stacks.back_end.eks_cluster_stacks.eks_keda_stack.eks_keda_stack import EksKedaStack
+from stacks.back_end.eks_cluster_stacks.eks_keda_external_scaler_stack.eks_keda_external_scaler_stack import EksKedaExternalScalerStack
 from stacks.back_end.eks_sqs_consumer_stack.eks_sqs_consumer_stack import EksSqsConsumerStack
 from stacks.back_end.eks_sqs_producer_stack.eks_sqs_producer_stack import EksSqsProducerStack
 
@@ -81,7 +82,38 @@ sales_events_consumer_stack = EksSqsConsumerStack(
     clust_oidc_issuer=eks_cluster_stack.clust_oidc_issuer,
     reliable_q=sales_events_producer_stack.reliable_q,
     sales_event_bkt=sales_events_bkt_stack.data_bkt,
+    scaler_trigger="sqs",
+    scaler_queue_length=10,
+    scaler_polling_interval=10,
+    scaler_cooldown_period=300,
+    scaler_min_replicas=1,
+    scaler_max_replicas=50,
+    scaler_scale_up_pods=10,
+    scaler_scale_up_percent=100,
+    scaler_scale_down_percent=50,
+    scaler_scale_down_window_secs=300,
+    scaler_target_age_secs=60,
+    scaler_pod_rate=50,
+    scaled_job_max_replicas=0,
+    scaled_job_msgs_per_job=10000,
+    warm_pool_size=2,
     description="Miztiik Automation: Consumer to process sales events from SQS")
+# The ScaledObject needs the KEDA CRDs
+sales_events_consumer_stack.add_dependency(eks_keda_stack)
+
+# KEDA external scaler, sizes the consumer to a latency target
+keda_external_scaler_stack = EksKedaExternalScalerStack(
+    app,
+    f"keda-external-scaler-stack",
+    stack_log_level="INFO",
+    eks_cluster=eks_cluster_stack.eks_cluster_1,
+    clust_oidc_provider_arn=eks_cluster_stack.clust_oidc_provider_arn,
+    clust_oidc_issuer=eks_cluster_stack.clust_oidc_issuer,
+    reliable_q=sales_events_producer_stack.reliable_q,
+    description="Miztiik Automation: KEDA external scaler, sizes the consumer to a latency target")
+# The keda namespace & the consumer namespace must exist first
+keda_external_scaler_stack.add_dependency(eks_keda_stack)
+keda_external_scaler_stack.add_dependency(sales_events_consumer_stack)
 
 
 # Stack Level Tagging
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline check of the KEDA external scaler against the in-process SQS fake.
+
+Runs the producer at a LOAD_PROFILE rate & one consumer(its /metrics on a local
+port) against fake_aws.py, serves sqs_rate_scaler over grpc & calls it like
+KEDA does, every --interval secs. Prints what the scaler saw & the replicas it
+asked for. Needs grpcio & grpcio-tools.
+
+    python3 benchmarks/external_scaler_bench.py --rate 200 --duration 60 --target-age-secs 30
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_aws import FakeS3, FakeSqs  # noqa: E402
+from pipeline_bench import (CONSUMER_SRC, PRODUCER_SRC, _ROOT, RESULTS_DIR,  # noqa: E402
+                            load_script)
+
+SCALER_SRC = os.path.join(
+    _ROOT, "stacks/back_end/eks_cluster_stacks/eks_keda_external_scaler_stack/lambda_src/sqs_rate_scaler.py")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run(args):
+    import grpc
+    sqs = FakeSqs(latency_ms=args.latency_ms)
+    s3 = FakeS3(latency_ms=args.s3_latency_ms)
+    _common = {
+        "LOG_LEVEL": "WARNING",
+        "AWS_REGION": "us-east-1",
+        "RELIABLE_QUEUE_URL": sqs.q_url,
+        "STORE_EVENTS_BKT": "bench-bkt"
+    }
+    producer = load_script(PRODUCER_SRC, {
+        **_common,
+        "TOT_MSGS_TO_PRODUCE": int(args.rate * args.duration),
+        "MSGS_PER_SEND_BATCH": 10,
+        "WAIT_SECS_BETWEEN_MSGS": 0,
+        "LOAD_PROFILE": args.profile,
+        "TARGET_EVNTS_PER_SEC": args.rate,
+        "MIN_EVNTS_PER_SEC": args.rate / 10,
+        "PROFILE_PERIOD_SECS": args.duration
+    })
+    _metrics_port = _free_port()
+    consumer = load_script(CONSUMER_SRC, {
+        **_common,
+        "CONSUMER_WORKERS": args.workers,
+        "MAX_MSGS_PER_BATCH": args.batch_size,
+        "LONG_POLL_SECS": 1,
+        "METRICS_PORT": _metrics_port
+    })
+    scaler = load_script(SCALER_SRC, {**_common, "SCALER_PORT": 0})
+    producer.sqs_client, producer._s3 = sqs, s3
+    consumer.sqs_client, consumer._s3 = sqs, s3
+    scaler.sqs_client = sqs
+
+    _srv = scaler.serve(port=0)
+    pb2, pb2_grpc = scaler._load_stubs()
+    _chan = grpc.insecure_channel(f"127.0.0.1:{_srv.port}")
+    _stub = pb2_grpc.ExternalScalerStub(_chan)
+    _ref = pb2.ScaledObjectRef(name="sales-events-consumer-scaler", namespace="bench", scalerMetadata={
+        "queueURL": sqs.q_url,
+        "targetAgeSecs": str(args.target_age_secs),
+        "podRate": str(args.pod_rate),
+        "metricsHost": "127.0.0.1",
+        "metricsPort": str(_metrics_port)
+    })
+
+    _p = threading.Thread(target=producer.lambda_handler, args=({}, {}), daemon=True)
+    _c = threading.Thread(target=consumer.run_consumers)
+    _p.start()
+    _c.start()
+    _spec = _stub.GetMetricSpec(_ref).metricSpecs[0]
+    print(f"metric: {_spec.metricName} targetSize: {_spec.targetSize}")
+    print(f'{"t":>5}{"depth":>8}{"inflight":>9}{"age":>5}{"active":>7}{"replicas":>9}')
+    samples = []
+    _start = time.monotonic()
+    try:
+        while time.monotonic() - _start < args.duration:
+            time.sleep(args.interval)
+            _active = _stub.IsActive(_ref).result
+            _m = _stub.GetMetrics(pb2.GetMetricsRequest(
+                scaledObjectRef=_ref, metricName=_spec.metricName)).metricValues[0]
+            _attrs = sqs.get_queue_attributes(QueueUrl=sqs.q_url)["Attributes"]
+            _s = {
+                "t": round(time.monotonic() - _start, 1),
+                "depth": int(_attrs["ApproximateNumberOfMessages"]),
+                "in_flight": int(_attrs["ApproximateNumberOfMessagesNotVisible"]),
+                "oldest_age_secs": int(_attrs["ApproximateAgeOfOldestMessage"]),
+                "active": _active,
+                "replicas": _m.metricValue
+            }
+            samples.append(_s)
+            print(f'{_s["t"]:>5}{_s["depth"]:>8}{_s["in_flight"]:>9}{_s["oldest_age_secs"]:>5}'
+                  f'{str(_s["active"]):>7}{_s["replicas"]:>9}')
+    finally:
+        consumer._shutdown.begin("bench")
+        _c.join()
+        _chan.close()
+        _srv.stop(0)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--interval", type=float, default=5,
+                        help="Secs between calls, the ScaledObject pollingInterval")
+    parser.add_argument("--profile", default="step",
+                        choices=["constant", "ramp", "step", "sine", "burst"])
+    parser.add_argument("--rate", type=float, default=200, help="Producer target events/sec")
+    parser.add_argument("--workers", type=int, default=1, help="Workers of the one consumer")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Consumer msgs per receive, keep it low to keep one pod below the rate")
+    parser.add_argument("--latency-ms", type=float, default=10)
+    parser.add_argument("--s3-latency-ms", type=float, default=20)
+    parser.add_argument("--target-age-secs", type=float, default=30)
+    parser.add_argument("--pod-rate", type=float, default=50)
+    parser.add_argument("--out", help="Results json, defaults to benchmarks/results/external_scaler_<ts>.json")
+    args = parser.parse_args()
+
+    samples = run(args)
+    _out = args.out or os.path.join(
+        RESULTS_DIR, f'external_scaler_{time.strftime("%Y%m%dT%H%M%S")}.json')
+    os.makedirs(os.path.dirname(_out), exist_ok=True)
+    with open(_out, "w") as f:
+        json.dump({
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": vars(args),
+            "samples": samples
+        }, f, indent=2)
+    print(f"results: {_out}")
+
+
+if __name__ == "__main__":
+    main()
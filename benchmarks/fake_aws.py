@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process stand-ins for the SQS & S3 clients used by the lambda_src scripts.
+They keep the SQS semantics the consumer relies on(visibility timeout,
+receipt handles, long polling, batch limits) & inject a per call latency.
+"""
+
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from types import SimpleNamespace
+
+from botocore.exceptions import ClientError
+
+
+class QueueDoesNotExist(ClientError):
+    pass
+
+
+def _client_err(code, op):
+    return ClientError({"Error": {"Code": code, "Message": code}}, op)
+
+
+class _Latency:
+    def __init__(self, latency_ms=0, jitter_ms=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+
+    def wait(self):
+        _ms = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if _ms > 0:
+            time.sleep(_ms / 1000)
+
+
+class FakeSqs:
+    """ A single standard queue, reachable through any queue url/name """
+
+    def __init__(self, q_url="https://sqs.local/000000000000/reliable_message_q",
+                 visibility_timeout=30, latency_ms=0, jitter_ms=0, throttle_rate=0,
+                 max_receive_count=3):
+        self.q_url = q_url
+        self.visibility_timeout = visibility_timeout
+        # The RedrivePolicy, msgs received this many times move to the dlq
+        self.max_receive_count = max_receive_count
+        self.throttle_rate = throttle_rate
+        self.exceptions = SimpleNamespace(QueueDoesNotExist=QueueDoesNotExist)
+        self._latency = _Latency(latency_ms, jitter_ms)
+        self._cond = threading.Condition()
+        self._msgs = {}
+        self._visible = deque()
+        # receipt handle -> (msg id, invisible until)
+        self._inflight = {}
+        self.api_calls = {}
+        self.sent_at = {}
+        self.deleted_at = {}
+        self.dlq = []
+
+    def _call(self, op):
+        with self._cond:
+            self.api_calls[op] = self.api_calls.get(op, 0) + 1
+        self._latency.wait()
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            raise _client_err("RequestThrottled", op)
+
+    def _requeue_expired(self, now):
+        for rh, (m_id, until) in list(self._inflight.items()):
+            if until <= now:
+                del self._inflight[rh]
+                if m_id in self._msgs:
+                    self._visible.append(m_id)
+
+    def _enqueue(self, body, attrs):
+        m_id = str(uuid.uuid4())
+        self._msgs[m_id] = {
+            "MessageId": m_id,
+            "Body": body,
+            "MessageAttributes": attrs or {},
+            "ReceiveCount": 0
+        }
+        self.sent_at[m_id] = time.perf_counter()
+        self._visible.append(m_id)
+        return m_id
+
+    def get_queue_url(self, QueueName):
+        self._call("get_queue_url")
+        return {"QueueUrl": self.q_url}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None):
+        self._call("get_queue_attributes")
+        now = time.perf_counter()
+        with self._cond:
+            self._requeue_expired(now)
+            _oldest = min((self.sent_at[m] for m in self._visible), default=now)
+            return {"Attributes": {
+                "ApproximateNumberOfMessages": str(len(self._visible)),
+                "ApproximateNumberOfMessagesNotVisible": str(len(self._inflight)),
+                "ApproximateAgeOfOldestMessage": str(int(now - _oldest))
+            }}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, **kwargs):
+        self._call("send_message")
+        with self._cond:
+            m_id = self._enqueue(MessageBody, MessageAttributes)
+            self._cond.notify_all()
+        return {"MessageId": m_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call("send_message_batch")
+        if len(Entries) > 10:
+            raise _client_err("TooManyEntriesInBatchRequest", "SendMessageBatch")
+        _ok = []
+        with self._cond:
+            for e in Entries:
+                m_id = self._enqueue(e["MessageBody"], e.get("MessageAttributes"))
+                _ok.append({"Id": e["Id"], "MessageId": m_id})
+            self._cond.notify_all()
+        return {"Successful": _ok, "Failed": []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        self._call("receive_message")
+        _deadline = time.perf_counter() + WaitTimeSeconds
+        out = []
+        with self._cond:
+            while True:
+                now = time.perf_counter()
+                self._requeue_expired(now)
+                if self._visible or now >= _deadline:
+                    break
+                self._cond.wait(min(_deadline - now, 0.05))
+            while self._visible and len(out) < MaxNumberOfMessages:
+                m_id = self._visible.popleft()
+                if m_id not in self._msgs:
+                    continue
+                m = self._msgs[m_id]
+                if self.max_receive_count and m["ReceiveCount"] >= self.max_receive_count:
+                    self.dlq.append(self._msgs.pop(m_id))
+                    continue
+                m["ReceiveCount"] += 1
+                rh = f"{m_id}#{uuid.uuid4().hex}"
+                self._inflight[rh] = (m_id, now + self.visibility_timeout)
+                out.append({
+                    "MessageId": m_id,
+                    "ReceiptHandle": rh,
+                    "Body": m["Body"],
+                    "MessageAttributes": m["MessageAttributes"],
+                    "Attributes": {"ApproximateReceiveCount": str(m["ReceiveCount"])}
+                })
+        return {"Messages": out} if out else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._call("delete_message_batch")
+        if len(Entries) > 10:
+            raise _client_err("TooManyEntriesInBatchRequest", "DeleteMessageBatch")
+        _ok, _failed = [], []
+        now = time.perf_counter()
+        with self._cond:
+            for e in Entries:
+                _m = self._inflight.pop(e["ReceiptHandle"], None)
+                if not _m:
+                    _failed.append({"Id": e["Id"], "SenderFault": True,
+                                    "Code": "ReceiptHandleIsInvalid"})
+                    continue
+                self._msgs.pop(_m[0], None)
+                self.deleted_at.setdefault(_m[0], now)
+                _ok.append({"Id": e["Id"]})
+        return {"Successful": _ok, "Failed": _failed}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self._call("change_message_visibility_batch")
+        _ok, _failed = [], []
+        now = time.perf_counter()
+        with self._cond:
+            for e in Entries:
+                _m = self._inflight.get(e["ReceiptHandle"])
+                if not _m:
+                    _failed.append({"Id": e["Id"], "SenderFault": True,
+                                    "Code": "ReceiptHandleIsInvalid"})
+                    continue
+                self._inflight[e["ReceiptHandle"]] = (
+                    _m[0], now + int(e["VisibilityTimeout"]))
+                _ok.append({"Id": e["Id"]})
+            self._cond.notify_all()
+        return {"Successful": _ok, "Failed": _failed}
+
+    def depth(self):
+        with self._cond:
+            return len(self._msgs)
+
+    def visible(self):
+        with self._cond:
+            self._requeue_expired(time.perf_counter())
+            return sum(1 for m_id in self._visible if m_id in self._msgs)
+
+    def e2e_latencies(self):
+        """ Secs from send to delete, for every deleted msg """
+        return [self.deleted_at[m] - self.sent_at[m] for m in self.deleted_at]
+
+
+class FakeS3:
+    def __init__(self, latency_ms=0, jitter_ms=0):
+        self._latency = _Latency(latency_ms, jitter_ms)
+        self._lock = threading.Lock()
+        self.api_calls = {}
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        with self._lock:
+            self.api_calls["put_object"] = self.api_calls.get("put_object", 0) + 1
+        self._latency.wait()
+        with self._lock:
+            self.objects[Key] = len(Body)
+        return {"ETag": uuid.uuid4().hex}
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline simulator of KEDA scaling the consumer off the SQS queue length.
+
+Reads the ScaledObjects in keda_scalers(aws-sqs-queue & the sqs_rate_scaler
+external triggers), drives each with the same producer traffic, a producer
+LOAD_PROFILE or a RECORD_FILE recording, and reports the backlog age, time to
+drain, replica-seconds & secs over the age SLO of every config, with & without
+a warm pool.
+
+    python3 benchmarks/keda_sim.py --profile burst --target-rate 500 --min-rate 20 --duration 3600
+    python3 benchmarks/keda_sim.py --replay run.jsonl.gz --pod-rate 120 --startup-secs 25
+    python3 benchmarks/keda_sim.py --from-results benchmarks/results/pipeline_<sha>.json
+    python3 benchmarks/keda_sim.py --node-pods 3 --nodes 2 --warm-pool 0,3
+    python3 benchmarks/keda_sim.py --stack-behavior --scale-down-percent 25
+
+Model, one tick per sec,
+- KEDA polls the queue every pollingInterval, the HPA sees the last polled
+  ApproximateNumberOfMessages. KEDA scales 0 -> 1 on any msg & back to 0 after
+  cooldownPeriod without msgs, only when minReplicaCount is 0.
+- The HPA syncs every 15s, desired = ceil(queue length / queueLength) within a
+  10% tolerance. External triggers use sqs_rate_scaler's desired_replicas off
+  the polled depth, oldest msg age & the arrival rate since the last poll.
+- The HPA follows the ScaledObject's advanced.horizontalPodAutoscalerConfig
+  behavior, the k8s defaults(up by max(4 pods, 100%) per 15s, down to the
+  highest desired of the last 300s) for what it does not set. Policies limit
+  the change from the replicas at the start of their period, stabilization
+  takes the lowest desired of the scale up window & the highest of the scale
+  down window. --stack-behavior simulates the consumer stack's behavior
+  instead, the --scale-* flags are its scaler_scale_* params.
+- A new pod consumes after --startup-secs, then --pod-rate msgs/sec. Msgs are
+  consumed oldest first.
+- With --node-pods, a node fits that many pods. A pod that does not fit makes
+  the cluster autoscaler add a node, ready after --node-startup-secs. Nodes are
+  never removed.
+- A warm pool of --warm-pool placeholders holds a slot each, on a node that has
+  pulled the image. A pod that does not fit preempts one & consumes after
+  --warm-startup-secs, the placeholder is rescheduled like any other pod.
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import sys
+import time
+from collections import deque
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pipeline_bench import PRODUCER_SRC, _ROOT, RESULTS_DIR, load_script  # noqa: E402
+
+SCALERS_DIR = os.path.join(_ROOT, "stacks/back_end/keda_scalers")
+SCALER_SRC = os.path.join(
+    _ROOT, "stacks/back_end/eks_cluster_stacks/eks_keda_external_scaler_stack/lambda_src/sqs_rate_scaler.py")
+HPA_SYNC_SECS = 15
+HPA_TOLERANCE = 0.1
+# k8s defaults of the HPA behavior
+DEFAULT_BEHAVIOR = {
+    "scaleUp": {
+        "stabilizationWindowSeconds": 0,
+        "selectPolicy": "Max",
+        "policies": [
+            {"type": "Pods", "value": 4, "periodSeconds": 15},
+            {"type": "Percent", "value": 100, "periodSeconds": 15}
+        ]
+    },
+    "scaleDown": {
+        "stabilizationWindowSeconds": 300,
+        "selectPolicy": "Max",
+        "policies": [
+            {"type": "Percent", "value": 100, "periodSeconds": 15}
+        ]
+    }
+}
+
+
+def hpa_behavior(behavior=None):
+    """ HPA behavior, the defaults filled in for every direction or field it does not set """
+    return {d: {**_default, **((behavior or {}).get(d) or {})}
+            for d, _default in DEFAULT_BEHAVIOR.items()}
+
+
+def stack_behavior(scale_up_pods=10, scale_up_percent=100, scale_down_percent=50,
+                   scale_down_window_secs=300):
+    """ The behavior eks_sqs_consumer_stack deploys, off its scaler_scale_* params """
+    return {
+        "scaleUp": {
+            "stabilizationWindowSeconds": 0,
+            "selectPolicy": "Max",
+            "policies": [
+                {"type": "Pods", "value": scale_up_pods, "periodSeconds": 15},
+                {"type": "Percent", "value": scale_up_percent, "periodSeconds": 15}
+            ]
+        },
+        "scaleDown": {
+            "stabilizationWindowSeconds": scale_down_window_secs,
+            "policies": [
+                {"type": "Percent", "value": scale_down_percent, "periodSeconds": 60}
+            ]
+        }
+    }
+
+
+def _scale_limit(rules, cur, changes, t, up):
+    """ Most(up) or fewest(down) replicas the policies allow, off the replicas at the start of each period """
+    _limits = []
+    for _p in rules["policies"]:
+        _changed = sum(n for s, n in changes if s > t - _p["periodSeconds"])
+        if up:
+            _start = cur - _changed
+            _limits.append(_start + _p["value"] if _p["type"] == "Pods"
+                           else math.ceil(_start * (1 + _p["value"] / 100)))
+        else:
+            _start = cur + _changed
+            _limits.append(_start - _p["value"] if _p["type"] == "Pods"
+                           else int(_start * (1 - _p["value"] / 100)))
+    _select = rules.get("selectPolicy", "Max")
+    if _select == "Disabled" or not _limits:
+        return cur
+    # Max picks the policy that allows the biggest change
+    if (_select == "Max") == up:
+        return max(_limits)
+    return min(_limits)
+
+
+def load_scalers(paths):
+    """ Returns a config per aws-sqs-queue or external ScaledObject in the yaml files """
+    configs = []
+    for path in paths:
+        with open(path) as f:
+            for doc in yaml.safe_load_all(f):
+                if not doc or doc.get("kind") != "ScaledObject":
+                    continue
+                _spec = doc["spec"]
+                for _trig in _spec.get("triggers", []):
+                    if _trig.get("type") not in ("aws-sqs-queue", "external"):
+                        continue
+                    _m = _trig["metadata"]
+                    _hpa = _spec.get("advanced", {}).get("horizontalPodAutoscalerConfig", {})
+                    configs.append({
+                        "name": f'{os.path.basename(path)}:{doc["metadata"]["name"]}',
+                        "type": _trig["type"],
+                        "min_replicas": int(_spec.get("minReplicaCount", 0)),
+                        "max_replicas": int(_spec.get("maxReplicaCount", 100)),
+                        "polling_interval": int(_spec.get("pollingInterval", 30)),
+                        "cooldown_period": int(_spec.get("cooldownPeriod", 300)),
+                        "queue_length": int(_m.get("queueLength", 5)),
+                        "target_age_secs": float(_m.get("targetAgeSecs", 60)),
+                        "min_drain_secs": float(_m.get("minDrainSecs", 10)),
+                        "behavior": hpa_behavior(_hpa.get("behavior"))
+                    })
+    return configs
+
+
+def profile_arrivals(args):
+    """ Msgs arriving in every sec, from the producer's own LOAD_PROFILE rates """
+    producer = load_script(PRODUCER_SRC, {
+        "LOG_LEVEL": "WARNING",
+        "TARGET_EVNTS_PER_SEC": args.target_rate,
+        "MIN_EVNTS_PER_SEC": args.min_rate,
+        "PROFILE_PERIOD_SECS": args.period,
+        "BURST_SECS": args.burst_secs
+    })
+    _arrivals, _carry = [], 0.0
+    for t in range(args.duration):
+        # Midpoint rate, same as the producer's TokenBucket
+        _carry += producer._profile_rate(args.profile, t + 0.5)
+        _arrivals.append(int(_carry))
+        _carry -= int(_carry)
+    return _arrivals
+
+
+def replay_arrivals(args):
+    """ Msgs arriving in every sec, from a producer recording """
+    producer = load_script(PRODUCER_SRC, {"LOG_LEVEL": "WARNING"})
+    _arrivals = [0] * args.duration
+    for _t, _, _ in producer.read_recording(args.replay):
+        _s = int(_t / args.replay_speed) if args.replay_speed > 0 else 0
+        if _s < args.duration:
+            _arrivals[_s] += 1
+    return _arrivals
+
+
+def _pct(vals, p):
+    if not vals:
+        return 0
+    _s = sorted(vals)
+    return _s[min(len(_s) - 1, int(round(p / 100 * (len(_s) - 1))))]
+
+
+class Cluster:
+    """ Pod slots on nodes of node_pods each(0 for no limit) & the warm pool placeholders """
+
+    def __init__(self, node_pods, nodes, node_startup_secs, startup_secs,
+                 warm_pool, warm_startup_secs):
+        self.node_pods = node_pods
+        self.node_startup_secs = node_startup_secs
+        self.startup_secs = startup_secs
+        self.warm_pool = warm_pool
+        self.warm_startup_secs = warm_startup_secs
+        self.nodes = 0
+        self.free = []  # sec every free slot is ready, i.e. its node is up
+        self.warm = []  # [slot ready sec, image pulled sec] of every placeholder
+        self._add_nodes(nodes, 0)
+
+    def _add_nodes(self, n, ready_at):
+        self.nodes += n
+        self.free = sorted(self.free + [ready_at] * (n * self.node_pods))
+
+    def _take_slot(self, t):
+        """ Sec the slot is ready, adds a node when none is free """
+        if not self.node_pods:
+            return t
+        if not self.free:
+            self._add_nodes(1, t + self.node_startup_secs)
+        return self.free.pop(0)
+
+    def start(self, pods):
+        """ The min replicas & the warm pool, already up at sec 0 """
+        if self.node_pods:
+            _short = pods + self.warm_pool - len(self.free)
+            if _short > 0:
+                self._add_nodes(math.ceil(_short / self.node_pods), 0)
+            self.free = self.free[pods:]
+        self.refill(0)
+        self.warm = [[0, 0] for _ in self.warm]
+        return [[0, 0] for _ in range(pods)]
+
+    def start_pod(self, t):
+        """ [sec the new pod consumes from, sec its slot is ready] """
+        if self.node_pods and not (self.free and self.free[0] <= t):
+            # No room on a running node, preempt a scheduled placeholder
+            _sched = [w for w in self.warm if w[0] <= t]
+            if _sched:
+                _w = min(_sched, key=lambda w: w[1])
+                self.warm.remove(_w)
+                return [max(t, _w[1]) + self.warm_startup_secs, _w[0]]
+            # Or take the slot of one still waiting on its node
+            if self.warm and not (self.free and self.free[0] <= min(self.warm)[0]):
+                _w = min(self.warm)
+                self.warm.remove(_w)
+                return [_w[0] + self.startup_secs, _w[0]]
+        _slot = self._take_slot(t)
+        return [max(t, _slot) + self.startup_secs, _slot]
+
+    def stop_pods(self, t, pods):
+        if self.node_pods:
+            self.free = sorted(self.free + [max(t, p[1]) for p in pods])
+
+    def refill(self, t):
+        """ Reschedule placeholders upto the pool size """
+        while len(self.warm) < self.warm_pool:
+            _slot = self._take_slot(t)
+            self.warm.append([_slot, max(t, _slot) + self.startup_secs])
+
+
+def simulate(cfg, arrivals, pod_rate, startup_secs, slo_secs, node_pods=0,
+             nodes=0, node_startup_secs=90, warm_pool=0, warm_startup_secs=3):
+    _external = cfg.get("type") == "external"
+    if _external:
+        scaler = load_script(SCALER_SRC, {"LOG_LEVEL": "WARNING"})
+    cluster = Cluster(node_pods, nodes, node_startup_secs, startup_secs,
+                      warm_pool, warm_startup_secs)
+    backlog = deque()  # [arrival sec, msgs]
+    # [sec it consumes from, sec its slot is ready] of every pod
+    pods = cluster.start(cfg["min_replicas"])
+    polled_len = 0
+    # What the external scaler sees: oldest age, arrivals since its last poll
+    polled_age, polled_arrival = 0, 0.0
+    _consumed, _last_poll = 0, (0, 0)
+    last_active = 0
+    _behavior = cfg.get("behavior") or hpa_behavior()
+    _up, _down = _behavior["scaleUp"], _behavior["scaleDown"]
+    desired_hist = deque()  # (sec, desired) for the stabilization windows
+    _hist_secs = max(_up["stabilizationWindowSeconds"], _down["stabilizationWindowSeconds"])
+    # (sec, pods) added & removed, for the policy periods
+    scale_ups, scale_downs = deque(), deque()
+    _period_secs = max(p["periodSeconds"] for p in _up["policies"] + _down["policies"])
+    replica_secs = 0
+    max_replicas = len(pods)
+    ages, slo_violations, max_backlog, scale_events = [], 0, 0, 0
+    warm_secs, _drain_run, max_drain_secs = 0, 0, 0
+    _capacity = 0.0
+    for t, _n in enumerate(arrivals):
+        if _n:
+            backlog.append([t, _n])
+        # Consume, oldest first
+        _ready = sum(1 for p in pods if p[0] <= t)
+        _capacity = min(_capacity + _ready * pod_rate, _ready * pod_rate)
+        while backlog and _capacity >= 1:
+            _take = min(backlog[0][1], int(_capacity))
+            backlog[0][1] -= _take
+            _capacity -= _take
+            _consumed += _take
+            if not backlog[0][1]:
+                backlog.popleft()
+        _q_len = sum(c[1] for c in backlog)
+        _age = t - backlog[0][0] if backlog else 0
+
+        # KEDA poll & activation
+        if t % cfg["polling_interval"] == 0:
+            polled_len, polled_age = _q_len, _age
+            if t > _last_poll[0]:
+                polled_arrival = (_consumed + _q_len - _last_poll[1]) / (t - _last_poll[0])
+            _last_poll = (t, _consumed + _q_len)
+            if polled_len:
+                last_active = t
+                if not pods:
+                    pods.append(cluster.start_pod(t))
+                    scale_events += 1
+            elif (pods and cfg["min_replicas"] == 0
+                  and t - last_active >= cfg["cooldown_period"]):
+                cluster.stop_pods(t, pods)
+                pods = []
+                scale_events += 1
+
+        # HPA sync
+        if pods and t % HPA_SYNC_SECS == 0:
+            _cur = len(pods)
+            if _external:
+                # targetSize 1, the metric value is the replicas wanted
+                _metric = scaler.desired_replicas(
+                    polled_len, 0, polled_age, polled_arrival, pod_rate,
+                    cfg["target_age_secs"], cfg["min_drain_secs"])
+                _ratio = _metric / _cur
+            else:
+                _metric = math.ceil(polled_len / cfg["queue_length"])
+                _ratio = polled_len / (cfg["queue_length"] * _cur)
+            _desired = _cur if abs(_ratio - 1) <= HPA_TOLERANCE else _metric
+            _desired = min(max(_desired, cfg["min_replicas"], 1), cfg["max_replicas"])
+            desired_hist.append((t, _desired))
+            while desired_hist[0][0] <= t - _hist_secs:
+                desired_hist.popleft()
+            for _hist in (scale_ups, scale_downs):
+                while _hist and _hist[0][0] <= t - _period_secs:
+                    _hist.popleft()
+            _up_rec = min(d for s, d in desired_hist
+                          if s > t - _up["stabilizationWindowSeconds"] or s == t)
+            _down_rec = max(d for s, d in desired_hist
+                            if s > t - _down["stabilizationWindowSeconds"] or s == t)
+            if _up_rec > _cur:
+                _new = min(_up_rec, _scale_limit(_up, _cur, scale_ups, t, True))
+                if _new > _cur:
+                    pods += [cluster.start_pod(t) for _ in range(_new - _cur)]
+                    scale_ups.append((t, _new - _cur))
+                    scale_events += 1
+            elif _down_rec < _cur:
+                _new = max(_down_rec, _scale_limit(_down, _cur, scale_downs, t, False),
+                           cfg["min_replicas"], 1)
+                if _new < _cur:
+                    # Pods still starting go first, then the newest
+                    pods = sorted(pods)
+                    cluster.stop_pods(t, pods[_new:])
+                    pods = pods[:_new]
+                    scale_downs.append((t, _cur - _new))
+                    scale_events += 1
+        cluster.refill(t)
+
+        # Secs the backlog took to clear, longest stretch
+        _drain_run = _drain_run + 1 if _q_len else 0
+        max_drain_secs = max(max_drain_secs, _drain_run)
+        warm_secs += len(cluster.warm)
+        replica_secs += len(pods)
+        max_replicas = max(max_replicas, len(pods))
+        max_backlog = max(max_backlog, _q_len)
+        ages.append(_age)
+        if _age > slo_secs:
+            slo_violations += 1
+
+    return {
+        "config": cfg["name"],
+        "type": cfg.get("type", "aws-sqs-queue"),
+        "queue_length": cfg["queue_length"] if not _external else None,
+        "target_age_secs": cfg["target_age_secs"] if _external else None,
+        "polling_interval": cfg["polling_interval"],
+        "cooldown_period": cfg["cooldown_period"],
+        "behavior": cfg.get("behavior"),
+        "msgs": sum(arrivals),
+        "msgs_left": sum(c[1] for c in backlog),
+        "warm_pool": warm_pool,
+        "replica_secs": replica_secs,
+        "warm_pod_secs": warm_secs,
+        "max_replicas": max_replicas,
+        "max_nodes": cluster.nodes if node_pods else None,
+        "max_drain_secs": max_drain_secs,
+        "max_backlog": max_backlog,
+        "p95_age_secs": _pct(ages, 95),
+        "max_age_secs": max(ages, default=0),
+        "slo_violation_secs": slo_violations,
+        "scale_events": scale_events
+    }
+
+
+def _pod_rate_from(results_path):
+    """ Best msgs/sec of a pipeline_bench run, i.e. what one pod can consume """
+    with open(results_path) as f:
+        return max(r["msgs_per_sec"] or 0 for r in json.load(f)["results"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scalers", nargs="*",
+                        default=sorted(glob.glob(os.path.join(SCALERS_DIR, "*.yml"))),
+                        help="ScaledObject yamls, defaults to all of keda_scalers")
+    parser.add_argument("--duration", type=int, default=3600, help="Secs to simulate")
+    parser.add_argument("--profile", default="burst",
+                        choices=["constant", "ramp", "step", "sine", "burst"])
+    parser.add_argument("--target-rate", type=float, default=300)
+    parser.add_argument("--min-rate", type=float, default=10)
+    parser.add_argument("--period", type=float, default=900)
+    parser.add_argument("--burst-secs", type=float, default=120)
+    parser.add_argument("--replay", help="Producer RECORD_FILE to use instead of --profile")
+    parser.add_argument("--replay-speed", type=float, default=1)
+    parser.add_argument("--pod-rate", type=float, default=100,
+                        help="Msgs/sec one ready pod consumes")
+    parser.add_argument("--from-results",
+                        help="pipeline_bench results json to take --pod-rate from")
+    parser.add_argument("--startup-secs", type=float, default=30,
+                        help="Secs from a scale up to the pod consuming")
+    parser.add_argument("--slo-secs", type=float, default=60,
+                        help="Max acceptable age of the oldest msg")
+    parser.add_argument("--node-pods", type=int, default=0,
+                        help="Consumer pods per node, 0 for no node limit")
+    parser.add_argument("--nodes", type=int, default=2, help="Nodes at the start")
+    parser.add_argument("--node-startup-secs", type=float, default=90,
+                        help="Secs from the autoscaler adding a node to it taking pods")
+    parser.add_argument("--warm-pool", default="0",
+                        help="Warm pool sizes to compare, comma separated")
+    parser.add_argument("--warm-startup-secs", type=float, default=3,
+                        help="Secs from a scale up to a pod consuming in a placeholder's slot")
+    parser.add_argument("--stack-behavior", action="store_true",
+                        help="Use the consumer stack's HPA behavior for every config, not the yaml's")
+    parser.add_argument("--scale-up-pods", type=int, default=10)
+    parser.add_argument("--scale-up-percent", type=int, default=100)
+    parser.add_argument("--scale-down-percent", type=int, default=50)
+    parser.add_argument("--scale-down-window-secs", type=int, default=300)
+    parser.add_argument("--out", help="Results json, defaults to benchmarks/results/keda_sim_<ts>.json")
+    args = parser.parse_args()
+
+    if args.from_results:
+        args.pod_rate = _pod_rate_from(args.from_results)
+    arrivals = replay_arrivals(args) if args.replay else profile_arrivals(args)
+    configs = load_scalers(args.scalers)
+    if args.stack_behavior:
+        _b = hpa_behavior(stack_behavior(args.scale_up_pods, args.scale_up_percent,
+                                         args.scale_down_percent, args.scale_down_window_secs))
+        for cfg in configs:
+            cfg["behavior"] = _b
+    results = [
+        simulate(cfg, arrivals, args.pod_rate, args.startup_secs, args.slo_secs,
+                 args.node_pods, args.nodes, args.node_startup_secs, int(w),
+                 args.warm_startup_secs)
+        for cfg in configs
+        for w in args.warm_pool.split(",")
+    ]
+    _w = max([len(r["config"]) for r in results] + [6]) + 2
+    print(f'{"config":<{_w}}{"target":>6}{"poll":>5}{"warm":>5}{"replica_s":>10}{"max_pods":>9}'
+          f'{"nodes":>6}{"p95_age":>8}{"max_age":>8}{"drain_s":>8}{"slo_viol_s":>11}{"left":>7}')
+    for r in results:
+        _target = r["queue_length"] or f'{r["target_age_secs"]:g}s'
+        print(f'{r["config"]:<{_w}}{_target:>6}{r["polling_interval"]:>5}{r["warm_pool"]:>5}'
+              f'{r["replica_secs"]:>10}{r["max_replicas"]:>9}{str(r["max_nodes"] or "-"):>6}'
+              f'{r["p95_age_secs"]:>8}{r["max_age_secs"]:>8}{r["max_drain_secs"]:>8}'
+              f'{r["slo_violation_secs"]:>11}{r["msgs_left"]:>7}')
+
+    _out = args.out or os.path.join(
+        RESULTS_DIR, f'keda_sim_{time.strftime("%Y%m%dT%H%M%S")}.json')
+    os.makedirs(os.path.dirname(_out), exist_ok=True)
+    with open(_out, "w") as f:
+        json.dump({
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": vars(args),
+            "results": results
+        }, f, indent=2)
+    print(f"results: {_out}")
+
+
+if __name__ == "__main__":
+    main()
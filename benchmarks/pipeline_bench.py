@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of the producer -> SQS -> consumer -> S3 pipeline.
+
+Runs the unmodified lambda_src scripts against the in-process fakes in
+fake_aws.py, for every combination of batch size & consumer workers, and
+reports msgs/sec, p50/p99 send to delete latency & api calls per msg.
+
+    python3 benchmarks/pipeline_bench.py --msgs 2000 --batch-sizes 1,10 --workers 1,4 --latency-ms 20
+    python3 benchmarks/pipeline_bench.py --compare benchmarks/results/pipeline_<sha>.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_aws import FakeS3, FakeSqs  # noqa: E402
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRODUCER_SRC = os.path.join(
+    _ROOT, "stacks/back_end/eks_sqs_producer_stack/lambda_src/stream_data_producer.py")
+CONSUMER_SRC = os.path.join(
+    _ROOT, "stacks/back_end/eks_sqs_consumer_stack/lambda_src/stream_data_consumer.py")
+RESULTS_DIR = os.path.join(_ROOT, "benchmarks", "results")
+
+
+def load_script(path, env):
+    """ Import a fresh copy of a lambda_src script, its GlobalArgs are read from the env at import """
+    _saved = dict(os.environ)
+    os.environ.update({k: str(v) for k, v in env.items()})
+    try:
+        _name = f"{os.path.basename(path)[:-3]}_{uuid.uuid4().hex[:8]}"
+        spec = importlib.util.spec_from_file_location(_name, path)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    finally:
+        os.environ.clear()
+        os.environ.update(_saved)
+    return mod
+
+
+def _pct(vals, p):
+    if not vals:
+        return None
+    _i = min(len(vals) - 1, int(round(p / 100 * (len(vals) - 1))))
+    return round(sorted(vals)[_i] * 1000, 2)
+
+
+def _git_sha():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=_ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def run_pipeline(msgs, batch_size, workers, args):
+    sqs = FakeSqs(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                  throttle_rate=args.throttle_rate)
+    s3 = FakeS3(latency_ms=args.s3_latency_ms, jitter_ms=args.jitter_ms)
+    _common = {
+        "LOG_LEVEL": "WARNING",
+        "AWS_REGION": "us-east-1",
+        "RELIABLE_QUEUE_URL": sqs.q_url,
+        "STORE_EVENTS_BKT": "bench-bkt"
+    }
+    producer = load_script(PRODUCER_SRC, {
+        **_common,
+        "TOT_MSGS_TO_PRODUCE": msgs,
+        "MSGS_PER_SEND_BATCH": batch_size,
+        "WAIT_SECS_BETWEEN_MSGS": 0,
+        **({"LOAD_PROFILE": "constant", "TARGET_EVNTS_PER_SEC": args.rate} if args.rate else {})
+    })
+    consumer = load_script(CONSUMER_SRC, {
+        **_common,
+        # Poison msgs are received more than once, the consumer is stopped below
+        "TOT_MSGS_TO_PROCESS": 10 ** 9,
+        "MAX_MSGS_PER_BATCH": batch_size,
+        "CONSUMER_WORKERS": workers,
+        "CONSUMER_WORKER_MODE": args.worker_mode,
+        "S3_SINK_FORMAT": args.sink,
+        "LONG_POLL_SECS": 1,
+        "METRICS_PORT": 0
+    })
+    producer.sqs_client, producer._s3 = sqs, s3
+    consumer.sqs_client, consumer._s3 = sqs, s3
+
+    _start = time.perf_counter()
+    _p = threading.Thread(target=producer.lambda_handler, args=({}, {}))
+    _c = threading.Thread(target=consumer.run_consumers)
+    _p.start()
+    _c.start()
+    _p.join()
+    # Drain once every msg left is held by the consumer, buffered or being written
+    while sqs.visible():
+        time.sleep(0.05)
+    consumer._shutdown.begin("bench")
+    _c.join()
+    _elapsed = max(sqs.deleted_at.values(), default=time.perf_counter()) - _start
+
+    _lat = sqs.e2e_latencies()
+    _calls = {**sqs.api_calls, **s3.api_calls}
+    return {
+        "msgs": msgs,
+        "batch_size": batch_size,
+        "workers": workers,
+        "deleted_msgs": len(_lat),
+        "dlq_msgs": len(sqs.dlq),
+        "elapsed_secs": round(_elapsed, 3),
+        "msgs_per_sec": round(len(_lat) / _elapsed, 2) if _elapsed else None,
+        "e2e_p50_ms": _pct(_lat, 50),
+        "e2e_p99_ms": _pct(_lat, 99),
+        "api_calls_per_msg": {k: round(v / msgs, 4) for k, v in sorted(_calls.items())},
+        "api_calls_per_msg_tot": round(sum(_calls.values()) / msgs, 4),
+        "s3_objects": len(s3.objects)
+    }
+
+
+def _cfg_key(r):
+    return f'b{r["batch_size"]}_w{r["workers"]}'
+
+
+def compare(prev_path, results):
+    with open(prev_path) as f:
+        _prev = {_cfg_key(r): r for r in json.load(f)["results"]}
+    print(f"\nvs {prev_path}")
+    for r in results:
+        _p = _prev.get(_cfg_key(r))
+        if not _p or not _p["msgs_per_sec"]:
+            continue
+        _d = (r["msgs_per_sec"] - _p["msgs_per_sec"]) / _p["msgs_per_sec"] * 100
+        print(f'{_cfg_key(r):>10} msgs/sec {_p["msgs_per_sec"]:>10} -> {r["msgs_per_sec"]:>10} ({_d:+.1f}%)'
+              f' p99_ms {_p["e2e_p99_ms"]} -> {r["e2e_p99_ms"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--msgs", type=int, default=2000)
+    parser.add_argument("--batch-sizes", default="1,10")
+    parser.add_argument("--workers", default="1,4")
+    parser.add_argument("--worker-mode", default="thread", choices=["thread", "asyncio"])
+    parser.add_argument("--sink", default="json", choices=["json", "ndjson", "parquet"])
+    parser.add_argument("--latency-ms", type=float, default=10,
+                        help="Injected latency of every SQS call")
+    parser.add_argument("--s3-latency-ms", type=float, default=20,
+                        help="Injected latency of every S3 put")
+    parser.add_argument("--jitter-ms", type=float, default=5)
+    parser.add_argument("--throttle-rate", type=float, default=0,
+                        help="Fraction of SQS calls that are throttled")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Producer target events/sec, 0 to send as fast as possible")
+    parser.add_argument("--out", help="Results json, defaults to benchmarks/results/pipeline_<sha>.json")
+    parser.add_argument("--compare", help="Previous results json to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for b in [int(x) for x in args.batch_sizes.split(",")]:
+        for w in [int(x) for x in args.workers.split(",")]:
+            r = run_pipeline(args.msgs, b, w, args)
+            print(json.dumps(r))
+            results.append(r)
+
+    _sha = _git_sha()
+    _out = args.out or os.path.join(RESULTS_DIR, f"pipeline_{_sha}.json")
+    os.makedirs(os.path.dirname(_out), exist_ok=True)
+    with open(_out, "w") as f:
+        json.dump({
+            "commit": _sha,
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": vars(args),
+            "results": results
+        }, f, indent=2)
+    print(f"results: {_out}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
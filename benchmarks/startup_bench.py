@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Consumer cold start benchmark: secs from `docker run` to the first msg received.
+
+Compares the legacy bootstrap(wget the script & pip install boto3 at container
+start) against the prebuilt image. The bootstrap still pays for the download,
+but runs this tree's script, mounted into the container, as the upstream one
+never logs time_to_first_msg_secs. Needs docker, a queue with msgs & aws creds
+in the env, which are passed through to the container.
+
+    docker build -t sales-events-consumer stacks/back_end/eks_sqs_consumer_stack/lambda_src
+    RELIABLE_QUEUE_URL=https://sqs... STORE_EVENTS_BKT=... AWS_REGION=... \\
+        python3 benchmarks/startup_bench.py --image sales-events-consumer --runs 3
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import threading
+import time
+import uuid
+
+CONSUMER_SRC = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "stacks/back_end/eks_sqs_consumer_stack/lambda_src/stream_data_consumer.py")
+BOOTSTRAP_CMD = (
+    "wget -q -O /dev/null https://raw.githubusercontent.com/miztiik/scale-eks-with-keda/master/"
+    "stacks/back_end/eks_sqs_consumer_stack/lambda_src/stream_data_consumer.py;"
+    "pip3 install --user boto3==1.17.112;python3 /bench/stream_data_consumer.py;"
+)
+PASS_ENV = (
+    "AWS_REGION", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN",
+    "RELIABLE_QUEUE_NAME", "RELIABLE_QUEUE_URL", "STORE_EVENTS_BKT"
+)
+_FIRST_MSG = re.compile(r'"time_to_first_msg_secs":([0-9.]+)')
+
+
+def time_to_first_msg(docker_args, timeout):
+    """ Wall clock secs until the consumer logs its first msg & the secs it reports itself """
+    _env = []
+    for k in PASS_ENV:
+        if os.getenv(k):
+            _env += ["-e", k]
+    # The consumer keeps running, it is removed once the first msg is seen
+    _name = f"startup-bench-{uuid.uuid4().hex[:8]}"
+    _cmd = ["docker", "run", "--rm", "--name", _name, *_env,
+            "-e", "METRICS_PORT=0", *docker_args]
+    _found = threading.Event()
+    _res = [None, None]
+
+    def _read(stdout):
+        for line in stdout:
+            _m = _FIRST_MSG.search(line)
+            if _m:
+                _res[:] = round(time.perf_counter() - _start, 3), float(_m.group(1))
+                _found.set()
+                return
+
+    _start = time.perf_counter()
+    _p = subprocess.Popen(_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    # Read in a thread, a container that logs nothing must still time out
+    _reader = threading.Thread(target=_read, args=(_p.stdout,), daemon=True)
+    _reader.start()
+    try:
+        _found.wait(timeout)
+    finally:
+        subprocess.run(["docker", "rm", "-f", _name], capture_output=True)
+        _p.kill()
+        _p.wait(timeout=10)
+    return tuple(_res)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--image", required=True, help="Prebuilt consumer image to compare")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=int, default=300)
+    parser.add_argument("--out", default="benchmarks/results/startup.json")
+    args = parser.parse_args()
+
+    _modes = {
+        "bootstrap": ["-v", f"{CONSUMER_SRC}:/bench/stream_data_consumer.py:ro",
+                      "python:3.8.10-alpine", "sh", "-c", BOOTSTRAP_CMD],
+        "image": [args.image]
+    }
+    results = {}
+    for mode, docker_args in _modes.items():
+        _runs = [time_to_first_msg(docker_args, args.timeout) for _ in range(args.runs)]
+        _wall = [w for w, _ in _runs if w is not None]
+        results[mode] = {
+            "runs": _runs,
+            "time_to_first_msg_secs_median": statistics.median(_wall) if _wall else None
+        }
+        print(json.dumps({mode: results[mode]}))
+
+    os.makedirs(os.path.dirname(args.out), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
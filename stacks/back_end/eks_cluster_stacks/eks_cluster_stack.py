@@ -148,6 +148,35 @@ class EksClusterStack(cdk.Stack):
             # bootstrap_options={"kubelet_extra_args": "--node-labels=node.kubernetes.io/lifecycle=spot,daemonset=active,app=general --eviction-hard imagefs.available<15% --feature-gates=CSINodeInfo=true,CSIDriverRegistry=true,CSIBlockVolume=true,ExpandCSIVolumes=true"}
         )
 
+        # Burst capacity for the consumers, on spot. The on-demand group above
+        # is the base. All types are 2 vCPU/4 GiB, 3 consumers(500m/256Mi) fit
+        # one after the system pods. One shape keeps the autoscaler's node
+        # template right & lets it scale the group from 0
+        node_grp_2 = self.eks_cluster_1.add_nodegroup_capacity(
+            f"n_g_spot_{clust_name}",
+            nodegroup_name=f"{clust_name}_n_g_spot",
+            instance_types=[
+                _ec2.InstanceType("c5.large"),
+                _ec2.InstanceType("c5a.large"),
+                _ec2.InstanceType("c5d.large"),
+                _ec2.InstanceType("t3.medium"),
+                _ec2.InstanceType("t3a.medium"),
+            ],
+            disk_size=20,
+            min_size=0,
+            max_size=15,
+            desired_size=0,
+            labels={"app": "miztiik_ng",
+                    "lifecycle": "spot",
+                    "compute_provider": "ec2"
+                    },
+            subnets=_ec2.SubnetSelection(
+                subnet_type=_ec2.SubnetType.PUBLIC),
+            ami_type=_eks.NodegroupAmiType.AL2_X86_64,
+            capacity_type=_eks.CapacityType.SPOT,
+            node_role=self._eks_node_role
+        )
+
         # This code block will provision worker nodes with Fargate Profile configuration
         fargate_n_g_3 = self.eks_cluster_1.add_fargate_profile(
             "FargateEnabled",
@@ -164,6 +193,8 @@ class EksClusterStack(cdk.Stack):
         # We like to use the Kubernetes Dashboard
         self.enable_dashboard()
         self.enable_metrics_server
+        # Add nodes for the Pending pods KEDA scales out, remove the idle ones
+        self.enable_cluster_autoscaler(clust_name, clust_oidc_provider)
 
         # OIDC Issuer
         self.clust_oidc_issuer = clust_oidc_provider.open_id_connect_provider_issuer
@@ -282,6 +313,117 @@ class EksClusterStack(cdk.Stack):
             },
         )
 
+    # https://github.com/kubernetes/autoscaler/blob/master/cluster-autoscaler/cloudprovider/aws/README.md
+    def enable_cluster_autoscaler(self, clust_name, clust_oidc_provider, namespace: str = "kube-system"):
+        svc_accnt_name = "cluster-autoscaler"
+
+        # To make resolution of LHS during runtime, pre built the string.
+        oidc_issuer_condition_str = cdk.CfnJson(
+            self,
+            "ca-oidc-issuer-str",
+            value={
+                f"{clust_oidc_provider.open_id_connect_provider_issuer}:sub": f"system:serviceaccount:{namespace}:{svc_accnt_name}"
+            },
+        )
+
+        ca_svc_accnt_role = _iam.Role(
+            self,
+            "cluster-autoscaler-svc-accnt-role",
+            assumed_by=_iam.FederatedPrincipal(
+                federated=f"{clust_oidc_provider.open_id_connect_provider_arn}",
+                conditions={
+                    "StringEquals": oidc_issuer_condition_str
+                },
+                assume_role_action="sts:AssumeRoleWithWebIdentity"
+            )
+        )
+        ca_svc_accnt_role.add_to_policy(
+            _iam.PolicyStatement(
+                effect=_iam.Effect.ALLOW,
+                actions=[
+                    "autoscaling:DescribeAutoScalingGroups",
+                    "autoscaling:DescribeAutoScalingInstances",
+                    "autoscaling:DescribeLaunchConfigurations",
+                    "autoscaling:DescribeTags",
+                    "ec2:DescribeInstanceTypes",
+                    "ec2:DescribeLaunchTemplateVersions"
+                ],
+                resources=["*"]
+            )
+        )
+        # Only resize the node groups of this cluster
+        ca_svc_accnt_role.add_to_policy(
+            _iam.PolicyStatement(
+                effect=_iam.Effect.ALLOW,
+                actions=[
+                    "autoscaling:SetDesiredCapacity",
+                    "autoscaling:TerminateInstanceInAutoScalingGroup"
+                ],
+                resources=["*"],
+                conditions={
+                    "StringEquals": {
+                        f"autoscaling:ResourceTag/k8s.io/cluster-autoscaler/{clust_name}": "owned"
+                    }
+                }
+            )
+        )
+
+        # EKS tags the ASG of every managed node group with
+        # k8s.io/cluster-autoscaler/enabled & k8s.io/cluster-autoscaler/<cluster>,
+        # which is what the auto discovery looks for
+        self.eks_cluster_1.add_helm_chart(
+            "cluster-autoscaler",
+            namespace=namespace,
+            chart="cluster-autoscaler",
+            repository="https://kubernetes.github.io/autoscaler",
+            version="9.9.2",
+            values={
+                "cloudProvider": "aws",
+                "awsRegion": f"{cdk.Aws.REGION}",
+                "autoDiscovery": {
+                    "clusterName": f"{clust_name}"
+                },
+                # Same minor version as the cluster
+                "image": {
+                    "tag": "v1.18.3"
+                },
+                "rbac": {
+                    "serviceAccount": {
+                        "create": True,
+                        "name": f"{svc_accnt_name}",
+                        "annotations": {
+                            "eks.amazonaws.com/role-arn": f"{ca_svc_accnt_role.role_arn}"
+                        }
+                    }
+                },
+                "priorityClassName": "system-cluster-critical",
+                # Do not let a scale down evict the autoscaler itself
+                "podAnnotations": {
+                    "cluster-autoscaler.kubernetes.io/safe-to-evict": "false"
+                },
+                "extraArgs": {
+                    # Scale up, check for Pending consumers often & act on them at once
+                    "scan-interval": "10s",
+                    "new-pod-scale-up-delay": "0s",
+                    # Give up on a spot group that cannot get capacity, fall back to the other
+                    "max-node-provision-time": "5m",
+                    # Not priority, the managed node group ASGs are named eks-<uuid> &
+                    # no name pattern can pick out the spot group
+                    "expander": "least-waste",
+                    "balance-similar-node-groups": "true",
+                    # The warm pool placeholders(priority -10) must still trigger a scale up
+                    "expendable-pods-priority-cutoff": "-10",
+                    # Scale down, consolidate nodes below half used, once idle for 3 mins
+                    "scale-down-enabled": "true",
+                    "scale-down-utilization-threshold": "0.5",
+                    "scale-down-unneeded-time": "3m",
+                    "scale-down-delay-after-add": "5m",
+                    "skip-nodes-with-local-storage": "false",
+                    "skip-nodes-with-system-pods": "false"
+                }
+            }
+        )
+
     def enable_metrics_server(self, namespace: str = "tools"):
         metrics_server = self.eks_cluster.add_helm_chart(
             "MetricsServer",
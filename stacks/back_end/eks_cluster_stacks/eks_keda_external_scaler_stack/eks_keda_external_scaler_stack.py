@@ -0,0 +1,268 @@
+import os
+
+from aws_cdk import aws_iam as _iam
+from aws_cdk import aws_eks as _eks
+from aws_cdk import aws_ecr_assets as _ecr_assets
+from aws_cdk import core as cdk
+
+from stacks.miztiik_global_args import GlobalArgs
+
+
+class EksKedaExternalScalerStack(cdk.Stack):
+    def __init__(
+        self,
+        scope: cdk.Construct,
+        construct_id: str,
+        stack_log_level: str,
+        eks_cluster,
+        clust_oidc_provider_arn,
+        clust_oidc_issuer,
+        reliable_q,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        # Add your stack resources below):
+
+        ##########################################
+        #######                            #######
+        #######   KEDA External Scaler     #######
+        #######                            #######
+        ##########################################
+
+        # Runs next to the KEDA operator, in the namespace from EksKedaStack
+        app_grp_01_name = "sqs-rate-scaler"
+        app_grp_01_ns_name = "keda"
+        app_grp_01_label = {"app": f"{app_grp_01_name}"}
+
+        # The consumer pods, whose /metrics the scaler reads
+        consumer_name = "sales-events-consumer"
+        consumer_ns_name = f"{consumer_name}-ns"
+        consumer_metrics_port = 8080
+
+        scaler_port = 6000
+
+        #######################################
+        #######                         #######
+        #######   K8s Service Account   #######
+        #######                         #######
+        #######################################
+
+        svc_accnt_name = "sqs-rate-scaler-svc-accnt"
+        svc_accnt_ns = app_grp_01_ns_name
+
+        # To make resolution of LHS during runtime, pre built the string.
+        oidc_issuer_condition_str = cdk.CfnJson(
+            self,
+            "oidc-issuer-str",
+            value={
+                f"{clust_oidc_issuer}:sub": f"system:serviceaccount:{svc_accnt_ns}:{svc_accnt_name}"
+            },
+        )
+
+        # Svc Account Role
+        self.scaler_svc_accnt_role = _iam.Role(
+            self,
+            "sqs-rate-scaler-svc-accnt-role",
+            assumed_by=_iam.FederatedPrincipal(
+                federated=f"{clust_oidc_provider_arn}",
+                conditions={
+                    "StringEquals": oidc_issuer_condition_str
+                },
+                assume_role_action="sts:AssumeRoleWithWebIdentity"
+            )
+        )
+
+        # The scaler only reads the queue attributes
+        reliable_q.grant(self.scaler_svc_accnt_role, "sqs:GetQueueAttributes")
+
+        scaler_svc_accnt_manifest = {
+            "apiVersion": "v1",
+            "kind": "ServiceAccount",
+            "metadata": {
+                "name": f"{svc_accnt_name}",
+                "namespace": f"{svc_accnt_ns}",
+                "annotations": {
+                    "eks.amazonaws.com/role-arn": f"{self.scaler_svc_accnt_role.role_arn}"
+                }
+            }
+        }
+
+        scaler_svc_accnt = _eks.KubernetesManifest(
+            self,
+            f"{svc_accnt_name}",
+            cluster=eks_cluster,
+            manifest=[
+                scaler_svc_accnt_manifest
+            ]
+        )
+
+        ######################################
+        #######                        #######
+        #######   Prebuilt App Image   #######
+        #######                        #######
+        ######################################
+
+        scaler_img = _ecr_assets.DockerImageAsset(
+            self,
+            "sqsRateScalerImage",
+            directory=os.path.join(os.path.dirname(__file__), "lambda_src")
+        )
+
+        #######################################
+        #######                         #######
+        #######    APP 01 DEPLOYMENT    #######
+        #######                         #######
+        #######################################
+
+        app_01_scaler_deployment = {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "metadata": {
+                "name": f"{app_grp_01_name}",
+                "namespace": f"{app_grp_01_ns_name}"
+            },
+            "spec": {
+                "replicas": 1,
+                "selector": {"matchLabels": app_grp_01_label},
+                "template": {
+                    "metadata": {
+                        "labels": app_grp_01_label
+                    },
+                    "spec": {
+                        "serviceAccountName": f"{svc_accnt_name}",
+                        "containers": [
+                            {
+                                "name": f"{app_grp_01_name}",
+                                "image": f"{scaler_img.image_uri}",
+                                "ports": [
+                                    {
+                                        "name": "grpc",
+                                        "containerPort": scaler_port,
+                                        "protocol": "TCP"
+                                    }
+                                ],
+                                "readinessProbe": {
+                                    "tcpSocket": {
+                                        "port": scaler_port
+                                    },
+                                    "periodSeconds": 10
+                                },
+                                "resources": {
+                                    "requests": {
+                                        "cpu": "100m",
+                                        "memory": "128Mi"
+                                    }
+                                },
+                                "env":
+                                [
+                                    {
+                                        "name": "SCALER_PORT",
+                                        "value": f"{scaler_port}"
+                                    },
+                                    {
+                                        "name": "AWS_REGION",
+                                        "value": f"{cdk.Aws.REGION}"
+                                    },
+                                    {
+                                        # Defaults, the ScaledObject metadata overrides them
+                                        "name": "TARGET_AGE_SECS",
+                                        "value": "60"
+                                    },
+                                    {
+                                        "name": "POD_RATE",
+                                        "value": "50"
+                                    },
+                                    {
+                                        "name": "METRICS_PORT",
+                                        "value": f"{consumer_metrics_port}"
+                                    }
+                                ]
+                            }
+                        ]
+                    }
+                }
+            }
+        }
+
+        # KEDA reaches the scaler at <svc>.keda.svc.cluster.local:6000
+        app_01_scaler_svc = {
+            "apiVersion": "v1",
+            "kind": "Service",
+            "metadata": {
+                "name": f"{app_grp_01_name}",
+                "namespace": f"{app_grp_01_ns_name}"
+            },
+            "spec": {
+                "selector": app_grp_01_label,
+                "ports": [
+                    {
+                        "name": "grpc",
+                        "port": scaler_port,
+                        "targetPort": scaler_port,
+                        "protocol": "TCP"
+                    }
+                ]
+            }
+        }
+
+        # Headless, so the scaler resolves every consumer pod ip & scrapes each
+        consumer_metrics_svc = {
+            "apiVersion": "v1",
+            "kind": "Service",
+            "metadata": {
+                "name": f"{consumer_name}-metrics",
+                "namespace": f"{consumer_ns_name}"
+            },
+            "spec": {
+                "clusterIP": "None",
+                "selector": {"app": f"{consumer_name}"},
+                "ports": [
+                    {
+                        "name": "metrics",
+                        "port": consumer_metrics_port,
+                        "targetPort": consumer_metrics_port,
+                        "protocol": "TCP"
+                    }
+                ]
+            }
+        }
+
+        # apply a kubernetes manifest to the cluster
+        app_01_manifest = _eks.KubernetesManifest(
+            self,
+            "miztSqsRateScalerSvc",
+            cluster=eks_cluster,
+            manifest=[
+                app_01_scaler_deployment,
+                app_01_scaler_svc,
+                consumer_metrics_svc
+            ]
+        )
+
+        # Make sure the service account is available before create deployments
+        app_01_manifest.node.add_dependency(scaler_svc_accnt)
+
+        ###########################################
+        ################# OUTPUTS #################
+        ###########################################
+        output_0 = cdk.CfnOutput(
+            self,
+            "AutomationFrom",
+            value=f"{GlobalArgs.SOURCE_INFO}",
+            description="To know more about this automation stack, check out our github page.",
+        )
+
+        output_1 = cdk.CfnOutput(
+            self,
+            "ExternalScalerAddress",
+            value=f"{app_grp_01_name}.{app_grp_01_ns_name}.svc.cluster.local:{scaler_port}",
+            description="scalerAddress of the KEDA external trigger"
+        )
+
+        output_2 = cdk.CfnOutput(
+            self,
+            "ConsumerMetricsHost",
+            value=f"{consumer_name}-metrics.{consumer_ns_name}.svc.cluster.local",
+            description="metricsHost of the KEDA external trigger"
+        )
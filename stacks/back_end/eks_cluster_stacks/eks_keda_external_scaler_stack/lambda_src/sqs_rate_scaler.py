@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""
+KEDA external scaler for the sales events consumer.
+
+Sizes the consumer to keep the oldest msg under a target age, from the queue
+depth, the age of the oldest msg & the msgs/sec each consumer pod reports on
+its /metrics(consumer_processing_rate),
+
+    drain_secs = max(targetAgeSecs - oldest msg age, minDrainSecs)
+    replicas   = ceil((arrival rate + depth / drain_secs) / per pod rate)
+
+The arrival rate is what the pods consumed plus the change in the backlog since
+the last call. Per pod rate is the mean of the pods reporting a rate while there
+is a backlog(i.e. they are saturated), else the last such value or podRate.
+"""
+
+import json
+import logging
+import math
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+class GlobalArgs:
+    OWNER = "Mystique"
+    VERSION = "2021-05-14"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    AWS_REGION = os.getenv("AWS_REGION")
+    SCALER_PORT = int(os.getenv("SCALER_PORT", 6000))
+    SCALER_WORKERS = int(os.getenv("SCALER_WORKERS", 10))
+    # Defaults of the ScaledObject metadata
+    TARGET_AGE_SECS = float(os.getenv("TARGET_AGE_SECS", 60))
+    POD_RATE = float(os.getenv("POD_RATE", 50))
+    MIN_DRAIN_SECS = float(os.getenv("MIN_DRAIN_SECS", 10))
+    METRICS_PORT = int(os.getenv("METRICS_PORT", 8080))
+    SCRAPE_TIMEOUT_SECS = float(os.getenv("SCRAPE_TIMEOUT_SECS", 1))
+    # StreamIsActive checks the queue this often
+    STREAM_INTERVAL_SECS = float(os.getenv("STREAM_INTERVAL_SECS", 5))
+    METRIC_NAME = "sqs_latency_target_replicas"
+
+
+def set_logging(lv=GlobalArgs.LOG_LEVEL):
+    """ Helper to enable logging """
+    logging.basicConfig(level=lv)
+    logger = logging.getLogger()
+    logger.setLevel(lv)
+    return logger
+
+
+logger = set_logging()
+
+# Created on first use, one per region. Tests & benchmarks can set sqs_client
+# to serve every region
+sqs_client = None
+_sqs_clients = {}
+_clients_lock = threading.Lock()
+_scrapers = ThreadPoolExecutor(max_workers=8, thread_name_prefix="scraper")
+
+
+def get_sqs_client(region=None):
+    if sqs_client is not None:
+        return sqs_client
+    region = region or GlobalArgs.AWS_REGION
+    if region not in _sqs_clients:
+        with _clients_lock:
+            if region not in _sqs_clients:
+                import boto3
+                _sqs_clients[region] = boto3.client("sqs", region_name=region)
+    return _sqs_clients[region]
+
+
+def scaler_params(metadata):
+    """ ScaledObject trigger metadata, with the defaults filled in """
+    _m = dict(metadata or {})
+    if not _m.get("queueURL"):
+        raise ValueError("queueURL is required")
+    return {
+        "queue_url": _m["queueURL"],
+        "region": _m.get("awsRegion") or GlobalArgs.AWS_REGION,
+        "target_age_secs": float(_m.get("targetAgeSecs", GlobalArgs.TARGET_AGE_SECS)),
+        "pod_rate": float(_m.get("podRate", GlobalArgs.POD_RATE)),
+        "min_drain_secs": float(_m.get("minDrainSecs", GlobalArgs.MIN_DRAIN_SECS)),
+        "metrics_host": _m.get("metricsHost"),
+        "metrics_port": int(_m.get("metricsPort", GlobalArgs.METRICS_PORT))
+    }
+
+
+def queue_stats(queue_url, region=None):
+    _r = get_sqs_client(region).get_queue_attributes(
+        QueueUrl=queue_url,
+        AttributeNames=[
+            "ApproximateNumberOfMessages",
+            "ApproximateNumberOfMessagesNotVisible",
+            "ApproximateAgeOfOldestMessage"
+        ]
+    )["Attributes"]
+    return {
+        "depth": int(_r.get("ApproximateNumberOfMessages", 0)),
+        "in_flight": int(_r.get("ApproximateNumberOfMessagesNotVisible", 0)),
+        "oldest_age_secs": float(_r.get("ApproximateAgeOfOldestMessage", 0))
+    }
+
+
+def _scrape_rate(addr, port):
+    _url = f"http://{addr}:{port}/metrics"
+    try:
+        with urllib.request.urlopen(_url, timeout=GlobalArgs.SCRAPE_TIMEOUT_SECS) as r:
+            for _l in r.read().decode("UTF-8").splitlines():
+                if _l.startswith("consumer_processing_rate "):
+                    return float(_l.split()[1])
+    except Exception as e:
+        logger.debug(f'{{"scrape_failed":"{_url}","err":"{str(e)}"}}')
+    return None
+
+
+def pod_rates(host, port):
+    """ consumer_processing_rate of every pod behind the headless service """
+    if not host:
+        return []
+    try:
+        _addrs = sorted({a[4][0] for a in socket.getaddrinfo(
+            host, port, proto=socket.IPPROTO_TCP)})
+    except socket.gaierror as e:
+        logger.warning(f'{{"resolve_failed":"{host}","err":"{str(e)}"}}')
+        return []
+    _rates = _scrapers.map(lambda a: _scrape_rate(
+        f"[{a}]" if ":" in a else a, port), _addrs)
+    return [r for r in _rates if r is not None]
+
+
+def desired_replicas(depth, in_flight, oldest_age_secs, arrival_rate, pod_rate,
+                     target_age_secs, min_drain_secs):
+    """ Replicas to serve the arrivals & drain the backlog before it ages past the target """
+    if not (depth or in_flight or arrival_rate > 0):
+        return 0
+    _drain_secs = max(target_age_secs - oldest_age_secs, min_drain_secs)
+    _needed = arrival_rate + depth / _drain_secs
+    return max(1, math.ceil(_needed / max(pod_rate, 1e-6)))
+
+
+class RateScaler:
+    """ Keeps the backlog & per pod rate seen by every ScaledObject between calls """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = {}
+
+    def evaluate(self, so_key, metadata):
+        _p = scaler_params(metadata)
+        _q = queue_stats(_p["queue_url"], _p["region"])
+        _rates = pod_rates(_p["metrics_host"], _p["metrics_port"])
+        _consumed = sum(_rates)
+        _backlog = _q["depth"] + _q["in_flight"]
+        _now = self._clock()
+        with self._lock:
+            _st = self._state.setdefault(
+                so_key, {"t": None, "backlog": 0, "pod_rate": None})
+            _growth = 0.0
+            if _st["t"] is not None and _now > _st["t"]:
+                _growth = (_backlog - _st["backlog"]) / (_now - _st["t"])
+            _st["t"], _st["backlog"] = _now, _backlog
+            _busy = [r for r in _rates if r > 0]
+            # Idle pods report what arrived, not what they can do
+            if _busy and _q["depth"]:
+                _st["pod_rate"] = sum(_busy) / len(_busy)
+            _pod_rate = _st["pod_rate"] or _p["pod_rate"]
+        _arrival = max(0.0, _consumed + _growth)
+        _replicas = desired_replicas(
+            _q["depth"], _q["in_flight"], _q["oldest_age_secs"], _arrival,
+            _pod_rate, _p["target_age_secs"], _p["min_drain_secs"])
+        logger.info(json.dumps({
+            "scaled_object": "/".join(so_key), **_q, "pods": len(_rates),
+            "arrival_rate": round(_arrival, 2), "pod_rate": round(_pod_rate, 2),
+            "replicas": _replicas
+        }))
+        return _replicas, _q
+
+    def is_active(self, metadata):
+        _p = scaler_params(metadata)
+        _q = queue_stats(_p["queue_url"], _p["region"])
+        return bool(_q["depth"] or _q["in_flight"])
+
+
+def _load_stubs():
+    """ The grpc stubs are generated at image build, or here from the proto when run locally """
+    _dir = os.path.dirname(os.path.abspath(__file__))
+    if _dir not in sys.path:
+        sys.path.insert(0, _dir)
+    try:
+        import externalscaler_pb2
+        import externalscaler_pb2_grpc
+    except ImportError:
+        import tempfile
+        from grpc_tools import protoc
+        _out = tempfile.mkdtemp(prefix="externalscaler_")
+        if protoc.main(["protoc", f"-I{_dir}", f"--python_out={_out}",
+                        f"--grpc_python_out={_out}", "externalscaler.proto"]):
+            raise RuntimeError(f"protoc failed for {_dir}/externalscaler.proto")
+        sys.path.insert(0, _out)
+        import externalscaler_pb2
+        import externalscaler_pb2_grpc
+    return externalscaler_pb2, externalscaler_pb2_grpc
+
+
+def serve(port=GlobalArgs.SCALER_PORT, scaler=None):
+    """ Start the ExternalScaler grpc server, returns it running """
+    import grpc
+    pb2, pb2_grpc = _load_stubs()
+    scaler = scaler or RateScaler()
+
+    def _abort(context, e):
+        logger.error(f'{{"scaler_err":"{str(e)}"}}')
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT if isinstance(
+            e, ValueError) else grpc.StatusCode.UNAVAILABLE, str(e))
+
+    class ExternalScaler(pb2_grpc.ExternalScalerServicer):
+        def IsActive(self, request, context):
+            try:
+                return pb2.IsActiveResponse(result=scaler.is_active(request.scalerMetadata))
+            except Exception as e:
+                _abort(context, e)
+
+        def StreamIsActive(self, request, context):
+            _last = None
+            while context.is_active():
+                try:
+                    _active = scaler.is_active(request.scalerMetadata)
+                except Exception as e:
+                    logger.error(f'{{"stream_is_active_err":"{str(e)}"}}')
+                    _active = _last
+                if _active is not None and _active != _last:
+                    _last = _active
+                    yield pb2.IsActiveResponse(result=_active)
+                time.sleep(GlobalArgs.STREAM_INTERVAL_SECS)
+
+        def GetMetricSpec(self, request, context):
+            # Target of 1 per pod, so the HPA scales to the metric value
+            return pb2.GetMetricSpecResponse(metricSpecs=[
+                pb2.MetricSpec(metricName=GlobalArgs.METRIC_NAME, targetSize=1)
+            ])
+
+        def GetMetrics(self, request, context):
+            _ref = request.scaledObjectRef
+            try:
+                _replicas, _ = scaler.evaluate(
+                    (_ref.namespace, _ref.name), _ref.scalerMetadata)
+            except Exception as e:
+                _abort(context, e)
+            return pb2.GetMetricsResponse(metricValues=[
+                pb2.MetricValue(metricName=GlobalArgs.METRIC_NAME, metricValue=_replicas)
+            ])
+
+    _srv = grpc.server(ThreadPoolExecutor(
+        max_workers=GlobalArgs.SCALER_WORKERS, thread_name_prefix="grpc"))
+    pb2_grpc.add_ExternalScalerServicer_to_server(ExternalScaler(), _srv)
+    _port = _srv.add_insecure_port(f"[::]:{port}")
+    _srv.start()
+    logger.info(f'{{"scaler_port":{_port}}}')
+    _srv.port = _port
+    return _srv
+
+
+def main():
+    _srv = serve()
+    _srv.wait_for_termination()
+
+
+if __name__ == "__main__":
+    main()
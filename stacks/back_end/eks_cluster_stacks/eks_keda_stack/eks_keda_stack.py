@@ -111,18 +111,47 @@ class EksKedaStack(cdk.Stack):
         # Make sure the namespace is available before service accounts
         keda_svc_accnt.node.add_dependency(app_grp_01_ns)
 
-        # Ref: https://keda.sh/docs/2.3/deploy
-        # install_keda = _eks.HelmChart(
-        #     self,
-        #     "kedaDeployment",
-        #     cluster=eks_cluster,
-        #     chart="keda",
-        #     repository="https://kedacore.github.io/charts",
-        #     namespace="keda",
-        #     create_namespace=False,
-        #     values={
-        #     }
-        # )
+        # Ref: https://keda.sh/docs/2.4/deploy
+        # Scalers are polled by the operator, the defaults reconcile one
+        # ScaledObject at a time & queue the rest behind any slow trigger
+        keda_max_reconciles = 5
+
+        install_keda = _eks.HelmChart(
+            self,
+            "kedaDeployment",
+            cluster=eks_cluster,
+            chart="keda",
+            repository="https://kedacore.github.io/charts",
+            version="2.4.0",
+            namespace=f"{app_grp_01_ns_name}",
+            create_namespace=False,
+            values={
+                # Use the service account above, with its IAM Role
+                "serviceAccount": {
+                    "create": False,
+                    "name": f"{svc_accnt_name}"
+                },
+                # Lets the operator read the mounted IRSA token, https://github.com/kedacore/keda/issues/837
+                "podSecurityContext": {
+                    "fsGroup": 1001,
+                    "runAsGroup": 1001,
+                    "runAsUser": 1001
+                },
+                "env": [
+                    {
+                        "name": "KEDA_SCALEDOBJECT_CTRL_MAX_RECONCILES",
+                        "value": f"{keda_max_reconciles}"
+                    },
+                    {
+                        "name": "KEDA_SCALEDJOB_CTRL_MAX_RECONCILES",
+                        "value": f"{keda_max_reconciles}"
+                    }
+                ]
+            }
+        )
+
+        # Make sure the service account is available before the operator starts
+        install_keda.node.add_dependency(keda_svc_accnt)
 
         ###########################################
         ################# OUTPUTS #################
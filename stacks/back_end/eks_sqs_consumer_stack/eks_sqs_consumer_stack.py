@@ -1,5 +1,8 @@
+import os
+
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_eks as _eks
+from aws_cdk import aws_ecr_assets as _ecr_assets
 from aws_cdk import core as cdk
 
 from stacks.miztiik_global_args import GlobalArgs
@@ -16,10 +19,34 @@ class EksSqsConsumerStack(cdk.Stack):
         clust_oidc_issuer,
         reliable_q,
         sales_event_bkt,
+        scaler_trigger: str = "sqs",
+        scaler_queue_length: int = 10,
+        scaler_polling_interval: int = 10,
+        scaler_cooldown_period: int = 300,
+        scaler_min_replicas: int = 1,
+        scaler_max_replicas: int = 50,
+        scaler_scale_up_pods: int = 10,
+        scaler_scale_up_percent: int = 100,
+        scaler_scale_down_percent: int = 50,
+        scaler_scale_down_window_secs: int = 300,
+        scaler_target_age_secs: int = 60,
+        scaler_pod_rate: int = 50,
+        scaled_job_max_replicas: int = 0,
+        scaled_job_msgs_per_job: int = 10000,
+        warm_pool_size: int = 2,
         **kwargs
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # sqs: queue length per replica, external: the sqs-rate-scaler of the
+        # keda-external-scaler-stack, none: no ScaledObject, e.g. for a ScaledJob
+        if scaler_trigger not in ("sqs", "external", "none"):
+            raise ValueError(f"Unknown scaler_trigger:{scaler_trigger}")
+        # The jobs & the deployment would compete for the same msgs
+        if scaled_job_max_replicas > 0 and scaler_trigger != "none":
+            raise ValueError(
+                f"A ScaledJob needs scaler_trigger none, not:{scaler_trigger}")
+
         # Add your stack resources below):
 
         ########################################
@@ -117,12 +144,36 @@ class EksSqsConsumerStack(cdk.Stack):
         # Make sure the namespace is available before creating service account
         events_consumer_svc_accnt.node.add_dependency(app_grp_01_ns)
 
+        ######################################
+        #######                        #######
+        #######   Prebuilt App Image   #######
+        #######                        #######
+        ######################################
+
+        # Built from lambda_src & pushed to the cdk assets ECR repo. The tag is
+        # the hash of the source, so every code change rolls out a new image
+        consumer_img = _ecr_assets.DockerImageAsset(
+            self,
+            "salesEventsConsumerImage",
+            directory=os.path.join(os.path.dirname(__file__), "lambda_src")
+        )
+
         #######################################
         #######                         #######
         #######    APP 01 DEPLOYMENT    #######
         #######                         #######
         #######################################
 
+        # Prometheus /metrics endpoint of the consumer pods
+        metrics_port = 8080
+        # The consumer drains within this, the pod gets a few secs more before SIGKILL
+        shutdown_grace_secs = 25
+        # Also reserved by each warm pool placeholder
+        consumer_resource_requests = {
+            "cpu": "500m",
+            "memory": "256Mi"
+        }
+
         app_01_consumer_deployment = {
             "apiVersion": "apps/v1",
             "kind": "Deployment",
@@ -130,26 +181,90 @@ class EksSqsConsumerStack(cdk.Stack):
                 "name": f"{app_grp_01_name}",
                 "namespace": f"{app_grp_01_ns_name}"
             },
+            # No replicas, KEDA owns the count & a redeploy must not reset it
             "spec": {
-                "replicas": 1,
                 "selector": {"matchLabels": app_grp_01_label},
                 "template": {
-                    "metadata": {"labels": app_grp_01_label},
+                    "metadata": {
+                        "labels": app_grp_01_label,
+                        "annotations": {
+                            "prometheus.io/scrape": "true",
+                            "prometheus.io/port": f"{metrics_port}",
+                            "prometheus.io/path": "/metrics"
+                        }
+                    },
                     "spec": {
                         "serviceAccountName": f"{svc_accnt_name}",
+                        "terminationGracePeriodSeconds": shutdown_grace_secs + 5,
                         "containers": [
                             {
                                 "name": f"{app_grp_01_name}",
-                                "image": "python:3.8.10-alpine",
-                                "command": [
-                                    "sh",
-                                    "-c"
-                                ],
-                                "args": [
-                                    "wget https://raw.githubusercontent.com/miztiik/scale-eks-with-keda/master/stacks/back_end/eks_sqs_consumer_stack/lambda_src/stream_data_consumer.py;pip3 install --user boto3;python3 stream_data_consumer.py;"
+                                # Code & dependencies are baked in, no wget/pip at pod start
+                                "image": f"{consumer_img.image_uri}",
+                                "ports": [
+                                    {
+                                        "name": "metrics",
+                                        "containerPort": metrics_port,
+                                        "protocol": "TCP"
+                                    }
                                 ],
+                                # A worker stuck for HEALTH_STALE_SECS fails the liveness probe
+                                "livenessProbe": {
+                                    "httpGet": {
+                                        "path": "/healthz",
+                                        "port": metrics_port
+                                    },
+                                    "periodSeconds": 20,
+                                    "failureThreshold": 3
+                                },
+                                "readinessProbe": {
+                                    "httpGet": {
+                                        "path": "/readyz",
+                                        "port": metrics_port
+                                    },
+                                    "periodSeconds": 10
+                                },
+                                # Stop receiving as soon as the pod is marked for termination
+                                "lifecycle": {
+                                    "preStop": {
+                                        "httpGet": {
+                                            "path": "/drain",
+                                            "port": metrics_port
+                                        }
+                                    }
+                                },
+                                "resources": {
+                                    "requests": consumer_resource_requests
+                                },
                                 "env":
                                 [
+                                    {
+                                        # Workers per pod are sized off the cpu request
+                                        "name": "CPU_REQUEST_MILLICORES",
+                                        "valueFrom": {
+                                            "resourceFieldRef": {
+                                                "containerName": f"{app_grp_01_name}",
+                                                "resource": "requests.cpu",
+                                                "divisor": "1m"
+                                            }
+                                        }
+                                    },
+                                    {
+                                        "name": "STARTUP_PROFILE",
+                                        "value": "true"
+                                    },
+                                    {
+                                        "name": "METRICS_PORT",
+                                        "value": f"{metrics_port}"
+                                    },
+                                    {
+                                        "name": "SHUTDOWN_GRACE_SECS",
+                                        "value": f"{shutdown_grace_secs}"
+                                    },
+                                    {
+                                        "name": "CONSUMER_WORKER_MODE",
+                                        "value": "thread"
+                                    },
                                     {
                                         "name": "STORE_EVENTS_BKT",
                                         "value": f"{sales_event_bkt.bucket_name}"
@@ -162,6 +277,10 @@ class EksSqsConsumerStack(cdk.Stack):
                                         "name": "RELIABLE_QUEUE_NAME",
                                         "value": f"{reliable_q.queue_name}"
                                     },
+                                    {
+                                        "name": "RELIABLE_QUEUE_URL",
+                                        "value": f"{reliable_q.queue_url}"
+                                    },
                                     {
                                         "name": "AWS_REGION",
                                         "value": f"{cdk.Aws.REGION}"
@@ -176,11 +295,61 @@ class EksSqsConsumerStack(cdk.Stack):
                                     },
                                     {
                                         "name": "MSG_PROCESS_DELAY",
+                                        "value": "0"
+                                    },
+                                    {
+                                        "name": "LONG_POLL_SECS",
+                                        "value": "20"
+                                    },
+                                    {
+                                        # Long running, the KEDA ScaledJob runs it as a job instead
+                                        "name": "CONSUMER_MODE",
+                                        "value": "service"
+                                    },
+                                    {
+                                        "name": "S3_WRITER_POOL_SIZE",
+                                        "value": "10"
+                                    },
+                                    {
+                                        "name": "S3_MAX_POOL_CONNECTIONS",
                                         "value": "10"
                                     },
                                     {
-                                        "name": "TOT_MSGS_TO_PROCESS",
-                                        "value": "10000"
+                                        "name": "AWS_RETRY_MODE",
+                                        "value": "adaptive"
+                                    },
+                                    {
+                                        "name": "AWS_MAX_ATTEMPTS",
+                                        "value": "5"
+                                    },
+                                    {
+                                        "name": "AWS_CONNECT_TIMEOUT",
+                                        "value": "2"
+                                    },
+                                    {
+                                        "name": "AWS_READ_TIMEOUT",
+                                        "value": "10"
+                                    },
+                                    {
+                                        "name": "AWS_TCP_KEEPALIVE",
+                                        "value": "true"
+                                    },
+                                    {
+                                        "name": "S3_SINK_FORMAT",
+                                        "value": "ndjson"
+                                    },
+                                    {
+                                        "name": "S3_SINK_GZIP",
+                                        "value": "true"
+                                    },
+                                    {
+                                        "name": "SINK_MAX_AGE_SECS",
+                                        "value": "10"
+                                    },
+                                    {
+                                        # Same as the reliable_q visibility timeout
+                                        "name": "VISIBILITY_TIMEOUT_SECS",
+                                        "value": "30"
                                     }
                                 ]
                             }
@@ -190,6 +359,10 @@ class EksSqsConsumerStack(cdk.Stack):
             }
         }
 
+        if scaled_job_max_replicas > 0:
+            # The ScaledJob processes the queue, keep the long running consumer off it
+            app_01_consumer_deployment["spec"]["replicas"] = 0
+
         # apply a kubernetes manifest to the cluster
         app_01_manifest = _eks.KubernetesManifest(
             self,
@@ -204,6 +377,350 @@ class EksSqsConsumerStack(cdk.Stack):
         app_01_manifest.node.add_dependency(app_grp_01_ns)
         app_01_manifest.node.add_dependency(events_consumer_svc_accnt)
 
+        ########################################
+        #######                          #######
+        #######   KEDA SQS Scaler        #######
+        #######                          #######
+        ########################################
+
+        # Generated from the real queue, keda_scalers has hand edited variants to experiment with
+        scaler_name = f"{app_grp_01_name}-scaler"
+        trigger_auth_name = f"{app_grp_01_name}-trigger-auth"
+
+        # KEDA 2.4 aws-eks pod identity reads the queue with the keda-operator's own
+        # IRSA role(AmazonSQSFullAccess), it does not assume the consumer's role
+        app_01_trigger_auth = {
+            "apiVersion": "keda.sh/v1alpha1",
+            "kind": "TriggerAuthentication",
+            "metadata": {
+                "name": f"{trigger_auth_name}",
+                "namespace": f"{app_grp_01_ns_name}"
+            },
+            "spec": {
+                "podIdentity": {
+                    "provider": "aws-eks"
+                }
+            }
+        }
+
+        if scaler_trigger == "external":
+            # Served by the keda-external-scaler-stack, deploy it too. It reads the
+            # consumers' /metrics through the headless service that stack adds
+            app_01_scaler_triggers = [
+                {
+                    "type": "external",
+                    "metadata": {
+                        "scalerAddress": "sqs-rate-scaler.keda.svc.cluster.local:6000",
+                        "queueURL": f"{reliable_q.queue_url}",
+                        "awsRegion": f"{cdk.Aws.REGION}",
+                        "targetAgeSecs": f"{scaler_target_age_secs}",
+                        "podRate": f"{scaler_pod_rate}",
+                        "metricsHost": f"{app_grp_01_name}-metrics.{app_grp_01_ns_name}.svc.cluster.local",
+                        "metricsPort": f"{metrics_port}"
+                    }
+                }
+            ]
+        else:
+            app_01_scaler_triggers = [
+                {
+                    "type": "aws-sqs-queue",
+                    "authenticationRef": {
+                        "name": f"{trigger_auth_name}"
+                    },
+                    "metadata": {
+                        "queueURL": f"{reliable_q.queue_url}",
+                        "queueLength": f"{scaler_queue_length}",
+                        "awsRegion": f"{cdk.Aws.REGION}",
+                        "identityOwner": "pod"
+                    }
+                }
+            ]
+
+        app_01_scaled_object = {
+            "apiVersion": "keda.sh/v1alpha1",
+            "kind": "ScaledObject",
+            "metadata": {
+                "name": f"{scaler_name}",
+                "namespace": f"{app_grp_01_ns_name}",
+                "labels": {
+                    **app_grp_01_label,
+                    "deploymentName": f"{app_grp_01_name}"
+                }
+            },
+            "spec": {
+                "scaleTargetRef": {
+                    "kind": "Deployment",
+                    "name": f"{app_grp_01_name}"
+                },
+                "minReplicaCount": scaler_min_replicas,
+                "maxReplicaCount": scaler_max_replicas,
+                "pollingInterval": scaler_polling_interval,
+                "cooldownPeriod": scaler_cooldown_period,
+                "advanced": {
+                    "horizontalPodAutoscalerConfig": {
+                        "behavior": {
+                            # Ramp up by the larger of the two every 15s, without waiting
+                            "scaleUp": {
+                                "stabilizationWindowSeconds": 0,
+                                "selectPolicy": "Max",
+                                "policies": [
+                                    {
+                                        "type": "Pods",
+                                        "value": scaler_scale_up_pods,
+                                        "periodSeconds": 15
+                                    },
+                                    {
+                                        "type": "Percent",
+                                        "value": scaler_scale_up_percent,
+                                        "periodSeconds": 15
+                                    }
+                                ]
+                            },
+                            # Step down gradually, once the queue stayed short for the window
+                            "scaleDown": {
+                                "stabilizationWindowSeconds": scaler_scale_down_window_secs,
+                                "policies": [
+                                    {
+                                        "type": "Percent",
+                                        "value": scaler_scale_down_percent,
+                                        "periodSeconds": 60
+                                    }
+                                ]
+                            }
+                        }
+                    }
+                },
+                "triggers": app_01_scaler_triggers
+            }
+        }
+
+        # The KEDA CRDs come from the eks-keda-stack helm chart
+        if scaler_trigger != "none":
+            app_01_scaler_manifest = _eks.KubernetesManifest(
+                self,
+                "miztSalesEventConsumerScaler",
+                cluster=eks_cluster,
+                # The external trigger authenticates in the scaler, with its own IRSA role
+                manifest=[
+                    app_01_trigger_auth,
+                    app_01_scaled_object
+                ] if scaler_trigger == "sqs" else [app_01_scaled_object]
+            )
+
+            app_01_scaler_manifest.node.add_dependency(app_01_manifest)
+
+        ########################################
+        #######                          #######
+        #######   KEDA SQS ScaledJob     #######
+        #######                          #######
+        ########################################
+
+        # One consumer job, in CONSUMER_MODE=job, per scaled_job_msgs_per_job msgs.
+        # Generated like the ScaledObject, keda_scalers has a hand edited variant
+        job_scaler_name = f"{app_grp_01_name}-job-scaler"
+        job_name = f"{app_grp_01_name}-job"
+
+        if scaled_job_max_replicas > 0:
+            app_01_scaled_job = {
+                "apiVersion": "keda.sh/v1alpha1",
+                "kind": "ScaledJob",
+                "metadata": {
+                    "name": f"{job_scaler_name}",
+                    "namespace": f"{app_grp_01_ns_name}",
+                    "labels": {"app": f"{job_name}"}
+                },
+                "spec": {
+                    "jobTargetRef": {
+                        "parallelism": 1,
+                        "completions": 1,
+                        "activeDeadlineSeconds": 900,
+                        "backoffLimit": 2,
+                        "template": {
+                            "metadata": {
+                                "labels": {"app": f"{job_name}"}
+                            },
+                            "spec": {
+                                "serviceAccountName": f"{svc_accnt_name}",
+                                "restartPolicy": "Never",
+                                "containers": [
+                                    {
+                                        "name": f"{job_name}",
+                                        "image": f"{consumer_img.image_uri}",
+                                        "resources": {
+                                            "requests": consumer_resource_requests
+                                        },
+                                        "env": [
+                                            {
+                                                # Exit after TOT_MSGS_TO_PROCESS msgs or once the queue is empty
+                                                "name": "CONSUMER_MODE",
+                                                "value": "job"
+                                            },
+                                            {
+                                                "name": "TOT_MSGS_TO_PROCESS",
+                                                "value": f"{scaled_job_msgs_per_job}"
+                                            },
+                                            {
+                                                "name": "CPU_REQUEST_MILLICORES",
+                                                "valueFrom": {
+                                                    "resourceFieldRef": {
+                                                        "containerName": f"{job_name}",
+                                                        "resource": "requests.cpu",
+                                                        "divisor": "1m"
+                                                    }
+                                                }
+                                            },
+                                            {
+                                                "name": "RELIABLE_QUEUE_URL",
+                                                "value": f"{reliable_q.queue_url}"
+                                            },
+                                            {
+                                                "name": "AWS_REGION",
+                                                "value": f"{cdk.Aws.REGION}"
+                                            },
+                                            {
+                                                "name": "STORE_EVENTS_BKT",
+                                                "value": f"{sales_event_bkt.bucket_name}"
+                                            },
+                                            {
+                                                "name": "MAX_MSGS_PER_BATCH",
+                                                "value": "10"
+                                            },
+                                            {
+                                                "name": "S3_SINK_FORMAT",
+                                                "value": "ndjson"
+                                            },
+                                            {
+                                                "name": "S3_SINK_GZIP",
+                                                "value": "true"
+                                            },
+                                            {
+                                                # Same as the reliable_q visibility timeout
+                                                "name": "VISIBILITY_TIMEOUT_SECS",
+                                                "value": "30"
+                                            },
+                                            {
+                                                # No one scrapes a job
+                                                "name": "METRICS_PORT",
+                                                "value": "0"
+                                            }
+                                        ]
+                                    }
+                                ]
+                            }
+                        }
+                    },
+                    "pollingInterval": scaler_polling_interval,
+                    "maxReplicaCount": scaled_job_max_replicas,
+                    "successfulJobsHistoryLimit": 5,
+                    "failedJobsHistoryLimit": 5,
+                    "scalingStrategy": {
+                        # Pending jobs are not counted twice against the queue length
+                        "strategy": "accurate"
+                    },
+                    "triggers": [
+                        {
+                            "type": "aws-sqs-queue",
+                            "metadata": {
+                                "queueURL": f"{reliable_q.queue_url}",
+                                "queueLength": f"{scaled_job_msgs_per_job}",
+                                "awsRegion": f"{cdk.Aws.REGION}",
+                                "identityOwner": "operator"
+                            }
+                        }
+                    ]
+                }
+            }
+
+            app_01_job_scaler_manifest = _eks.KubernetesManifest(
+                self,
+                "miztSalesEventConsumerJobScaler",
+                cluster=eks_cluster,
+                manifest=[
+                    app_01_scaled_job
+                ]
+            )
+
+            app_01_job_scaler_manifest.node.add_dependency(app_grp_01_ns)
+            app_01_job_scaler_manifest.node.add_dependency(events_consumer_svc_accnt)
+
+        ########################################
+        #######                          #######
+        #######   Warm Pool              #######
+        #######                          #######
+        ########################################
+
+        # Placeholder pods, each holding the resources of one consumer on a node
+        # that has already pulled the consumer image. A scaled out consumer
+        # preempts one & starts right away, instead of waiting on a new node &
+        # the image pull. The evicted placeholder goes Pending, which is what
+        # makes the cluster autoscaler add a node to refill the pool.
+        warm_pool_name = f"{app_grp_01_name}-warm-pool"
+
+        if warm_pool_size > 0:
+            # Below the default priority(0) of the consumer pods, so they preempt it
+            warm_pool_priority_class = {
+                "apiVersion": "scheduling.k8s.io/v1",
+                "kind": "PriorityClass",
+                "metadata": {
+                    "name": f"{warm_pool_name}"
+                },
+                "value": -10,
+                "globalDefault": False,
+                "description": "Placeholders reserving capacity for the sales events consumer"
+            }
+
+            warm_pool_deployment = {
+                "apiVersion": "apps/v1",
+                "kind": "Deployment",
+                "metadata": {
+                    "name": f"{warm_pool_name}",
+                    "namespace": f"{app_grp_01_ns_name}"
+                },
+                "spec": {
+                    "replicas": warm_pool_size,
+                    "selector": {"matchLabels": {"app": f"{warm_pool_name}"}},
+                    "template": {
+                        "metadata": {
+                            "labels": {"app": f"{warm_pool_name}"}
+                        },
+                        "spec": {
+                            "priorityClassName": f"{warm_pool_name}",
+                            # Nothing to drain, give the slot up at once
+                            "terminationGracePeriodSeconds": 0,
+                            # Pulls the consumer image onto the node, for the consumer that takes the slot
+                            "initContainers": [
+                                {
+                                    "name": "pull-consumer-image",
+                                    "image": f"{consumer_img.image_uri}",
+                                    "command": ["true"]
+                                }
+                            ],
+                            "containers": [
+                                {
+                                    "name": "placeholder",
+                                    "image": "k8s.gcr.io/pause:3.2",
+                                    "resources": {
+                                        "requests": consumer_resource_requests
+                                    }
+                                }
+                            ]
+                        }
+                    }
+                }
+            }
+
+            warm_pool_manifest = _eks.KubernetesManifest(
+                self,
+                "miztSalesEventConsumerWarmPool",
+                cluster=eks_cluster,
+                manifest=[
+                    warm_pool_priority_class,
+                    warm_pool_deployment
+                ]
+            )
+
+            warm_pool_manifest.node.add_dependency(app_grp_01_ns)
+
         ###########################################
         ################# OUTPUTS #################
         ###########################################
@@ -213,3 +730,26 @@ class EksSqsConsumerStack(cdk.Stack):
             value=f"{GlobalArgs.SOURCE_INFO}",
             description="To know more about this automation stack, check out our github page.",
         )
+
+        output_1 = cdk.CfnOutput(
+            self,
+            "ConsumerImageUri",
+            value=f"{consumer_img.image_uri}",
+            description="Consumer image, for the hand edited KEDA ScaledJob in keda_scalers"
+        )
+
+        if scaler_trigger != "none":
+            output_2 = cdk.CfnOutput(
+                self,
+                "ConsumerScaledObject",
+                value=f"{app_grp_01_ns_name}/{scaler_name}",
+                description=f"KEDA ScaledObject of the consumer deployment, on the {scaler_trigger} trigger"
+            )
+
+        if scaled_job_max_replicas > 0:
+            output_3 = cdk.CfnOutput(
+                self,
+                "ConsumerScaledJob",
+                value=f"{app_grp_01_ns_name}/{job_scaler_name}",
+                description="KEDA ScaledJob of the consumer jobs"
+            )
@@ -1,11 +1,30 @@
 # -*- coding: utf-8 -*-
 
+import time
+
+# Start of the import, for STARTUP_PROFILE
+_IMPORT_START = time.perf_counter()
+
 import json
 import logging
 import os
 import datetime
-import time
-import boto3
+import gzip
+import math
+import threading
+import asyncio
+import random
+import signal
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# botocore & pyarrow are imported on first use, to keep the import cheap
+pa = None
+pq = None
 
 
 class GlobalArgs:
@@ -14,12 +33,64 @@ class GlobalArgs:
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
     AWS_REGION = os.getenv("AWS_REGION")
     RELIABLE_QUEUE_NAME = os.getenv("RELIABLE_QUEUE_NAME")
+    RELIABLE_QUEUE_URL = os.getenv("RELIABLE_QUEUE_URL")
     MAX_MSGS_PER_BATCH = int(os.getenv("MAX_MSGS_PER_BATCH", 5))
     MSG_POLL_BACKOFF = int(os.getenv("MSG_POLL_BACKOFF", 2))
-    MSG_PROCESS_DELAY = int(os.getenv("MSG_PROCESS_DELAY", 10))
+    MAX_POLL_BACKOFF = int(os.getenv("MAX_POLL_BACKOFF", 64))
+    MSG_PROCESS_DELAY = int(os.getenv("MSG_PROCESS_DELAY", 0))
+    LONG_POLL_SECS = min(int(os.getenv("LONG_POLL_SECS", 20)), 20)
+    # service: poll until stopped, job: exit after TOT_MSGS_TO_PROCESS or once the queue is empty
+    CONSUMER_MODE = os.getenv("CONSUMER_MODE", "service")
     TOT_MSGS_TO_PROCESS = int(os.getenv("TOT_MSGS_TO_PROCESS", 10))
     S3_BKT_NAME = os.getenv("STORE_EVENTS_BKT")
     S3_PREFIX = "store_events"
+    S3_WRITER_POOL_SIZE = int(os.getenv("S3_WRITER_POOL_SIZE", 10))
+    # json: One object per event
+    # ndjson|parquet: Buffered, one object per partition flush
+    S3_SINK_FORMAT = os.getenv("S3_SINK_FORMAT", "json").lower()
+    S3_SINK_GZIP = os.getenv("S3_SINK_GZIP", "false").lower() == "true"
+    # snappy, gzip, zstd, brotli, lz4 or none
+    PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "snappy").lower()
+    SINK_MAX_BYTES = int(os.getenv("SINK_MAX_BYTES", 8 * 1024 * 1024))
+    SINK_MAX_EVNTS = int(os.getenv("SINK_MAX_EVNTS", 5000))
+    # Buffered msgs are in-flight, the heartbeat extends their visibility
+    SINK_MAX_AGE_SECS = float(os.getenv("SINK_MAX_AGE_SECS", 10))
+    # botocore client tuning, shared by the SQS & S3 clients
+    AWS_RETRY_MODE = os.getenv("AWS_RETRY_MODE", "adaptive")
+    AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", 5))
+    AWS_CONNECT_TIMEOUT = float(os.getenv("AWS_CONNECT_TIMEOUT", 2))
+    AWS_READ_TIMEOUT = float(os.getenv("AWS_READ_TIMEOUT", 10))
+    AWS_TCP_KEEPALIVE = os.getenv("AWS_TCP_KEEPALIVE", "true").lower() == "true"
+    # Must match the queue, msgs are extended before it runs out
+    VISIBILITY_TIMEOUT_SECS = int(os.getenv("VISIBILITY_TIMEOUT_SECS", 30))
+    HEARTBEAT_INTERVAL_SECS = float(os.getenv("HEARTBEAT_INTERVAL_SECS", 5))
+    # Stop extending a msg held longer than this, it is likely stuck
+    HEARTBEAT_MAX_SECS = int(os.getenv("HEARTBEAT_MAX_SECS", 900))
+    # Secs to drain in after SIGTERM, keep below the pod terminationGracePeriodSeconds
+    SHUTDOWN_GRACE_SECS = float(os.getenv("SHUTDOWN_GRACE_SECS", 25))
+    # Part of the grace period kept for flushing the sink & releasing msgs
+    SHUTDOWN_FLUSH_SECS = float(os.getenv("SHUTDOWN_FLUSH_SECS", 5))
+    # Log the import & client creation times at startup
+    STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "false").lower() == "true"
+    STARTUP_BUDGET_SECS = float(os.getenv("STARTUP_BUDGET_SECS", 2))
+    # /healthz fails once a worker has not completed a poll in this long
+    HEALTH_STALE_SECS = float(os.getenv("HEALTH_STALE_SECS", 120))
+    # Prometheus /metrics, /healthz & /readyz endpoint, 0 to disable
+    METRICS_PORT = int(os.getenv("METRICS_PORT", 8080))
+    # Concurrent poll->process->delete pipelines in this process
+    CONSUMER_WORKER_MODE = os.getenv("CONSUMER_WORKER_MODE", "thread").lower()
+    CPU_REQUEST_MILLICORES = int(os.getenv("CPU_REQUEST_MILLICORES", 250))
+    WORKERS_PER_CPU = int(os.getenv("WORKERS_PER_CPU", 8))
+    # Workers are I/O bound, by default size them off the pod's cpu request
+    CONSUMER_WORKERS = int(os.getenv(
+        "CONSUMER_WORKERS",
+        max(1, math.ceil(CPU_REQUEST_MILLICORES / 1000 * WORKERS_PER_CPU))
+    ))
+    # Pollers + the sink flusher share the SQS pool, the S3 writers the S3 pool
+    SQS_MAX_POOL_CONNECTIONS = int(os.getenv(
+        "SQS_MAX_POOL_CONNECTIONS", max(10, CONSUMER_WORKERS + 2)))
+    S3_MAX_POOL_CONNECTIONS = int(os.getenv(
+        "S3_MAX_POOL_CONNECTIONS", S3_WRITER_POOL_SIZE))
 
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL):
@@ -31,77 +102,1045 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL):
 
 
 logger = set_logging()
-sqs_client = boto3.client("sqs", region_name=GlobalArgs.AWS_REGION)
-_s3 = boto3.client("s3")
 
 
-def put_object(_pre, data):
+class Metrics:
+    """
+    Minimal thread safe counters & histograms, served in the prometheus text
+    format. Avoids pulling in prometheus_client into the pod.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10, 20, float("inf"))
+    # Window of the per pod processing rate gauge
+    RATE_WINDOW_SECS = 60
+
+    DEFS = {
+        "consumer_msgs_received_total": ("counter", "Msgs received from SQS"),
+        "consumer_msgs_processed_total": ("counter", "Msgs processed, by result"),
+        "consumer_receive_calls_total": ("counter", "ReceiveMessage calls, by result"),
+        "consumer_delete_failures_total": ("counter", "Msgs that failed to delete"),
+        "consumer_stage_seconds": ("histogram", "Latency of each processing stage"),
+        "consumer_processing_rate": ("gauge", "Msgs processed per sec by this pod, over the rate window"),
+        "consumer_workers": ("gauge", "Concurrent poller pipelines in this pod"),
+        "consumer_visibility_extensions_total": ("counter", "In-flight msgs whose visibility was extended"),
+        "consumer_msgs_released_total": ("counter", "Msgs made visible again without processing"),
+        "consumer_http_connections": ("gauge", "Connections opened by each client's pool"),
+        "consumer_http_requests": ("gauge", "Requests sent by each client's pool"),
+        "consumer_time_to_first_msg_seconds": ("gauge", "Secs from process start to the first msg received"),
+        "consumer_poll_state": ("gauge", "Current poll state of each worker")
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._hists = {}
+        self._gauges = {}
+        # Msgs processed per whole second, for the processing rate gauge
+        self._rate_buckets = deque()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def inc(self, name, val=1, labels=None):
+        _k = self._key(name, labels)
+        with self._lock:
+            self._counters[_k] = self._counters.get(_k, 0) + val
+            if name == "consumer_msgs_processed_total":
+                _sec = int(time.time())
+                if self._rate_buckets and self._rate_buckets[-1][0] == _sec:
+                    self._rate_buckets[-1][1] += val
+                else:
+                    self._rate_buckets.append([_sec, val])
+
+    def set(self, name, val, labels=None):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = val
+
+    def observe(self, name, secs, labels=None):
+        _k = self._key(name, labels)
+        with self._lock:
+            _h = self._hists.setdefault(
+                _k, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+            for i, b in enumerate(self.BUCKETS):
+                if secs <= b:
+                    _h["buckets"][i] += 1
+            _h["sum"] += secs
+            _h["count"] += 1
+
+    @contextmanager
+    def timed(self, stage):
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("consumer_stage_seconds",
+                         time.perf_counter() - _start, {"stage": stage})
+
+    def processing_rate(self):
+        _since = int(time.time()) - self.RATE_WINDOW_SECS
+        with self._lock:
+            while self._rate_buckets and self._rate_buckets[0][0] <= _since:
+                self._rate_buckets.popleft()
+            return sum(c for _, c in self._rate_buckets) / self.RATE_WINDOW_SECS
+
+    @staticmethod
+    def _fmt_labels(labels, extra=None):
+        _l = list(labels) + list(extra or [])
+        if not _l:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in _l) + "}"
+
+    def render(self):
+        self.set("consumer_processing_rate", self.processing_rate())
+        for svc, _cs in conn_stats().items():
+            self.set("consumer_http_connections",
+                     _cs["connections"], {"svc": svc})
+            self.set("consumer_http_requests", _cs["requests"], {"svc": svc})
+        for _ps in poll_states():
+            for _st in ("busy", "draining", "idle", "throttled", "erroring"):
+                self.set("consumer_poll_state", int(_ps["state"] == _st),
+                         {"w_id": _ps["w_id"], "state": _st})
+        _lines = []
+        with self._lock:
+            for name, (m_type, m_help) in self.DEFS.items():
+                _lines.append(f"# HELP {name} {m_help}")
+                _lines.append(f"# TYPE {name} {m_type}")
+                if m_type == "histogram":
+                    for (n, labels), _h in self._hists.items():
+                        if n != name:
+                            continue
+                        for b, c in zip(self.BUCKETS, _h["buckets"]):
+                            _le = "+Inf" if b == float("inf") else b
+                            _lines.append(
+                                f"{name}_bucket{self._fmt_labels(labels, [('le', _le)])} {c}")
+                        _lines.append(
+                            f"{name}_sum{self._fmt_labels(labels)} {_h['sum']}")
+                        _lines.append(
+                            f"{name}_count{self._fmt_labels(labels)} {_h['count']}")
+                    continue
+                _vals = self._counters if m_type == "counter" else self._gauges
+                for (n, labels), v in _vals.items():
+                    if n == name:
+                        _lines.append(f"{name}{self._fmt_labels(labels)} {v}")
+        return "\n".join(_lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def _reply(self, code, body, content_type="text/plain"):
+        _body = body.encode("UTF-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._reply(200, metrics.render(), "text/plain; version=0.0.4")
+        elif self.path == "/healthz":
+            _ok = is_live()
+            self._reply(200 if _ok else 503, "ok\n" if _ok else "stale\n")
+        elif self.path == "/readyz":
+            _ok = is_ready()
+            self._reply(200 if _ok else 503, "ok\n" if _ok else "not ready\n")
+        elif self.path == "/drain":
+            # The pod preStop hook, start draining before the SIGTERM arrives
+            _shutdown.begin("preStop")
+            self._reply(200, "draining\n")
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the app logs
+        pass
+
+
+def start_metrics_server(port=GlobalArgs.METRICS_PORT):
+    if not port:
+        return None
+    _srv = ThreadingHTTPServer(("", port), _MetricsHandler)
+    _srv.daemon_threads = True
+    threading.Thread(target=_srv.serve_forever,
+                     name="metrics_server", daemon=True).start()
+    logger.info(f'{{"metrics_port":{port}}}')
+    return _srv
+
+
+# Clients are created on first use, not at import. Tests & benchmarks can set them
+sqs_client = None
+_s3 = None
+_clients_lock = threading.Lock()
+# Secs spent creating each client, for STARTUP_PROFILE
+_client_init_secs = {}
+_botocore_session = None
+
+
+def _client_config(max_pool_connections, read_timeout=None):
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=max_pool_connections,
+        retries={
+            "mode": GlobalArgs.AWS_RETRY_MODE,
+            "total_max_attempts": GlobalArgs.AWS_MAX_ATTEMPTS
+        },
+        connect_timeout=GlobalArgs.AWS_CONNECT_TIMEOUT,
+        read_timeout=read_timeout or GlobalArgs.AWS_READ_TIMEOUT,
+        tcp_keepalive=GlobalArgs.AWS_TCP_KEEPALIVE
+    )
+
+
+def _new_client(svc, **kwargs):
+    """ Create a client off one shared botocore session, which loads only this service's model """
+    global _botocore_session
+    _start = time.perf_counter()
+    if _botocore_session is None:
+        import botocore.session
+        _botocore_session = botocore.session.get_session()
+    _c = _botocore_session.create_client(svc, **kwargs)
+    _client_init_secs[svc] = round(time.perf_counter() - _start, 4)
+    return _c
+
+
+def get_sqs_client():
+    global sqs_client
+    if sqs_client is None:
+        with _clients_lock:
+            if sqs_client is None:
+                sqs_client = _new_client(
+                    "sqs",
+                    region_name=GlobalArgs.AWS_REGION,
+                    # A long poll holds the connection upto LONG_POLL_SECS
+                    config=_client_config(
+                        GlobalArgs.SQS_MAX_POOL_CONNECTIONS,
+                        max(GlobalArgs.AWS_READ_TIMEOUT,
+                            GlobalArgs.LONG_POLL_SECS + 5)
+                    )
+                )
+    return sqs_client
+
+
+def get_s3_client():
+    global _s3
+    if _s3 is None:
+        with _clients_lock:
+            if _s3 is None:
+                # One connection per writer thread, so parallel puts reuse keep-alive connections
+                _s3 = _new_client(
+                    "s3",
+                    region_name=GlobalArgs.AWS_REGION,
+                    config=_client_config(GlobalArgs.S3_MAX_POOL_CONNECTIONS)
+                )
+    return _s3
+
+
+# Created on first use. Dropped at the start of every run_consumers, so a
+# worker left behind by the last run cannot start a new one
+_s3_writers = None
+
+
+def get_s3_writers():
+    global _s3_writers
+    if _s3_writers is None:
+        with _clients_lock:
+            if _s3_writers is None:
+                _s3_writers = ThreadPoolExecutor(
+                    max_workers=GlobalArgs.S3_WRITER_POOL_SIZE,
+                    thread_name_prefix="s3_writer"
+                )
+    return _s3_writers
+
+
+def conn_stats():
+    """ New connections vs requests per client, from the urllib3 pools botocore keeps """
+    _stats = {}
+    for svc, _c in (("sqs", sqs_client), ("s3", _s3)):
+        try:
+            _pools = _c._endpoint.http_session._manager.pools
+            _conns = sum(_pools[k].num_connections for k in _pools.keys())
+            _reqs = sum(_pools[k].num_requests for k in _pools.keys())
+        except AttributeError:
+            # Not created yet, or not a botocore client
+            continue
+        _stats[svc] = {
+            "connections": _conns,
+            "requests": _reqs,
+            "reuse_ratio": round(1 - _conns / _reqs, 4) if _reqs else None
+        }
+    return _stats
+
+
+def put_object(_pre, data, _sfx=None):
+    _ts = datetime.datetime.now()
+    # Suffix the key with the msg id, concurrent writers can share a timestamp
+    _k = f"{_ts.strftime('%s%f')}_{_sfx}" if _sfx else _ts.strftime('%s%f')
     try:
-        _r = _s3.put_object(
-            Bucket=GlobalArgs.S3_BKT_NAME,
-            Key=f"{GlobalArgs.S3_PREFIX}/event_type={_pre}/dt={datetime.datetime.now().strftime('%Y_%m_%d')}/{datetime.datetime.now().strftime('%s%f')}.json",
-            Body=json.dumps(data).encode("UTF-8"),
-        )
+        with metrics.timed("put"):
+            _r = get_s3_client().put_object(
+                Bucket=GlobalArgs.S3_BKT_NAME,
+                Key=f"{GlobalArgs.S3_PREFIX}/event_type={_pre}/dt={_ts.strftime('%Y_%m_%d')}/{_k}.json",
+                Body=json.dumps(data).encode("UTF-8"),
+            )
+        logger.debug(f"resp: {json.dumps(_r)}")
+    except Exception as e:
+        logger.exception(f"ERROR:{str(e)}")
+        return False
+    return True
+
+
+def put_part(e_type, dt, body, ext):
+    """ Write one flushed partition of buffered events """
+    _k = f"{datetime.datetime.now().strftime('%s%f')}_{uuid.uuid4().hex[:8]}"
+    try:
+        with metrics.timed("put"):
+            _r = get_s3_client().put_object(
+                Bucket=GlobalArgs.S3_BKT_NAME,
+                Key=f"{GlobalArgs.S3_PREFIX}/event_type={e_type}/dt={dt}/{_k}.{ext}",
+                Body=body,
+            )
         logger.debug(f"resp: {json.dumps(_r)}")
     except Exception as e:
         logger.exception(f"ERROR:{str(e)}")
+        return False
+    return True
+
+
+# Typed columns for the fields the sales event producer emits
+_EVNT_SCHEMA = [
+    ("request_id", "string"),
+    ("store_id", "int64"),
+    ("cust_id", "int64"),
+    ("category", "string"),
+    ("sku", "int64"),
+    ("price", "float64"),
+    ("qty", "int64"),
+    ("discount", "float64"),
+    ("gift_wrap", "bool"),
+    ("variant", "string"),
+    ("priority_shipping", "bool"),
+    ("is_return", "bool"),
+    ("bad_msg", "bool"),
+    ("ts", "timestamp"),
+    ("contact_me", "string")
+]
+
+
+def _load_pyarrow():
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(
+                "S3_SINK_FORMAT=parquet needs pyarrow, pip3 install pyarrow")
+        pa, pq = pyarrow, pyarrow.parquet
+
+
+def _to_parquet(rows):
+    """ Columnar encode a batch of events, fields missing in an event are null """
+    _types = {
+        "string": pa.string(),
+        "int64": pa.int64(),
+        "float64": pa.float64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("us")
+    }
+    _schema = pa.schema([(n, _types[t]) for n, t in _EVNT_SCHEMA])
+    _cols = {}
+    for n, t in _EVNT_SCHEMA:
+        _col = [r.get(n) for r in rows]
+        if t == "timestamp":
+            _col = [datetime.datetime.fromisoformat(v) if v else None
+                    for v in _col]
+        _cols[n] = _col
+    _buf = pa.BufferOutputStream()
+    pq.write_table(
+        pa.Table.from_pydict(_cols, schema=_schema),
+        _buf,
+        compression=GlobalArgs.PARQUET_COMPRESSION
+    )
+    return _buf.getvalue().to_pybytes()
+
+
+_SINK_FORMATS = ("json", "ndjson", "parquet")
+
+
+def check_sink_format(sink_format):
+    """ Fail at startup, not on the first flush, on a typo in S3_SINK_FORMAT """
+    if sink_format not in _SINK_FORMATS:
+        raise ValueError(f"Unknown S3_SINK_FORMAT:{sink_format}")
+
+
+class S3EventSink:
+    """
+    Buffers events per event_type/dt partition & writes each partition as one
+    newline delimited or parquet object, when it hits SINK_MAX_BYTES,
+    SINK_MAX_EVNTS or SINK_MAX_AGE_SECS. The msgs of a partition are deleted only after its
+    object is written, failed flushes are left to be redelivered.
+    """
+
+    def __init__(self, on_flushed):
+        if GlobalArgs.S3_SINK_FORMAT == "parquet":
+            _load_pyarrow()
+        self.on_flushed = on_flushed
+        self._parts = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.stats = {"flushes": 0, "f_flushes": 0, "flushed_evnts": 0}
+        self._flusher = threading.Thread(
+            target=self._flush_aged, name="s3_sink_flusher", daemon=True)
+        self._flusher.start()
+
+    def add(self, e_type, data, del_entry):
+        _line = json.dumps(data).encode("UTF-8") + b"\n"
+        _p_key = (e_type, datetime.datetime.now().strftime('%Y_%m_%d'))
+        with self._lock:
+            _p = self._parts.setdefault(
+                _p_key, {"lines": [], "bytes": 0, "first_ts": time.monotonic(), "del_entries": []})
+            # Parquet is encoded column wise at flush, keep the event as is
+            _p["lines"].append(
+                data if GlobalArgs.S3_SINK_FORMAT == "parquet" else _line)
+            _p["bytes"] += len(_line)
+            _p["del_entries"].append(del_entry)
+            _full = (_p["bytes"] >= GlobalArgs.SINK_MAX_BYTES
+                     or len(_p["lines"]) >= GlobalArgs.SINK_MAX_EVNTS)
+            if _full:
+                del self._parts[_p_key]
+        if _full:
+            self._flush({_p_key: _p})
+
+    def _take(self, force=False):
+        _now = time.monotonic()
+        with self._lock:
+            _due = {k: p for k, p in self._parts.items()
+                    if force or _now - p["first_ts"] >= GlobalArgs.SINK_MAX_AGE_SECS}
+            for k in _due:
+                del self._parts[k]
+        return _due
+
+    def _flush(self, parts, timeout=None):
+        if GlobalArgs.S3_SINK_FORMAT == "parquet":
+            _ext = "parquet"
+        else:
+            _ext = "jsonl.gz" if GlobalArgs.S3_SINK_GZIP else "jsonl"
+        _writes = {}
+        for (e_type, dt), _p in parts.items():
+            try:
+                if GlobalArgs.S3_SINK_FORMAT == "parquet":
+                    _body = _to_parquet(_p["lines"])
+                else:
+                    _body = b"".join(_p["lines"])
+                    if GlobalArgs.S3_SINK_GZIP:
+                        _body = gzip.compress(_body)
+            except Exception as e:
+                # Not written, hand the msgs back & carry on with the other partitions
+                logger.exception(f"ERROR:{str(e)}")
+                with self._lock:
+                    self.stats["f_flushes"] += 1
+                _hb_release(_p["del_entries"])
+                continue
+            _f = get_s3_writers().submit(put_part, e_type, dt, _body, _ext)
+            _writes[_f] = _p
+        try:
+            for _f in as_completed(_writes, timeout=timeout):
+                _p = _writes.pop(_f)
+                if not _f.result():
+                    with self._lock:
+                        self.stats["f_flushes"] += 1
+                    _hb_release(_p["del_entries"])
+                    continue
+                with self._lock:
+                    self.stats["flushes"] += 1
+                    self.stats["flushed_evnts"] += len(_p["lines"])
+                try:
+                    self.on_flushed(_p["del_entries"])
+                except Exception as e:
+                    # Written but not deleted, the msgs will be redelivered
+                    logger.exception(f"ERROR:{str(e)}")
+        except FutureTimeoutError:
+            # Not waited on, their msgs are still in-flight & released by run_consumers
+            logger.warning(f'{{"sink_unflushed_parts":{len(_writes)}}}')
+        logger.debug(f'{{"sink_stats":{json.dumps(self.stats)}}}')
+
+    def _flush_aged(self):
+        while not self._stop.wait(1):
+            try:
+                _due = self._take()
+                if _due:
+                    self._flush(_due)
+            except Exception as e:
+                logger.exception(f"ERROR:{str(e)}")
+
+    def close(self, timeout=None):
+        """ Stop the age based flusher & flush everything that is buffered, within timeout secs """
+        _until = None if timeout is None else time.monotonic() + timeout
+        self._stop.set()
+        self._flusher.join(timeout)
+        self._flush(self._take(force=True),
+                    None if _until is None else max(0, _until - time.monotonic()))
+        logger.info(f'{{"sink_stats":{json.dumps(self.stats)}}}')
+
+
+# Resolved queue url, seeded from the env to skip the lookup at startup
+_q_url = GlobalArgs.RELIABLE_QUEUE_URL
 
 
 def get_q_url(sqs_client):
-    q = sqs_client.get_queue_url(
-        QueueName=GlobalArgs.RELIABLE_QUEUE_NAME).get("QueueUrl")
-    logger.debug(f'{{"q_url":"{q}"}}')
-    return q
-
-
-def sqs_polling():
-    no_msgs = False
-    no_msg_cnt = 0
-    back_off_secs = GlobalArgs.MSG_POLL_BACKOFF
-    # poll sqs for 10000 Msgs
-    t_msgs = 0
-    while True:
-        q_url = get_q_url(sqs_client)
-        msg_batch = get_msgs(
-            q_url, GlobalArgs.MAX_MSGS_PER_BATCH, GlobalArgs.MSG_POLL_BACKOFF)
+    global _q_url
+    if not _q_url:
+        _q_url = sqs_client.get_queue_url(
+            QueueName=GlobalArgs.RELIABLE_QUEUE_NAME).get("QueueUrl")
+        logger.debug(f'{{"q_url":"{_q_url}"}}')
+    return _q_url
+
+
+def invalidate_q_url():
+    global _q_url
+    logger.warning(f'{{"q_url_invalidated":"{_q_url}"}}')
+    _q_url = None
+
+
+class VisibilityHeartbeat:
+    """
+    Tracks the receipt handles of in-flight msgs & extends their visibility,
+    with ChangeMessageVisibilityBatch, while they are still being processed.
+    Msgs that will not be processed here can be released(visibility 0), so
+    another replica picks them up right away.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._beat, name="visibility_heartbeat", daemon=True)
+        self._thread.start()
+
+    def track(self, msgs):
+        _now = time.monotonic()
+        with self._lock:
+            for m in msgs:
+                self._inflight[m["ReceiptHandle"]] = {
+                    "Id": m["MessageId"],
+                    "ReceiptHandle": m["ReceiptHandle"],
+                    "received_at": _now,
+                    "expires_at": _now + GlobalArgs.VISIBILITY_TIMEOUT_SECS
+                }
+
+    def untrack(self, entries):
+        with self._lock:
+            for e in entries:
+                self._inflight.pop(e["ReceiptHandle"], None)
+
+    def _change_visibility(self, entries, secs):
+        """ Returns the receipt handles that were changed """
+        _changed = set()
+        sqs_client = get_sqs_client()
+        for i in range(0, len(entries), 10):
+            _chunk = entries[i:i + 10]
+            try:
+                _r = sqs_client.change_message_visibility_batch(
+                    QueueUrl=get_q_url(sqs_client),
+                    Entries=[{"Id": e["Id"], "ReceiptHandle": e["ReceiptHandle"],
+                              "VisibilityTimeout": secs} for e in _chunk]
+                )
+            except Exception as e:
+                logger.exception(f"ERROR:{str(e)}")
+                continue
+            _ok = {r["Id"] for r in _r.get("Successful", [])}
+            _changed |= {e["ReceiptHandle"] for e in _chunk if e["Id"] in _ok}
+        return _changed
+
+    def _beat(self):
+        while not self._stop.wait(GlobalArgs.HEARTBEAT_INTERVAL_SECS):
+            _now = time.monotonic()
+            # Extend msgs that would expire before the next beat, with a beat to spare
+            _margin = 2 * GlobalArgs.HEARTBEAT_INTERVAL_SECS
+            with self._lock:
+                _due = [e for e in self._inflight.values()
+                        if e["expires_at"] - _now <= _margin]
+                _stuck = [e for e in _due
+                          if _now - e["received_at"] >= GlobalArgs.HEARTBEAT_MAX_SECS]
+                for e in _stuck:
+                    self._inflight.pop(e["ReceiptHandle"], None)
+            if _stuck:
+                logger.warning(f'{{"heartbeat_gave_up_msgs":{len(_stuck)}}}')
+            _due = [e for e in _due if e not in _stuck]
+            if not _due:
+                continue
+            _changed = self._change_visibility(
+                _due, GlobalArgs.VISIBILITY_TIMEOUT_SECS)
+            _expires_at = time.monotonic() + GlobalArgs.VISIBILITY_TIMEOUT_SECS
+            with self._lock:
+                for rh in _changed:
+                    if rh in self._inflight:
+                        self._inflight[rh]["expires_at"] = _expires_at
+                # Receipt handle no longer valid, the msg is back on the queue
+                for e in _due:
+                    if e["ReceiptHandle"] not in _changed:
+                        self._inflight.pop(e["ReceiptHandle"], None)
+            metrics.inc("consumer_visibility_extensions_total", len(_changed))
+
+    def release(self, entries=None):
+        """ Make msgs visible again right away, all in-flight msgs by default """
+        with self._lock:
+            if entries is None:
+                entries = list(self._inflight.values())
+            for e in entries:
+                self._inflight.pop(e["ReceiptHandle"], None)
+        if not entries:
+            return 0
+        _released = len(self._change_visibility(entries, 0))
+        metrics.inc("consumer_msgs_released_total", _released)
+        logger.info(f'{{"released_msgs":{_released}}}')
+        return _released
+
+    def inflight(self):
+        with self._lock:
+            return len(self._inflight)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+# Created by run_consumers, extends the visibility of in-flight msgs. Kept
+# after the run, the workers it left behind still release what they get
+_heartbeat = None
+
+
+def _hb_track(msgs):
+    if _heartbeat:
+        _heartbeat.track(msgs)
+
+
+def _hb_untrack(entries):
+    if _heartbeat:
+        _heartbeat.untrack(entries)
+
+
+def _hb_release(entries):
+    if _heartbeat:
+        _heartbeat.release(entries)
+
 
-        if msg_batch.get("Messages"):
-            no_msgs = False
+class ShutdownCoordinator:
+    """
+    Turns a SIGTERM/SIGINT, or a GET /drain from the preStop hook, into a drain
+    bounded by SHUTDOWN_GRACE_SECS. The workers stop receiving & finish their
+    current batch, until SHUTDOWN_FLUSH_SECS before the deadline. What is left
+    after that is flushed or released by run_consumers.
+    """
+
+    def __init__(self):
+        self.stop_evnt = threading.Event()
+        self._lock = threading.Lock()
+        self._deadline = None
+
+    def install(self):
+        # Signal handlers can only be set from the main thread
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for _sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(_sig, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self.begin(signal.Signals(signum).name)
+
+    def begin(self, reason):
+        with self._lock:
+            if self._deadline is not None:
+                return
+            self._deadline = time.monotonic() + GlobalArgs.SHUTDOWN_GRACE_SECS
+        self.stop_evnt.set()
+        logger.info(
+            f'{{"shutdown":"{reason}", "grace_secs":{GlobalArgs.SHUTDOWN_GRACE_SECS}}}')
+
+    def is_set(self):
+        return self.stop_evnt.is_set()
+
+    def secs_left(self):
+        """ Secs until the deadline, None if not draining """
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - time.monotonic())
+
+    def drain_expired(self):
+        """ True once the workers have used up their share of the grace period """
+        _left = self.secs_left()
+        return _left is not None and _left <= GlobalArgs.SHUTDOWN_FLUSH_SECS
+
+
+_shutdown = ShutdownCoordinator()
+
+
+# Msgs processed across all workers
+_t_msgs = 0
+_t_msgs_lock = threading.Lock()
+
+
+def _add_processed(cnt):
+    global _t_msgs
+    with _t_msgs_lock:
+        _t_msgs += cnt
+        return _t_msgs
+
+
+# Set in job mode once a long poll comes back empty
+_q_drained = threading.Event()
+
+
+def _done():
+    # A service runs until it is stopped
+    if GlobalArgs.CONSUMER_MODE != "job":
+        return False
+    return _t_msgs >= GlobalArgs.TOT_MSGS_TO_PROCESS or _q_drained.is_set()
+
+
+def _proc_age_secs():
+    """ Secs since this process started, falls back to secs since import off linux """
+    try:
+        with open("/proc/self/stat") as f:
+            _start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            _uptime = float(f.read().split()[0])
+        return _uptime - _start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED_AT
+
+
+_IMPORTED_AT = time.monotonic()
+_first_msg_evnt = threading.Event()
+
+
+def _mark_first_msg():
+    # Cold start of the pod, from process start to the first msg received
+    if _first_msg_evnt.is_set():
+        return
+    _first_msg_evnt.set()
+    _secs = round(_proc_age_secs(), 3)
+    metrics.set("consumer_time_to_first_msg_seconds", _secs)
+    logger.info(f'{{"time_to_first_msg_secs":{_secs}}}')
+
+
+_THROTTLE_ERR_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "RequestThrottled",
+    "OverLimit",
+    "TooManyRequestsException"
+)
+
+
+class PollController:
+    """
+    Adapts the receive wait & the delay between polls to what the queue returned.
+    - busy: Full batch, poll again right away
+    - draining: Partial batch, wait MSG_PROCESS_DELAY before polling again
+    - idle: Empty queue, long poll upto LONG_POLL_SECS with no extra delay
+    - throttled: Exponential back-off with jitter, upto MAX_POLL_BACKOFF
+    - erroring: Any other receive error(network, 5xx), same back-off as throttled
+    """
+
+    def __init__(self, w_id):
+        self.w_id = w_id
+        self.state = "idle"
+        self.wait_time_secs = GlobalArgs.LONG_POLL_SECS
+        self.delay_secs = 0
+        self.throttle_backoff_secs = 0
+        self.empty_polls = 0
+        self.throttled_polls = 0
+        self.error_polls = 0
+        self.started_at = time.monotonic()
+        self.last_poll_at = None
+
+    def _set(self, state, wait_time_secs, delay_secs):
+        self.last_poll_at = time.monotonic()
+        if state != self.state:
+            logger.info(
+                f'{{"w_id":{self.w_id}, "poll_state":"{state}", "from":"{self.state}"}}')
+        self.state = state
+        self.wait_time_secs = wait_time_secs
+        self.delay_secs = delay_secs
+
+    def on_batch(self, msg_cnt, max_msgs):
+        self.throttle_backoff_secs = 0
+        if msg_cnt >= max_msgs:
+            # Msgs are waiting, a short wait returns as soon as any are visible
+            self._set("busy", 1, 0)
+        elif msg_cnt:
+            self._set("draining", 1, GlobalArgs.MSG_PROCESS_DELAY)
         else:
-            no_msgs = True
-
-        # polling delay so aws does not throttle us
-        time.sleep(GlobalArgs.MSG_PROCESS_DELAY)
-        # sleep longer if there are no messages on the queue the last time it was polled
-        if no_msgs:
-            no_msg_cnt += 1
-            back_off_secs = 2 * back_off_secs
-            # HARD RESET, IF WE ARE WAITING FOR MESSAGES FOR LAST 10 MINUTES
-            if back_off_secs > 512:
-                back_off_secs = 2
-            logger.info(f'{{"sleeping_for":"{back_off_secs}"}}')
-            time.sleep(back_off_secs)
-
-        # Process & Delete Messages
-        if not no_msgs:
-            m_stats = process_msgs(msg_batch)
-            logger.info(f'{{"m_stats":"{json.dumps(m_stats)}"}}')
-            t_msgs += m_stats["msg_batch"]
-
-        # Break if we have processed X Msgs
-        if t_msgs >= GlobalArgs.TOT_MSGS_TO_PROCESS:
-            logger.info(f'{{"t_msgs":"{t_msgs}", "status":True }}')
+            self.empty_polls += 1
+            self._set("idle", GlobalArgs.LONG_POLL_SECS, 0)
+        return self.delay_secs
+
+    def _backoff(self, state):
+        self.throttle_backoff_secs = min(
+            max(2 * self.throttle_backoff_secs, GlobalArgs.MSG_POLL_BACKOFF),
+            GlobalArgs.MAX_POLL_BACKOFF
+        )
+        _jitter = random.uniform(0, self.throttle_backoff_secs / 2)
+        self._set(state, GlobalArgs.LONG_POLL_SECS,
+                  self.throttle_backoff_secs + _jitter)
+        return self.delay_secs
+
+    def on_throttle(self):
+        self.throttled_polls += 1
+        return self._backoff("throttled")
+
+    def on_error(self):
+        self.error_polls += 1
+        return self._backoff("erroring")
+
+    def is_stale(self):
+        return (time.monotonic() - (self.last_poll_at or self.started_at)
+                >= GlobalArgs.HEALTH_STALE_SECS)
+
+    def get_state(self):
+        return {
+            "w_id": self.w_id,
+            "state": self.state,
+            "wait_time_secs": self.wait_time_secs,
+            "delay_secs": round(self.delay_secs, 3),
+            "throttle_backoff_secs": self.throttle_backoff_secs,
+            "empty_polls": self.empty_polls,
+            "throttled_polls": self.throttled_polls,
+            "error_polls": self.error_polls
+        }
+
+
+# Poll controllers of all workers, to inspect the polling state
+_poll_ctrls = []
+
+
+def is_live():
+    """ Every worker completed a poll within HEALTH_STALE_SECS, a stuck or dead worker fails it """
+    return not any(c.is_stale() for c in _poll_ctrls)
+
+
+def is_ready():
+    """ A worker got through to the queue & the pod is not draining """
+    return not _shutdown.is_set() and any(c.last_poll_at for c in _poll_ctrls)
+
+
+def poll_states():
+    return [c.get_state() for c in _poll_ctrls]
+
+
+def poll_once(w_stats, poll_ctrl):
+    """ One receive, process & delete cycle. Returns the secs to wait before the next poll """
+    sqs_client = get_sqs_client()
+    q_url = get_q_url(sqs_client)
+    _wait_time_secs = poll_ctrl.wait_time_secs
+    try:
+        msg_batch = get_msgs(
+            q_url, GlobalArgs.MAX_MSGS_PER_BATCH, _wait_time_secs)
+    except sqs_client.exceptions.QueueDoesNotExist:
+        # Stale url, resolve it again by name on the next poll. Not an empty
+        # poll, a job must not take a missing queue for a drained one
+        invalidate_q_url()
+        metrics.inc("consumer_receive_calls_total",
+                    labels={"result": "error"})
+        return poll_ctrl.on_error()
+    except Exception as e:
+        # Back off & retry, a network blip or a 5xx must not kill the worker
+        _code = getattr(e, "response", {}).get("Error", {}).get("Code")
+        if _code in _THROTTLE_ERR_CODES:
+            metrics.inc("consumer_receive_calls_total",
+                        labels={"result": "throttled"})
+            return poll_ctrl.on_throttle()
+        logger.error(
+            f'{{"w_id":{w_stats["w_id"]}, "receive_err":"{str(e)}", "code":"{_code}"}}')
+        metrics.inc("consumer_receive_calls_total",
+                    labels={"result": "error"})
+        return poll_ctrl.on_error()
+
+    msgs = msg_batch.get("Messages", [])
+    metrics.inc("consumer_receive_calls_total",
+                labels={"result": "msgs" if msgs else "empty"})
+    metrics.inc("consumer_msgs_received_total", len(msgs))
+    wait_secs = poll_ctrl.on_batch(len(msgs), GlobalArgs.MAX_MSGS_PER_BATCH)
+    if not msgs:
+        # Only a full long poll proves the queue is empty, not the short one after a busy batch
+        if GlobalArgs.CONSUMER_MODE == "job" and _wait_time_secs >= GlobalArgs.LONG_POLL_SECS:
+            _q_drained.set()
+        return wait_secs
+    _mark_first_msg()
+    if _shutdown.is_set():
+        # Received while draining, hand them straight to another replica
+        _hb_release([{"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]}
+                     for m in msgs])
+        return 0
+    _hb_track(msgs)
+
+    # Process & Delete Messages
+    m_stats = process_msgs(msg_batch)
+    logger.info(
+        f'{{"w_id":{w_stats["w_id"]}, "m_stats":"{json.dumps(m_stats)}"}}')
+    w_stats["t_msgs"] += m_stats["msg_batch"]
+    _add_processed(m_stats["msg_batch"])
+    metrics.inc("consumer_msgs_processed_total",
+                m_stats["s_msgs"], {"result": "success"})
+    metrics.inc("consumer_msgs_processed_total",
+                m_stats["f_msgs"], {"result": "failed"})
+    metrics.inc("consumer_msgs_processed_total",
+                m_stats["p_msgs"], {"result": "poison"})
+    return wait_secs
+
+
+def _new_w_stats(w_id):
+    return {
+        "w_id": w_id,
+        "t_msgs": 0
+    }
+
+
+def _new_poll_ctrl(w_id):
+    poll_ctrl = PollController(w_id)
+    _poll_ctrls.append(poll_ctrl)
+    return poll_ctrl
+
+
+def sqs_polling(w_id=0, stop_evnt=None):
+    stop_evnt = stop_evnt or threading.Event()
+    w_stats = _new_w_stats(w_id)
+    poll_ctrl = _new_poll_ctrl(w_id)
+    # Break if we have processed X Msgs across all workers
+    while not stop_evnt.is_set() and not _done():
+        wait_secs = poll_once(w_stats, poll_ctrl)
+        if _done():
+            break
+        if wait_secs:
+            stop_evnt.wait(wait_secs)
+    logger.info(
+        f'{{"w_stats":{json.dumps(w_stats)}, "poll_state":{json.dumps(poll_ctrl.get_state())}}}')
+    return w_stats
+
+
+async def sqs_polling_async(w_id, stop_evnt, executor):
+    # boto3 is blocking, run the cycle on the executor and idle on the loop
+    loop = asyncio.get_running_loop()
+    w_stats = _new_w_stats(w_id)
+    poll_ctrl = _new_poll_ctrl(w_id)
+    while not stop_evnt.is_set() and not _done():
+        wait_secs = await loop.run_in_executor(
+            executor, poll_once, w_stats, poll_ctrl)
+        if _done():
             break
+        # Sleep in short slices, so a stop is noticed promptly
+        _slept = 0.0
+        while _slept < wait_secs and not stop_evnt.is_set():
+            _s = min(1.0, wait_secs - _slept)
+            await asyncio.sleep(_s)
+            _slept += _s
+    logger.info(
+        f'{{"w_stats":{json.dumps(w_stats)}, "poll_state":{json.dumps(poll_ctrl.get_state())}}}')
+    return w_stats
+
+
+async def _run_async_workers(stop_evnt):
+    executor = ThreadPoolExecutor(
+        max_workers=GlobalArgs.CONSUMER_WORKERS,
+        thread_name_prefix="sqs_poller"
+    )
+    tasks = [
+        asyncio.ensure_future(sqs_polling_async(i, stop_evnt, executor))
+        for i in range(GlobalArgs.CONSUMER_WORKERS)
+    ]
+    try:
+        while tasks:
+            _, tasks = await asyncio.wait(tasks, timeout=1)
+            if _shutdown.drain_expired():
+                break
+    finally:
+        # Do not wait on a poll still blocked in a long poll
+        executor.shutdown(wait=False)
+
+
+def run_consumers():
+    """ Run CONSUMER_WORKERS pipelines in this process, until stopped or, as a job, done """
+    global _sink, _heartbeat, _s3_writers, _t_msgs
+    check_sink_format(GlobalArgs.S3_SINK_FORMAT)
+    stop_evnt = _shutdown.stop_evnt
+    _shutdown.install()
+    workers = []
+    # A job counts & drains from scratch on every run
+    with _t_msgs_lock:
+        _t_msgs = 0
+    _q_drained.clear()
+    # Those of the last run were stopped, a new pool is created on first use
+    _s3_writers = None
+    _sink = S3EventSink(_del_flushed) if GlobalArgs.S3_SINK_FORMAT != "json" else None
+    _heartbeat = VisibilityHeartbeat()
+    start_metrics_server()
+    metrics.set("consumer_workers", GlobalArgs.CONSUMER_WORKERS)
+    logger.info(
+        f'{{"consumer_mode":"{GlobalArgs.CONSUMER_MODE}", "consumer_workers":{GlobalArgs.CONSUMER_WORKERS}, "worker_mode":"{GlobalArgs.CONSUMER_WORKER_MODE}"}}')
+    try:
+        if GlobalArgs.CONSUMER_WORKER_MODE == "asyncio":
+            asyncio.run(_run_async_workers(stop_evnt))
+        else:
+            workers = [
+                threading.Thread(
+                    target=sqs_polling,
+                    args=(i, stop_evnt),
+                    name=f"sqs_poller_{i}",
+                    daemon=True
+                )
+                for i in range(GlobalArgs.CONSUMER_WORKERS)
+            ]
+            for w in workers:
+                w.start()
+            # Join with a timeout, so the main thread keeps handling signals &
+            # notices the end of the workers' share of the grace period
+            _alive = workers
+            while _alive:
+                _left = _shutdown.secs_left()
+                _alive[0].join(timeout=1 if _left is None else
+                               min(1, max(0.1, _left - GlobalArgs.SHUTDOWN_FLUSH_SECS)))
+                # A worker still in a long poll or a slow write is left behind, it
+                # stops before its next write & releases what it gets
+                if _shutdown.drain_expired():
+                    break
+                _alive = [w for w in _alive if w.is_alive()]
+    finally:
+        # Write & delete whatever is still buffered, within what is left of the grace period
+        if _sink:
+            _sink.close(_shutdown.secs_left())
+        # Anything still in-flight was not processed, hand it to another replica
+        _heartbeat.release()
+        _heartbeat.stop()
+        # Let the in-flight S3 writes of the last batches complete, unless draining.
+        # Their msgs were just released
+        if _s3_writers:
+            _s3_writers.shutdown(wait=not _shutdown.is_set())
+    logger.info(f'{{"conn_stats":{json.dumps(conn_stats())}}}')
+    logger.info(f'{{"t_msgs":"{_t_msgs}", "status":True }}')
+
+
+def _del_flushed(m_to_del):
+    del_msgs(get_q_url(get_sqs_client()), m_to_del)
+
+
+# Created by run_consumers, when S3_SINK_FORMAT buffers events
+_sink = None
 
 
 def get_msgs(q_url, max_msgs, wait_time):
     try:
-        msg_batch = sqs_client.receive_message(
-            QueueUrl=q_url,
-            MaxNumberOfMessages=max_msgs,
-            WaitTimeSeconds=wait_time,
-            MessageAttributeNames=["All"]
-        )
+        with metrics.timed("receive"):
+            msg_batch = get_sqs_client().receive_message(
+                QueueUrl=q_url,
+                MaxNumberOfMessages=max_msgs,
+                WaitTimeSeconds=wait_time,
+                MessageAttributeNames=["All"]
+            )
         logger.debug(f'{{"msg_batch":"{json.dumps(msg_batch)}"}}')
     except Exception as e:
         logger.exception(f"ERROR:{str(e)}")
@@ -110,40 +1149,111 @@ def get_msgs(q_url, max_msgs, wait_time):
         return msg_batch
 
 
+def _decode(m):
+    """ Returns the event_type, event & the reason the msg can never be processed, if it cannot """
+    try:
+        e_type = m["MessageAttributes"]["event_type"]["StringValue"]
+    except KeyError:
+        return None, None, "missing_event_type"
+    try:
+        d = json.loads(m["Body"])
+    except ValueError:
+        return e_type, None, "bad_json"
+    if not isinstance(d, dict):
+        return e_type, None, "bad_json"
+    if "store_id" not in d:
+        return e_type, d, "missing_store_id"
+    return e_type, d, None
+
+
 def process_msgs(msg_batch):
+    m_process_stats = {
+        "msg_batch": len(msg_batch.get("Messages")),
+        "s_msgs": 0,
+        "f_msgs": 0,
+        "p_msgs": 0
+    }
     try:
-        m_process_stats = {
-            "msg_batch": len(msg_batch.get("Messages")),
-            "s_msgs": 0,
-            "f_msgs": 0
-        }
         m_del_entries = []
-        err = f'{{"missing_store_id":{True}}}'
-        for m in msg_batch["Messages"]:
-            m_del_entries.append(
-                {"Id": m["MessageId"], "ReceiptHandle": m['ReceiptHandle']})
-            d = json.loads(m["Body"])
-            e_type = m["MessageAttributes"]["event_type"]["StringValue"]
-            put_object(e_type, d)
-            m_process_stats["s_msgs"] += 1
+        m_f_entries = []
+        m_p_entries = []
+        _puts = {}
+        for i, m in enumerate(msg_batch["Messages"]):
+            _entry = {"Id": m["MessageId"], "ReceiptHandle": m['ReceiptHandle']}
+            with metrics.timed("decode"):
+                e_type, d, err = _decode(m)
+            if _shutdown.drain_expired():
+                # Left behind by run_consumers, write nothing more & hand the rest to another replica
+                _left = [{"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]}
+                         for m in msg_batch["Messages"][i:]]
+                _hb_release(_left)
+                m_process_stats["f_msgs"] += len(_left)
+                break
+            if err:
+                logger.warning(
+                    f'{{"poison_msg":"{m["MessageId"]}", "err":"{err}"}}')
+                m_p_entries.append(_entry)
+                m_process_stats["p_msgs"] += 1
+                continue
+            if _sink:
+                # Deleted by the sink, once the partition holding them is written
+                _sink.add(e_type, d, _entry)
+                m_process_stats["s_msgs"] += 1
+            else:
+                # Fan out the S3 writes of this batch across the writer pool
+                _f = get_s3_writers().submit(put_object, e_type, d, m["MessageId"])
+                _puts[_f] = _entry
+        # Poison msgs are redelivered right away, until the queue moves them to the DLQ
+        _hb_release(m_p_entries)
+        # Only msgs persisted to S3 are deleted, the rest will be redelivered
+        for _f in as_completed(_puts):
+            if _f.result():
+                m_del_entries.append(_puts[_f])
+                m_process_stats["s_msgs"] += 1
+            else:
+                m_f_entries.append(_puts[_f])
+                m_process_stats["f_msgs"] += 1
+        # Retry the failed writes sooner, on any replica
+        _hb_release(m_f_entries)
         # Trigger Message Batch Delete
-        q_url = get_q_url(sqs_client)
-        del_msgs(q_url, m_del_entries)
+        if m_del_entries:
+            q_url = get_q_url(get_sqs_client())
+            del_msgs(q_url, m_del_entries)
         logger.debug(f'{{"m_process_stats":"{json.dumps(m_process_stats)}"}}')
-
     except Exception as e:
         logger.exception(f"ERROR:{str(e)}")
-        # m_process_stats["f_msgs"] += 1
-    else:
-        return m_process_stats
+        # Whatever was not accounted for is redelivered after the visibility timeout
+        m_process_stats["f_msgs"] = (m_process_stats["msg_batch"] -
+                                     m_process_stats["s_msgs"] -
+                                     m_process_stats["p_msgs"])
+    return m_process_stats
 
 
 def del_msgs(q_url, m_to_del):
-    try:
-        sqs_client.delete_message_batch(QueueUrl=q_url, Entries=m_to_del)
-    except Exception as e:
-        logger.exception(f"ERROR:{str(e)}")
-        raise e
+    sqs_client = get_sqs_client()
+    # DeleteMessageBatch takes upto 10 entries per call
+    for i in range(0, len(m_to_del), 10):
+        _entries = m_to_del[i:i + 10]
+        # Stop extending them before the call, a drain must not release msgs being deleted.
+        # If the delete fails, they are redelivered after the visibility timeout
+        _hb_untrack(_entries)
+        try:
+            try:
+                with metrics.timed("delete"):
+                    _r = sqs_client.delete_message_batch(
+                        QueueUrl=q_url, Entries=_entries)
+            except sqs_client.exceptions.QueueDoesNotExist:
+                invalidate_q_url()
+                q_url = get_q_url(sqs_client)
+                _r = sqs_client.delete_message_batch(
+                    QueueUrl=q_url, Entries=_entries)
+            if _r.get("Failed"):
+                metrics.inc("consumer_delete_failures_total",
+                            len(_r["Failed"]))
+        except Exception as e:
+            metrics.inc("consumer_delete_failures_total", len(_entries))
+            logger.exception(f"ERROR:{str(e)}")
+            raise e
 
 
 def lambda_handler(event, context):
@@ -165,4 +1275,34 @@ def lambda_handler(event, context):
     }
 
 
-sqs_polling()
+def startup_profile(import_secs):
+    """ Create the clients up front & report where the cold start went """
+    _start = time.perf_counter()
+    get_sqs_client()
+    get_s3_client()
+    _prof = {
+        "proc_age_secs": round(_proc_age_secs(), 4),
+        "import_secs": round(import_secs, 4),
+        "client_init_secs": _client_init_secs,
+        "clients_secs": round(time.perf_counter() - _start, 4)
+    }
+    _prof["within_budget"] = _prof["proc_age_secs"] <= GlobalArgs.STARTUP_BUDGET_SECS
+    logger.info(f'{{"startup_profile":{json.dumps(_prof)}}}')
+    if not _prof["within_budget"]:
+        logger.warning(
+            f'{{"startup_over_budget_secs":{GlobalArgs.STARTUP_BUDGET_SECS}}}')
+    return _prof
+
+
+def main():
+    if GlobalArgs.STARTUP_PROFILE:
+        startup_profile(_IMPORT_SECS)
+    run_consumers()
+
+
+# Secs spent importing this module & its dependencies
+_IMPORT_SECS = time.perf_counter() - _IMPORT_START
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,9 @@
+import os
+
 from aws_cdk import aws_eks as _eks
 from aws_cdk import aws_sqs as _sqs
 from aws_cdk import aws_iam as _iam
+from aws_cdk import aws_ecr_assets as _ecr_assets
 from aws_cdk import core as cdk
 
 from stacks.miztiik_global_args import GlobalArgs
@@ -22,13 +25,25 @@ class EksSqsProducerStack(cdk.Stack):
 
         # Add your stack resources below):
 
+        # Poison msgs, released by the consumer, land here after max_receive_count receives
+        self.reliable_q_dlq = _sqs.Queue(
+            self,
+            "reliableQueueDlq01",
+            queue_name=f"reliable_message_q_dlq",
+            retention_period=cdk.Duration.days(14)
+        )
+
         self.reliable_q = _sqs.Queue(
             self,
             "reliableQueue01",
             delivery_delay=cdk.Duration.seconds(2),
             queue_name=f"reliable_message_q",
             retention_period=cdk.Duration.days(2),
-            visibility_timeout=cdk.Duration.seconds(30)
+            visibility_timeout=cdk.Duration.seconds(30),
+            dead_letter_queue=_sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=self.reliable_q_dlq
+            )
         )
 
         ########################################
@@ -127,6 +142,20 @@ class EksSqsProducerStack(cdk.Stack):
         # Make sure the namespace is available before service accounts
         events_producer_svc_accnt.node.add_dependency(app_grp_01_ns)
 
+        ######################################
+        #######                        #######
+        #######   Prebuilt App Image   #######
+        #######                        #######
+        ######################################
+
+        # Built from lambda_src & pushed to the cdk assets ECR repo. The tag is
+        # the hash of the source, so every code change rolls out a new image
+        producer_img = _ecr_assets.DockerImageAsset(
+            self,
+            "salesEventsProducerImage",
+            directory=os.path.join(os.path.dirname(__file__), "lambda_src")
+        )
+
         #######################################
         #######                         #######
         #######    APP 01 DEPLOYMENT    #######
@@ -150,14 +179,8 @@ class EksSqsProducerStack(cdk.Stack):
                         "containers": [
                             {
                                 "name": f"{app_grp_01_name}",
-                                "image": "python:3.8.10-alpine",
-                                "command": [
-                                    "sh",
-                                    "-c"
-                                ],
-                                "args": [
-                                    "wget https://raw.githubusercontent.com/miztiik/scale-eks-with-keda/master/stacks/back_end/eks_sqs_producer_stack/lambda_src/stream_data_producer.py;pip3 install --user boto3;python3 stream_data_producer.py;"
-                                ],
+                                # Code & dependencies are baked in, no wget/pip at pod start
+                                "image": f"{producer_img.image_uri}",
                                 "env": [
                                     {
                                         "name": "STORE_EVENTS_BKT",
@@ -171,6 +194,10 @@ class EksSqsProducerStack(cdk.Stack):
                                         "name": "RELIABLE_QUEUE_NAME",
                                         "value": f"{self.reliable_q.queue_name}"
                                     },
+                                    {
+                                        "name": "RELIABLE_QUEUE_URL",
+                                        "value": f"{self.reliable_q.queue_url}"
+                                    },
                                     {
                                         "name": "AWS_REGION",
                                         "value": f"{cdk.Aws.REGION}"
@@ -182,6 +209,30 @@ class EksSqsProducerStack(cdk.Stack):
                                     {
                                         "name": "WAIT_SECS_BETWEEN_MSGS",
                                         "value": "1"
+                                    },
+                                    {
+                                        "name": "AWS_RETRY_MODE",
+                                        "value": "adaptive"
+                                    },
+                                    {
+                                        "name": "AWS_MAX_ATTEMPTS",
+                                        "value": "5"
+                                    },
+                                    {
+                                        "name": "AWS_CONNECT_TIMEOUT",
+                                        "value": "2"
+                                    },
+                                    {
+                                        "name": "AWS_READ_TIMEOUT",
+                                        "value": "10"
+                                    },
+                                    {
+                                        "name": "AWS_TCP_KEEPALIVE",
+                                        "value": "true"
+                                    },
+                                    {
+                                        "name": "MSGS_PER_SEND_BATCH",
+                                        "value": "10"
                                     }
                                 ]
                             }
@@ -228,3 +279,10 @@ class EksSqsProducerStack(cdk.Stack):
             value=f"{self.reliable_q.queue_url}",
             description="Reliable Message Queue Url"
         )
+
+        output_3 = cdk.CfnOutput(
+            self,
+            "ReliableMessageDlqUrl",
+            value=f"{self.reliable_q_dlq.queue_url}",
+            description="Dead letter queue of the poison msgs"
+        )
@@ -1,11 +1,15 @@
+import glob
+import gzip
+import heapq
+import io
 import json
 import logging
+import math
+import multiprocessing
 import datetime
 import time
 import os
 import random
-import uuid
-import boto3
 
 
 class GlobalArgs:
@@ -13,12 +17,43 @@ class GlobalArgs:
     VERSION = "2021-05-14"
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
     RELIABLE_QUEUE_NAME = os.getenv("RELIABLE_QUEUE_NAME")
+    RELIABLE_QUEUE_URL = os.getenv("RELIABLE_QUEUE_URL")
     AWS_REGION = os.getenv("AWS_REGION")
     S3_BKT_NAME = os.getenv("STORE_EVENTS_BKT")
     S3_PREFIX = "sales_events"
     EVNT_WEIGHTS = {"success": 80, "fail": 20}
     WAIT_SECS_BETWEEN_MSGS = int(os.getenv("WAIT_SECS_BETWEEN_MSGS", 2))
     TOT_MSGS_TO_PRODUCE = int(os.getenv("TOT_MSGS_TO_PRODUCE", 10000))
+    # SQS allows 10 entries & 256 KB of payload per SendMessageBatch call
+    MSGS_PER_SEND_BATCH = min(int(os.getenv("MSGS_PER_SEND_BATCH", 1)), 10)
+    MAX_SEND_BATCH_BYTES = 262144
+    SEND_BATCH_RETRIES = int(os.getenv("SEND_BATCH_RETRIES", 3))
+    # botocore client tuning, shared by the SQS & S3 clients
+    AWS_RETRY_MODE = os.getenv("AWS_RETRY_MODE", "adaptive")
+    AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", 5))
+    AWS_CONNECT_TIMEOUT = float(os.getenv("AWS_CONNECT_TIMEOUT", 2))
+    AWS_READ_TIMEOUT = float(os.getenv("AWS_READ_TIMEOUT", 10))
+    AWS_TCP_KEEPALIVE = os.getenv("AWS_TCP_KEEPALIVE", "true").lower() == "true"
+    SQS_MAX_POOL_CONNECTIONS = int(os.getenv("SQS_MAX_POOL_CONNECTIONS", 10))
+    # Rate targeted load, replaces WAIT_SECS_BETWEEN_MSGS when set
+    LOAD_PROFILE = os.getenv("LOAD_PROFILE", "").lower()
+    TARGET_EVNTS_PER_SEC = float(os.getenv("TARGET_EVNTS_PER_SEC", 10))
+    MIN_EVNTS_PER_SEC = float(os.getenv("MIN_EVNTS_PER_SEC", 1))
+    PROFILE_PERIOD_SECS = float(os.getenv("PROFILE_PERIOD_SECS", 300))
+    PROFILE_STEPS = int(os.getenv("PROFILE_STEPS", 5))
+    BURST_SECS = float(os.getenv("BURST_SECS", 30))
+    # Max secs of unsent tokens that can be caught up after a slow send
+    TOKEN_BUCKET_SECS = float(os.getenv("TOKEN_BUCKET_SECS", 1))
+    # Events are drawn GEN_BATCH_SIZE at a time, GEN_SEED makes them reproducible
+    GEN_BATCH_SIZE = int(os.getenv("GEN_BATCH_SIZE", 500))
+    GEN_SEED = int(os.getenv("GEN_SEED")) if os.getenv("GEN_SEED") else None
+    # Record the sent events to a .gz, or .zst, JSONL file. Replay one, instead of generating
+    RECORD_FILE = os.getenv("RECORD_FILE")
+    REPLAY_FILE = os.getenv("REPLAY_FILE")
+    # 2 replays twice as fast as recorded, 0 as fast as possible
+    REPLAY_SPEED = float(os.getenv("REPLAY_SPEED", 1))
+    # Producer processes, each sends its slice of the msgs & of the target rate
+    PRODUCER_PROCS = max(int(os.getenv("PRODUCER_PROCS", 1)), 1)
 
 
 def set_logging(lv=GlobalArgs.LOG_LEVEL):
@@ -31,23 +66,296 @@ def set_logging(lv=GlobalArgs.LOG_LEVEL):
 logger = set_logging()
 
 
-def _rand_coin_flip():
-    r = False
-    if os.getenv("TRIGGER_RANDOM_FAILURES", True):
-        if random.randint(1, 100) > 90:
-            r = True
-    return r
+np = None
+
+
+def _load_numpy():
+    """ numpy is optional, the generator falls back to the random module without it """
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return None
+        np = numpy
+    return np
+
+
+_CATEGORIES = ["Books", "Games", "Mobiles", "Groceries", "Shoes", "Stationaries", "Laptops",
+               "Tablets", "Notebooks", "Camera", "Printers", "Monitors", "Speakers", "Projectors", "Cables", "Furniture"]
+_EVNT_TYPES = ["sale_event", "inventory_event"]
+_VARIANTS = ["black", "red"]
+# Reused for every event, json.dumps builds a new encoder per call
+_evnt_encoder = json.JSONEncoder(check_circular=False)
+
+
+class EventGenerator:
+    """
+    Makes sales events in batches, every field of a batch is drawn in one go.
+    Uses numpy when it is installed, the random module otherwise. With a seed,
+    the events, request ids included, are the same on every run. The `ts` is
+    left to be stamped when the event is sent.
+    """
+
+    def __init__(self, seed=None):
+        self._seeded = seed is not None
+        self._np = _load_numpy()
+        if self._np:
+            self._rng = self._np.random.default_rng(seed)
+        else:
+            self._rng = random.Random(seed)
+        # ~10% of the events are bad, unless TRIGGER_RANDOM_FAILURES is set to ""
+        self.bad_msg_pct = 10 if os.getenv("TRIGGER_RANDOM_FAILURES", True) else 0
+
+    def _uuids(self, n):
+        if not self._seeded:
+            _b = os.urandom(16 * n)
+        elif self._np:
+            _b = self._rng.bytes(16 * n)
+        else:
+            _b = self._rng.getrandbits(128 * n).to_bytes(16 * n, "little")
+        # Same as str(uuid.UUID(bytes=.., version=4)), without an object per id
+        _h = _b.hex()
+        return [f"{_h[i:i + 8]}-{_h[i + 8:i + 12]}-4{_h[i + 13:i + 16]}-"
+                f"{'89ab'[int(_h[i + 16], 16) & 3]}{_h[i + 17:i + 20]}-{_h[i + 20:i + 32]}"
+                for i in range(0, 32 * n, 32)]
+
+    def _draw_np(self, n):
+        _r = self._rng
+        _flags = _r.integers(0, 2, (4, n)).astype(bool).tolist()
+        return {
+            "price": self._np.round(_r.random(n) * 100, 2).tolist(),
+            "evnt_type": _r.integers(0, len(_EVNT_TYPES), n).tolist(),
+            "store_id": _r.integers(1, 11, n).tolist(),
+            "cust_id": _r.integers(100, 1000, n).tolist(),
+            "category": _r.integers(0, len(_CATEGORIES), n).tolist(),
+            "sku": _r.integers(18981, 189282, n).tolist(),
+            "qty": _r.integers(1, 39, n).tolist(),
+            "discount": self._np.round(_r.random(n) * 20, 1).tolist(),
+            "gift_wrap": _flags[0],
+            "variant": _r.integers(0, len(_VARIANTS), n).tolist(),
+            "priority_shipping": _flags[1],
+            "is_return": _flags[2],
+            "bad_msg": (_r.integers(1, 101, n) > 100 - self.bad_msg_pct).tolist()
+        }
+
+    def _draw_py(self, n):
+        _r = self._rng
+
+        def _bits():
+            _b = _r.getrandbits(n) if n else 0
+            return [bool(_b >> i & 1) for i in range(n)]
+        return {
+            "price": [round(_r.random() * 100, 2) for _ in range(n)],
+            "evnt_type": _r.choices(range(len(_EVNT_TYPES)), k=n),
+            "store_id": _r.choices(range(1, 11), k=n),
+            "cust_id": _r.choices(range(100, 1000), k=n),
+            "category": _r.choices(range(len(_CATEGORIES)), k=n),
+            "sku": _r.choices(range(18981, 189282), k=n),
+            "qty": _r.choices(range(1, 39), k=n),
+            "discount": [round(_r.random() * 20, 1) for _ in range(n)],
+            "gift_wrap": _bits(),
+            "variant": _r.choices(range(len(_VARIANTS)), k=n),
+            "priority_shipping": _bits(),
+            "is_return": _bits(),
+            "bad_msg": [b > 100 - self.bad_msg_pct for b in _r.choices(range(1, 101), k=n)]
+        }
+
+    def batch(self, n):
+        """ Returns `n` (event_type, event) pairs """
+        _d = self._draw_np(n) if self._np else self._draw_py(n)
+        _ids = self._uuids(n)
+        evnts = []
+        for i in range(n):
+            evnt_body = {
+                "request_id": _ids[i],
+                "store_id": _d["store_id"][i],
+                "cust_id": _d["cust_id"][i],
+                "category": _CATEGORIES[_d["category"][i]],
+                "sku": _d["sku"][i],
+                "price": _d["price"][i],
+                "qty": _d["qty"][i],
+                "discount": _d["discount"][i],
+                "gift_wrap": _d["gift_wrap"][i],
+                "variant": _VARIANTS[_d["variant"][i]],
+                "priority_shipping": _d["priority_shipping"][i],
+                "ts": None,
+                "contact_me": "github.com/miztiik"
+            }
+            # Make order type return
+            if _d["is_return"][i]:
+                evnt_body["is_return"] = True
+            if _d["bad_msg"][i]:
+                evnt_body.pop("store_id", None)
+                evnt_body["bad_msg"] = True
+            evnts.append((_EVNT_TYPES[_d["evnt_type"][i]], evnt_body))
+        return evnts
+
+
+def _profile_rate(profile, t):
+    """ Target events/sec of the load profile, `t` secs into the run """
+    hi = GlobalArgs.TARGET_EVNTS_PER_SEC
+    lo = GlobalArgs.MIN_EVNTS_PER_SEC
+    period = GlobalArgs.PROFILE_PERIOD_SECS
+    if profile == "constant":
+        return hi
+    if profile == "ramp":
+        return lo + (hi - lo) * min(t / period, 1.0)
+    if profile == "step":
+        _steps = max(GlobalArgs.PROFILE_STEPS, 1)
+        _step = min(int(t // (period / _steps)) + 1, _steps)
+        return lo + (hi - lo) * _step / _steps
+    if profile == "sine":
+        return lo + (hi - lo) * (1 - math.cos(2 * math.pi * t / period)) / 2
+    if profile == "burst":
+        return hi if (t % period) < GlobalArgs.BURST_SECS else lo
+    raise ValueError(f"Unknown LOAD_PROFILE:{profile}")
+
+
+class TokenBucket:
+    """
+    Paces events to a time varying rate. Tokens accrue from the wall clock,
+    so time spent sending is credited back and the rate does not drift.
+    """
+
+    # Below this, spin instead of sleep. time.sleep overshoots by ~1ms
+    SPIN_SECS = 0.002
+
+    def __init__(self, profile, capacity_secs=GlobalArgs.TOKEN_BUCKET_SECS):
+        self.profile = profile
+        self.capacity_secs = capacity_secs
+        self.start = time.perf_counter()
+        self._last = self.start
+        self.tokens = 0.0
+
+    def rate(self, now=None):
+        now = time.perf_counter() if now is None else now
+        return _profile_rate(self.profile, now - self.start)
+
+    def _refill(self, now):
+        # Midpoint rate keeps the integral accurate over ramps & curves
+        _r = _profile_rate(
+            self.profile, (self._last + now) / 2 - self.start)
+        _cap = max(_r * self.capacity_secs, 1.0)
+        self.tokens = min(self.tokens + _r * (now - self._last), _cap)
+        self._last = now
+        return _r
+
+    def acquire(self, n=1):
+        while True:
+            now = time.perf_counter()
+            _r = self._refill(now)
+            if self.tokens >= n:
+                self.tokens -= n
+                return
+            # Rate of zero, check again once it picks up
+            _wait = (n - self.tokens) / _r if _r > 0 else 0.1
+            if _wait > self.SPIN_SECS:
+                time.sleep(_wait - self.SPIN_SECS)
+
+
+def _open_recording(path, mode):
+    """ Text mode gzip file, or zstd when the path ends with .zst """
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "zstd recordings need zstandard, pip3 install zstandard")
+        if mode == "w":
+            return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(
+                open(path, "wb")), encoding="UTF-8")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb")), encoding="UTF-8")
+    return gzip.open(path, f"{mode}t", encoding="UTF-8")
+
+
+class EventRecorder:
+    """ Appends every sent event, with its attributes & its offset from the start of the run, as a JSON line """
+
+    def __init__(self, path):
+        self.path = path
+        self.evnts = 0
+        self._f = _open_recording(path, "w")
+        self._start = time.perf_counter()
+
+    def stamp(self):
+        """ Offset of now from the start of the run """
+        return round(time.perf_counter() - self._start, 6)
+
+    def write(self, attrs, body, t=None):
+        """ `t` is when the event was generated, it is written only once it is sent """
+        self._f.write(json.dumps({
+            "t": self.stamp() if t is None else t,
+            "attrs": attrs,
+            "body": body
+        }) + "\n")
+        self.evnts += 1
+
+    def close(self):
+        self._f.close()
+        logger.info(
+            f'{{"recorded_evnts":{self.evnts}, "record_file":"{self.path}"}}')
+
+
+def _read_one(path):
+    with _open_recording(path, "r") as f:
+        for line in f:
+            _rec = json.loads(line)
+            yield _rec["t"], _rec["attrs"], _rec["body"]
+
+
+def recording_paths(path):
+    """
+    The files of a recording. A glob matches several, e.g. run.jsonl.*.gz. A
+    PRODUCER_PROCS run recorded to run.jsonl.gz wrote run.jsonl.<w_id>.gz files,
+    those are picked up when run.jsonl.gz itself does not exist.
+    """
+    if glob.has_magic(path):
+        _paths = sorted(glob.glob(path))
+    elif os.path.exists(path):
+        _paths = [path]
+    else:
+        _root, _ext = os.path.splitext(path)
+        _paths = sorted(glob.glob(f"{glob.escape(_root)}.[0-9]*{glob.escape(_ext)}"))
+    if not _paths:
+        raise FileNotFoundError(f"No recording at {path}")
+    return _paths
 
 
-def _gen_uuid():
-    return str(uuid.uuid4())
+def read_recording(path):
+    """ Yields the (offset secs, attrs, body) of every recorded event, merged by offset across the files """
+    return heapq.merge(*[_read_one(p) for p in recording_paths(path)],
+                       key=lambda r: r[0])
+
+
+def _record_sent(recorder, entries, entry_ts, failed):
+    """ Records the sent entries of a batch, failed msgs were never sent & are left out """
+    if not recorder:
+        return
+    _failed = {m["Id"] for m in failed}
+    for m, t in zip(entries, entry_ts):
+        if m["Id"] not in _failed:
+            recorder.write(m["MessageAttributes"], m["MessageBody"], t)
+
+
+# Resolved queue url, seeded from the env to skip the lookup at startup
+_q_url = GlobalArgs.RELIABLE_QUEUE_URL
 
 
 def get_q_url(sqs_client):
-    q = sqs_client.get_queue_url(
-        QueueName=GlobalArgs.RELIABLE_QUEUE_NAME).get("QueueUrl")
-    logger.debug(f'{{"q_url":"{q}"}}')
-    return q
+    global _q_url
+    if not _q_url:
+        _q_url = sqs_client.get_queue_url(
+            QueueName=GlobalArgs.RELIABLE_QUEUE_NAME).get("QueueUrl")
+        logger.debug(f'{{"q_url":"{_q_url}"}}')
+    return _q_url
+
+
+def invalidate_q_url():
+    global _q_url
+    logger.warning(f'{{"q_url_invalidated":"{_q_url}"}}')
+    _q_url = None
 
 
 def send_msg(sqs_client, q_url, msg_body, msg_attr=None):
@@ -56,11 +364,20 @@ def send_msg(sqs_client, q_url, msg_body, msg_attr=None):
     try:
         logger.debug(
             f'{{"msg_body":{msg_body}, "msg_attr": {json.dumps(msg_attr)}}}')
-        resp = sqs_client.send_message(
-            QueueUrl=q_url,
-            MessageBody=msg_body,
-            MessageAttributes=msg_attr
-        )
+        try:
+            resp = sqs_client.send_message(
+                QueueUrl=q_url,
+                MessageBody=msg_body,
+                MessageAttributes=msg_attr
+            )
+        except sqs_client.exceptions.QueueDoesNotExist:
+            # Stale url, resolve it again by name and retry once
+            invalidate_q_url()
+            resp = sqs_client.send_message(
+                QueueUrl=get_q_url(sqs_client),
+                MessageBody=msg_body,
+                MessageAttributes=msg_attr
+            )
     except Exception as e:
         logger.exception(f"ERROR:{str(e)}")
         raise e
@@ -68,12 +385,116 @@ def send_msg(sqs_client, q_url, msg_body, msg_attr=None):
         return resp
 
 
-sqs_client = boto3.client("sqs", region_name=GlobalArgs.AWS_REGION)
+def _msg_size(msg_body, msg_attr):
+    """ Payload size of a msg, as SQS counts it against the batch limit """
+    _sz = len(msg_body.encode("UTF-8"))
+    for k, v in msg_attr.items():
+        _sz += len(k.encode("UTF-8")) + len(v["DataType"].encode("UTF-8"))
+        _sz += len(v.get("StringValue", "").encode("UTF-8"))
+    return _sz
+
+
+def send_msg_batch(sqs_client, q_url, entries):
+    """ Send upto 10 msgs in one call, retrying only the failed entries """
+    api_calls = 0
+    pending = entries
+    # Sender faults of every attempt, a later retry succeeding does not send them
+    given_up = []
+    for attempt in range(GlobalArgs.SEND_BATCH_RETRIES + 1):
+        try:
+            try:
+                resp = sqs_client.send_message_batch(
+                    QueueUrl=q_url, Entries=pending)
+            except sqs_client.exceptions.QueueDoesNotExist:
+                invalidate_q_url()
+                q_url = get_q_url(sqs_client)
+                resp = sqs_client.send_message_batch(
+                    QueueUrl=q_url, Entries=pending)
+            api_calls += 1
+        except Exception as e:
+            logger.exception(f"ERROR:{str(e)}")
+            raise e
+        failed = {f["Id"]: f for f in resp.get("Failed", [])}
+        if not failed:
+            return api_calls, given_up
+        logger.warning(
+            f'{{"send_batch_failed":{json.dumps(list(failed.values()))}, "attempt":{attempt}}}')
+        # Sender faults(malformed entries) will never succeed, dont retry them
+        given_up += [m for m in pending if m["Id"]
+                     in failed and failed[m["Id"]].get("SenderFault")]
+        pending = [m for m in pending if m["Id"]
+                   in failed and not failed[m["Id"]].get("SenderFault")]
+        if not pending:
+            break
+        time.sleep(0.1 * 2 ** attempt)
+    return api_calls, given_up + pending
+
+
+# Clients are created on first use, not at import. Tests & benchmarks can set them
+sqs_client = None
+_s3 = None
+
+
+_botocore_session = None
+
+
+def _client_config(max_pool_connections=10):
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=max_pool_connections,
+        retries={
+            "mode": GlobalArgs.AWS_RETRY_MODE,
+            "total_max_attempts": GlobalArgs.AWS_MAX_ATTEMPTS
+        },
+        connect_timeout=GlobalArgs.AWS_CONNECT_TIMEOUT,
+        read_timeout=GlobalArgs.AWS_READ_TIMEOUT,
+        tcp_keepalive=GlobalArgs.AWS_TCP_KEEPALIVE
+    )
+
+
+def _new_client(svc, **kwargs):
+    """ Create a client off one shared botocore session, which loads only this service's model """
+    global _botocore_session
+    if _botocore_session is None:
+        import botocore.session
+        _botocore_session = botocore.session.get_session()
+    return _botocore_session.create_client(
+        svc, region_name=GlobalArgs.AWS_REGION, **kwargs)
+
+
+def get_sqs_client():
+    global sqs_client
+    if sqs_client is None:
+        sqs_client = _new_client(
+            "sqs", config=_client_config(GlobalArgs.SQS_MAX_POOL_CONNECTIONS))
+    return sqs_client
+
+
+def get_s3_client():
+    global _s3
+    if _s3 is None:
+        _s3 = _new_client("s3", config=_client_config())
+    return _s3
+
+
+def conn_stats():
+    """ New connections vs requests of the SQS client, from the urllib3 pools botocore keeps """
+    try:
+        _pools = sqs_client._endpoint.http_session._manager.pools
+        _conns = sum(_pools[k].num_connections for k in _pools.keys())
+        _reqs = sum(_pools[k].num_requests for k in _pools.keys())
+    except AttributeError:
+        return {}
+    return {
+        "connections": _conns,
+        "requests": _reqs,
+        "reuse_ratio": round(1 - _conns / _reqs, 4) if _reqs else None
+    }
 
 
 def put_object(_pre, data):
     try:
-        _r = _s3.put_object(
+        _r = get_s3_client().put_object(
             Bucket=GlobalArgs.S3_BKT_NAME,
             Key=f"{GlobalArgs.S3_PREFIX}/event_type={_pre}/dt={datetime.datetime.now().strftime('%Y_%m_%d')}/{datetime.datetime.now().strftime('%s%f')}.json",
             Body=json.dumps(data).encode("UTF-8"),
@@ -83,64 +504,79 @@ def put_object(_pre, data):
         logger.exception(f"ERROR:{str(e)}")
 
 
-_s3 = boto3.client("s3")
-
 end_time = datetime.datetime.now() + datetime.timedelta(seconds=10)
 
 
 def lambda_handler(event, context):
     resp = {"status": False}
     logger.debug(f"Event: {json.dumps(event)}")
-    _categories = ["Books", "Games", "Mobiles", "Groceries", "Shoes", "Stationaries", "Laptops",
-                   "Tablets", "Notebooks", "Camera", "Printers", "Monitors", "Speakers", "Projectors", "Cables", "Furniture"]
-    _evnt_types = ["sale_event", "inventory_event"]
-    _variants = ["black", "red"]
+    _recorder = None
 
     try:
-        q_url = get_q_url(sqs_client)
+        sqs_client = get_sqs_client()
         t_msgs = 0
         p_cnt = 0
         s_evnts = 0
         inventory_evnts = 0
         t_sales = 0
+        api_calls = 0
+        f_msgs = 0
+        _batch, _batch_sz, _batch_ts = [], 0, []
+        _gen = EventGenerator(GlobalArgs.GEN_SEED)
+        _evnts = []
+        _replay, _next_rec = None, None
+        if GlobalArgs.REPLAY_FILE:
+            # Read one event ahead, to know which one is the last
+            _replay = read_recording(GlobalArgs.REPLAY_FILE)
+            _next_rec = next(_replay, None)
+            logger.info(
+                f'{{"replay_file":"{GlobalArgs.REPLAY_FILE}", "replay_speed":{GlobalArgs.REPLAY_SPEED}}}')
+        if GlobalArgs.RECORD_FILE:
+            _recorder = EventRecorder(GlobalArgs.RECORD_FILE)
+        _pacer = None
+        if GlobalArgs.LOAD_PROFILE and not _replay:
+            _pacer = TokenBucket(GlobalArgs.LOAD_PROFILE)
+            logger.info(
+                f'{{"load_profile":"{GlobalArgs.LOAD_PROFILE}", "target_evnts_per_sec":{GlobalArgs.TARGET_EVNTS_PER_SEC}}}')
+        _start = time.perf_counter()
         while True:
-            _s = round(random.random() * 100, 2)
-            _evnt_type = random.choice(_evnt_types)
-            _u = _gen_uuid()
-            p_s = bool(random.getrandbits(1))
-            evnt_body = {
-                "request_id": _u,
-                "store_id": random.randint(1, 10),
-                "cust_id": random.randint(100, 999),
-                "category": random.choice(_categories),
-                "sku": random.randint(18981, 189281),
-                "price": _s,
-                "qty": random.randint(1, 38),
-                "discount": round(random.random() * 20, 1),
-                "gift_wrap": bool(random.getrandbits(1)),
-                "variant": random.choice(_variants),
-                "priority_shipping": p_s,
-                "ts": datetime.datetime.now().isoformat(),
-                "contact_me": "github.com/miztiik"
-            }
-            _attr = {
-                "event_type": {
-                    "DataType": "String",
-                    "StringValue": _evnt_type
-                },
-                "priority_shipping": {
-                    "DataType": "String",
-                    "StringValue": f"{p_s}"
+            if _replay:
+                if _next_rec is None:
+                    break
+                (_t, _attr, _b), _next_rec = _next_rec, next(_replay, None)
+                # Sent at the recorded offset, scaled by REPLAY_SPEED
+                if GlobalArgs.REPLAY_SPEED > 0:
+                    _wait = _start + _t / GlobalArgs.REPLAY_SPEED - time.perf_counter()
+                    if _wait > 0:
+                        time.sleep(_wait)
+                evnt_body = json.loads(_b)
+                _evnt_type = _attr["event_type"]["StringValue"]
+                _s = evnt_body.get("price", 0)
+                _last_msg = _next_rec is None
+            else:
+                if _pacer:
+                    _pacer.acquire()
+                if not _evnts:
+                    # Popped from the end, reverse to send in the drawn order
+                    _evnts = _gen.batch(max(min(GlobalArgs.GEN_BATCH_SIZE,
+                                                GlobalArgs.TOT_MSGS_TO_PRODUCE - t_msgs), 1))[::-1]
+                _evnt_type, evnt_body = _evnts.pop()
+                _s = evnt_body["price"]
+                evnt_body["ts"] = datetime.datetime.now().isoformat()
+                _attr = {
+                    "event_type": {
+                        "DataType": "String",
+                        "StringValue": _evnt_type
+                    },
+                    "priority_shipping": {
+                        "DataType": "String",
+                        "StringValue": f"{evnt_body['priority_shipping']}"
+                    }
                 }
-            }
+                _b = _evnt_encoder.encode(evnt_body)
+                _last_msg = t_msgs + 1 >= GlobalArgs.TOT_MSGS_TO_PRODUCE
 
-            # Make order type return
-            if bool(random.getrandbits(1)):
-                evnt_body["is_return"] = True
-
-            if _rand_coin_flip():
-                evnt_body.pop("store_id", None)
-                evnt_body["bad_msg"] = True
+            if evnt_body.get("bad_msg"):
                 p_cnt += 1
 
             if _evnt_type == "sale_event":
@@ -148,18 +584,47 @@ def lambda_handler(event, context):
             elif _evnt_type == "inventory_event":
                 inventory_evnts += 1
 
-            send_msg(
-                sqs_client,
-                q_url,
-                json.dumps(evnt_body),
-                _attr
-            )
             t_msgs += 1
             t_sales += _s
-            time.sleep(GlobalArgs.WAIT_SECS_BETWEEN_MSGS)
+            _t_gen = _recorder.stamp() if _recorder else None
+            if GlobalArgs.MSGS_PER_SEND_BATCH > 1:
+                _sz = _msg_size(_b, _attr)
+                # Flush before the new msg would overflow the batch payload
+                if _batch and _batch_sz + _sz > GlobalArgs.MAX_SEND_BATCH_BYTES:
+                    _calls, _failed = send_msg_batch(
+                        sqs_client, get_q_url(sqs_client), _batch)
+                    api_calls += _calls
+                    f_msgs += len(_failed)
+                    _record_sent(_recorder, _batch, _batch_ts, _failed)
+                    _batch, _batch_sz, _batch_ts = [], 0, []
+                _batch.append({"Id": f"{len(_batch)}",
+                               "MessageBody": _b,
+                               "MessageAttributes": _attr})
+                _batch_sz += _sz
+                _batch_ts.append(_t_gen)
+                if len(_batch) < GlobalArgs.MSGS_PER_SEND_BATCH and not _last_msg:
+                    continue
+                _calls, _failed = send_msg_batch(
+                    sqs_client, get_q_url(sqs_client), _batch)
+                api_calls += _calls
+                f_msgs += len(_failed)
+                _record_sent(_recorder, _batch, _batch_ts, _failed)
+                _batch, _batch_sz, _batch_ts = [], 0, []
+            else:
+                send_msg(
+                    sqs_client,
+                    get_q_url(sqs_client),
+                    _b,
+                    _attr
+                )
+                api_calls += 1
+                if _recorder:
+                    _recorder.write(_attr, _b, _t_gen)
+            if not _pacer and not _replay:
+                time.sleep(GlobalArgs.WAIT_SECS_BETWEEN_MSGS)
             # if context.get_remaining_time_in_millis() < 1000:
             # if datetime.datetime.now() >= end_time:
-            if t_msgs >= GlobalArgs.TOT_MSGS_TO_PRODUCE:
+            if _last_msg:
                 break
 
         resp["tot_msgs"] = t_msgs
@@ -167,12 +632,20 @@ def lambda_handler(event, context):
         resp["sale_evnts"] = s_evnts
         resp["inventory_evnts"] = inventory_evnts
         resp["tot_sales"] = t_sales
+        resp["failed_msgs"] = f_msgs
+        resp["api_calls"] = api_calls
+        resp["api_calls_saved"] = t_msgs - api_calls
+        resp["evnts_per_sec"] = round(
+            t_msgs / (time.perf_counter() - _start), 2)
+        resp["conn_stats"] = conn_stats()
         resp["status"] = True
         logger.info(f'{{"resp":{json.dumps(resp)}}}')
 
     except Exception as e:
         logger.error(f"ERROR:{str(e)}")
         resp["err_msg"] = str(e)
+    if _recorder:
+        _recorder.close()
 
     return {
         "statusCode": 200,
@@ -182,4 +655,52 @@ def lambda_handler(event, context):
     }
 
 
-lambda_handler({}, {})
+def _produce_slice(w_id, tot_msgs, procs):
+    """ One PRODUCER_PROCS worker, with its own clients, msgs & share of the rate """
+    GlobalArgs.TOT_MSGS_TO_PRODUCE = tot_msgs
+    GlobalArgs.TARGET_EVNTS_PER_SEC /= procs
+    GlobalArgs.MIN_EVNTS_PER_SEC /= procs
+    # Seeded workers must not all send the same stream
+    if GlobalArgs.GEN_SEED is not None:
+        GlobalArgs.GEN_SEED += w_id
+    # One recording per worker, e.g. run.jsonl.gz -> run.jsonl.0.gz, read_recording merges them
+    if GlobalArgs.RECORD_FILE:
+        _root, _ext = os.path.splitext(GlobalArgs.RECORD_FILE)
+        GlobalArgs.RECORD_FILE = f"{_root}.{w_id}{_ext}"
+    return json.loads(lambda_handler({}, {})["body"])["message"]
+
+
+def run_producers(procs=GlobalArgs.PRODUCER_PROCS):
+    """ Spread TOT_MSGS_TO_PRODUCE & the target rate across `procs` processes, returns the summed summary """
+    procs = min(procs, max(GlobalArgs.TOT_MSGS_TO_PRODUCE, 1))
+    _tot = GlobalArgs.TOT_MSGS_TO_PRODUCE
+    _slices = [(i, _tot // procs + (1 if i < _tot % procs else 0), procs)
+               for i in range(procs)]
+    _start = time.perf_counter()
+    # spawn, a forked child could inherit a lock held by another thread
+    with multiprocessing.get_context("spawn").Pool(procs) as pool:
+        w_resps = pool.starmap(_produce_slice, _slices)
+    resp = {"status": all(r["status"] for r in w_resps), "procs": procs}
+    for k in ["tot_msgs", "bad_msgs", "sale_evnts", "inventory_evnts", "tot_sales",
+              "failed_msgs", "api_calls", "api_calls_saved"]:
+        resp[k] = sum(r.get(k, 0) for r in w_resps)
+    resp["tot_sales"] = round(resp["tot_sales"], 2)
+    resp["evnts_per_sec"] = round(
+        resp["tot_msgs"] / (time.perf_counter() - _start), 2)
+    _errs = [r["err_msg"] for r in w_resps if "err_msg" in r]
+    if _errs:
+        resp["err_msg"] = _errs
+    logger.info(f'{{"resp":{json.dumps(resp)}}}')
+    return resp
+
+
+def main():
+    # A recording is replayed in order, by one process, its per worker files merged by offset
+    if GlobalArgs.PRODUCER_PROCS > 1 and not GlobalArgs.REPLAY_FILE:
+        run_producers()
+    else:
+        lambda_handler({}, {})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+The lambda_src scripts are imported fresh for every test, their GlobalArgs read
+from the env at import, & run against the SQS/S3 stand-ins of the benchmarks.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "benchmarks"))
+
+from fake_aws import FakeS3, FakeSqs  # noqa: E402
+from pipeline_bench import CONSUMER_SRC, PRODUCER_SRC, load_script  # noqa: E402
+from external_scaler_bench import SCALER_SRC  # noqa: E402
+
+_COMMON_ENV = {
+    "LOG_LEVEL": "WARNING",
+    "AWS_REGION": "us-east-1",
+    "STORE_EVENTS_BKT": "test-bkt"
+}
+
+
+@pytest.fixture
+def sqs():
+    return FakeSqs()
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def load_producer(sqs, s3):
+    """ Returns a loader of the producer, with `env` on top of the defaults """
+    def _load(**env):
+        mod = load_script(PRODUCER_SRC, {
+            **_COMMON_ENV, "RELIABLE_QUEUE_URL": sqs.q_url, **env})
+        mod.sqs_client, mod._s3 = sqs, s3
+        return mod
+    return _load
+
+
+@pytest.fixture
+def load_consumer(sqs, s3):
+    """ Returns a loader of the consumer, with `env` on top of the defaults """
+    def _load(**env):
+        mod = load_script(CONSUMER_SRC, {
+            **_COMMON_ENV, "RELIABLE_QUEUE_URL": sqs.q_url, "METRICS_PORT": 0, **env})
+        mod.sqs_client, mod._s3 = sqs, s3
+        return mod
+    return _load
+
+
+@pytest.fixture
+def load_scaler(sqs):
+    """ Returns a loader of the external scaler, with `env` on top of the defaults """
+    def _load(**env):
+        mod = load_script(SCALER_SRC, {**_COMMON_ENV, **env})
+        mod.sqs_client = sqs
+        return mod
+    return _load
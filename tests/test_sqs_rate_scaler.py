@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+
+@pytest.fixture
+def scaler(load_scaler):
+    return load_scaler()
+
+
+@pytest.mark.parametrize("depth,in_flight,age,arrival,replicas", [
+    # Nothing queued, nothing arriving
+    (0, 0, 0, 0, 0),
+    # Only in-flight msgs keep one pod
+    (0, 5, 0, 0, 1),
+    # Serve the arrivals
+    (0, 0, 0, 120, 3),
+    # Drain 3000 msgs in the 120s left before the target age, 50/s per pod
+    (3000, 0, 0, 0, 1),
+    (3000, 0, 0, 100, 3),
+    # In the 30s left
+    (3000, 0, 90, 0, 2),
+    # Close to the target age, drain within minDrainSecs
+    (3000, 0, 115, 0, 6),
+])
+def test_desired_replicas(scaler, depth, in_flight, age, arrival, replicas):
+    assert scaler.desired_replicas(depth, in_flight, age, arrival, pod_rate=50,
+                                   target_age_secs=120, min_drain_secs=10) == replicas
+
+
+def test_desired_replicas_grows_as_the_backlog_ages(scaler):
+    _replicas = [scaler.desired_replicas(5000, 0, age, 0, 50, 60, 10) for age in (0, 30, 50, 60)]
+    assert _replicas == sorted(_replicas)
+    assert _replicas[-1] == 10
+
+
+def test_scaler_params_need_a_queue(scaler):
+    with pytest.raises(ValueError):
+        scaler.scaler_params({"targetAgeSecs": "30"})
+    assert scaler.scaler_params({"queueURL": "q", "podRate": "20"})["pod_rate"] == 20
+
+
+def test_rate_scaler_takes_the_arrival_rate_from_the_backlog_growth(scaler, sqs):
+    _now = [0.0]
+    rs = scaler.RateScaler(clock=lambda: _now[0])
+    _meta = {"queueURL": sqs.q_url, "podRate": "10", "targetAgeSecs": "1000"}
+    for i in range(100):
+        sqs.send_message(QueueUrl=sqs.q_url, MessageBody=json.dumps({"n": i}))
+    assert rs.evaluate(("ns", "so"), _meta)[0] == 1
+    for i in range(200):
+        sqs.send_message(QueueUrl=sqs.q_url, MessageBody=json.dumps({"n": i}))
+    _now[0] = 10.0
+    # 20 msgs/sec arriving at 10/sec per pod, plus the backlog to drain
+    assert rs.evaluate(("ns", "so"), _meta)[0] == 3
+    assert rs.is_active(_meta)
+
+
+def test_get_sqs_client_is_per_region(load_scaler):
+    pytest.importorskip("boto3")
+    scaler = load_scaler()
+    scaler.sqs_client = None
+    _east, _west = scaler.get_sqs_client(), scaler.get_sqs_client("eu-west-1")
+    assert (_east.meta.region_name, _west.meta.region_name) == ("us-east-1", "eu-west-1")
+    assert scaler.get_sqs_client("eu-west-1") is _west
@@ -0,0 +1,565 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import io
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+
+def test_get_q_url_is_seeded_from_the_env(load_consumer, sqs):
+    consumer = load_consumer()
+    assert consumer.get_q_url(sqs) == sqs.q_url
+    assert "get_queue_url" not in sqs.api_calls
+
+
+def test_get_q_url_is_looked_up_once_until_invalidated(load_consumer, sqs):
+    consumer = load_consumer(RELIABLE_QUEUE_URL="", RELIABLE_QUEUE_NAME="reliable_message_q")
+    for _ in range(3):
+        assert consumer.get_q_url(sqs) == sqs.q_url
+    assert sqs.api_calls["get_queue_url"] == 1
+    # A QueueDoesNotExist invalidates it, the next call looks it up by name again
+    consumer.invalidate_q_url()
+    assert consumer.get_q_url(sqs) == sqs.q_url
+    assert sqs.api_calls["get_queue_url"] == 2
+
+
+def _send(sqs, n, body=None):
+    for i in range(n):
+        sqs.send_message(QueueUrl=sqs.q_url,
+                         MessageBody=body if body is not None else json.dumps({"store_id": i}),
+                         MessageAttributes={"event_type": {"DataType": "String",
+                                                           "StringValue": "sale_event"}})
+
+
+@pytest.fixture
+def consumer(load_consumer):
+    return load_consumer(MAX_MSGS_PER_BATCH=10, MSG_PROCESS_DELAY=3, LONG_POLL_SECS=20,
+                         MSG_POLL_BACKOFF=2, MAX_POLL_BACKOFF=8)
+
+
+def test_poll_controller_follows_the_batch_size(consumer):
+    ctrl = consumer.PollController(0)
+    assert ctrl.on_batch(10, 10) == 0
+    assert (ctrl.state, ctrl.wait_time_secs) == ("busy", 1)
+    assert ctrl.on_batch(4, 10) == 3
+    assert (ctrl.state, ctrl.wait_time_secs) == ("draining", 1)
+    assert ctrl.on_batch(0, 10) == 0
+    assert (ctrl.state, ctrl.wait_time_secs) == ("idle", 20)
+    assert ctrl.empty_polls == 1
+
+
+def test_poll_controller_backs_off_exponentially_upto_the_max(consumer):
+    ctrl = consumer.PollController(0)
+    for _backoff in (2, 4, 8, 8):
+        _delay = ctrl.on_throttle()
+        assert ctrl.state == "throttled"
+        assert ctrl.throttle_backoff_secs == _backoff
+        # Upto half the back-off of jitter on top
+        assert _backoff <= _delay <= 1.5 * _backoff
+    assert ctrl.throttled_polls == 4
+    # A successful poll resets the back-off
+    ctrl.on_batch(1, 10)
+    assert ctrl.throttle_backoff_secs == 0
+    assert ctrl.on_throttle() <= 3
+
+
+def test_poll_controller_backs_off_on_errors(consumer):
+    ctrl = consumer.PollController(0)
+    ctrl.on_throttle()
+    assert ctrl.on_error() >= 4
+    assert (ctrl.state, ctrl.error_polls, ctrl.throttled_polls) == ("erroring", 1, 1)
+    assert ctrl.get_state()["error_polls"] == 1
+
+
+def _fail_receive(sqs, err):
+    def _receive(**kwargs):
+        raise err
+    sqs.receive_message = _receive
+
+
+@pytest.mark.parametrize("err,state", [
+    (ClientError({"Error": {"Code": "RequestThrottled"}}, "ReceiveMessage"), "throttled"),
+    (ClientError({"Error": {"Code": "InternalError"}}, "ReceiveMessage"), "erroring"),
+    (EndpointConnectionError(endpoint_url="https://sqs.local"), "erroring"),
+])
+def test_poll_once_backs_off_on_receive_errors(consumer, sqs, err, state):
+    _fail_receive(sqs, err)
+    ctrl = consumer.PollController(0)
+    assert consumer.poll_once(consumer._new_w_stats(0), ctrl) >= 2
+    assert ctrl.state == state
+
+
+def test_poll_once_missing_queue_does_not_drain_a_job(load_consumer, sqs):
+    consumer = load_consumer(CONSUMER_MODE="job", RELIABLE_QUEUE_NAME="reliable_message_q")
+    _fail_receive(sqs, sqs.exceptions.QueueDoesNotExist(
+        {"Error": {"Code": "QueueDoesNotExist"}}, "ReceiveMessage"))
+    ctrl = consumer.PollController(0)
+    consumer.poll_once(consumer._new_w_stats(0), ctrl)
+    assert not consumer._q_drained.is_set()
+    assert ctrl.empty_polls == 0
+    # Resolved again by name on the next poll
+    assert consumer._q_url is None
+
+
+def test_poll_once_processes_a_batch(consumer, sqs, s3):
+    _send(sqs, 4)
+    ctrl = consumer.PollController(0)
+    w_stats = consumer._new_w_stats(0)
+    assert consumer.poll_once(w_stats, ctrl) == 3
+    assert ctrl.state == "draining"
+    assert w_stats["t_msgs"] == 4
+    assert sqs.depth() == 0
+    assert len(s3.objects) == 4
+
+
+@pytest.fixture
+def s3_bodies(s3):
+    """ The bodies of the S3 puts, by key """
+    bodies = {}
+    _put = s3.put_object
+
+    def _put_object(Bucket, Key, Body, **kwargs):
+        bodies[Key] = Body
+        return _put(Bucket=Bucket, Key=Key, Body=Body, **kwargs)
+
+    s3.put_object = _put_object
+    return bodies
+
+
+@pytest.mark.parametrize("limit", [{"SINK_MAX_EVNTS": 3}, {"SINK_MAX_BYTES": 40}])
+def test_sink_writes_a_full_partition_as_one_object(load_consumer, s3_bodies, limit):
+    consumer = load_consumer(S3_SINK_FORMAT="ndjson", S3_SINK_GZIP="true",
+                             SINK_MAX_AGE_SECS=60, **limit)
+    flushed = []
+    sink = consumer.S3EventSink(flushed.extend)
+    for i in range(2):
+        sink.add("sale_event", {"store_id": i}, {"Id": f"{i}"})
+    # Below the limits, nothing is written nor handed back to be deleted
+    assert (s3_bodies, flushed) == ({}, [])
+    sink.add("sale_event", {"store_id": 2}, {"Id": "2"})
+    [(key, body)] = s3_bodies.items()
+    assert key.startswith("store_events/event_type=sale_event/dt=")
+    assert key.endswith(".jsonl.gz")
+    assert [json.loads(l) for l in gzip.decompress(body).splitlines()] == [
+        {"store_id": i} for i in range(3)]
+    assert [e["Id"] for e in flushed] == ["0", "1", "2"]
+    sink.close()
+
+
+def test_sink_flushes_a_partition_once_it_is_max_age_old(load_consumer, s3_bodies):
+    consumer = load_consumer(S3_SINK_FORMAT="ndjson", SINK_MAX_AGE_SECS=0.2)
+    flushed = []
+    sink = consumer.S3EventSink(flushed.extend)
+    sink.add("sale_event", {"store_id": 1}, {"Id": "1"})
+    sink.add("inventory_event", {"store_id": 2}, {"Id": "2"})
+    time.sleep(1.5)
+    # Written by the flusher, one object per partition
+    assert sorted(k.split("/")[1] for k in s3_bodies) == [
+        "event_type=inventory_event", "event_type=sale_event"]
+    assert all(k.endswith(".jsonl") for k in s3_bodies)
+    assert sorted(e["Id"] for e in flushed) == ["1", "2"]
+    sink.close()
+
+
+def test_sink_does_not_hand_back_the_msgs_of_a_failed_write(load_consumer, s3):
+    consumer = load_consumer(S3_SINK_FORMAT="ndjson", SINK_MAX_EVNTS=2)
+
+    def _put_object(**kwargs):
+        raise ClientError({"Error": {"Code": "InternalError"}}, "PutObject")
+
+    s3.put_object = _put_object
+    flushed = []
+    sink = consumer.S3EventSink(flushed.extend)
+    for i in range(2):
+        sink.add("sale_event", {"store_id": i}, {"Id": f"{i}"})
+    sink.close()
+    # Not deleted, left to be redelivered
+    assert flushed == []
+    assert (sink.stats["flushes"], sink.stats["f_flushes"]) == (0, 1)
+
+
+def test_process_msgs_deletes_buffered_msgs_once_written(load_consumer, sqs, s3):
+    consumer = load_consumer(S3_SINK_FORMAT="ndjson", SINK_MAX_EVNTS=5, SINK_MAX_AGE_SECS=60)
+    consumer._sink = consumer.S3EventSink(consumer._del_flushed)
+    _send(sqs, 4)
+    consumer.process_msgs(sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=10))
+    assert (sqs.depth(), len(s3.objects)) == (4, 0)
+    _send(sqs, 1)
+    consumer.process_msgs(sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=10))
+    assert (sqs.depth(), len(s3.objects)) == (0, 1)
+    consumer._sink.close()
+
+
+def test_sink_writes_a_partition_as_parquet(load_consumer, s3_bodies):
+    pq = pytest.importorskip("pyarrow.parquet")
+    consumer = load_consumer(S3_SINK_FORMAT="parquet", SINK_MAX_EVNTS=2, SINK_MAX_AGE_SECS=60)
+    sink = consumer.S3EventSink(lambda m_to_del: None)
+    sink.add("sale_event", {"store_id": 1, "price": 1.5}, {"Id": "1"})
+    sink.add("sale_event", {"price": 2.5, "bad_msg": True}, {"Id": "2"})
+    [(key, body)] = s3_bodies.items()
+    assert key.endswith(".parquet")
+    table = pq.read_table(io.BytesIO(body))
+    assert str(table.schema.field("store_id").type).startswith("int")
+    assert table.column("price").to_pylist() == [1.5, 2.5]
+    # Missing fields, as the store_id of a bad msg, are nulls
+    assert table.column("store_id").to_pylist() == [1, None]
+    assert table.column("bad_msg").to_pylist() == [None, True]
+    sink.close()
+
+
+def test_run_consumers_fails_fast_on_an_unknown_sink_format(load_consumer, sqs, s3):
+    consumer = load_consumer(S3_SINK_FORMAT="ndjosn")
+    _send(sqs, 5)
+    with pytest.raises(ValueError, match="S3_SINK_FORMAT:ndjosn"):
+        consumer.run_consumers()
+    assert consumer._heartbeat is None
+    assert (sqs.visible(), len(s3.objects)) == (5, 0)
+
+
+@pytest.fixture
+def heartbeat(load_consumer, sqs):
+    """ A running heartbeat, of a consumer & queue with a 1s visibility timeout """
+    sqs.visibility_timeout = 1
+    consumer = load_consumer(VISIBILITY_TIMEOUT_SECS=1, HEARTBEAT_INTERVAL_SECS=0.1,
+                             HEARTBEAT_MAX_SECS=2)
+    consumer._heartbeat = consumer.VisibilityHeartbeat()
+    yield consumer, consumer._heartbeat
+    consumer._heartbeat.stop()
+
+
+def test_heartbeat_extends_tracked_msgs(heartbeat, sqs):
+    consumer, hb = heartbeat
+    _send(sqs, 3)
+    msgs = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=3)["Messages"]
+    hb.track(msgs[:2])
+    consumer.time.sleep(1.5)
+    # Only the untracked msg timed out & is back on the queue
+    assert sqs.visible() == 1
+    assert hb.inflight() == 2
+    assert sqs.api_calls.get("change_message_visibility_batch", 0) >= 1
+
+
+def test_heartbeat_gives_up_on_stuck_msgs(heartbeat, sqs):
+    consumer, hb = heartbeat
+    _send(sqs, 1)
+    hb.track(sqs.receive_message(QueueUrl=sqs.q_url)["Messages"])
+    consumer.time.sleep(3)
+    assert hb.inflight() == 0
+    assert sqs.visible() == 1
+
+
+def test_heartbeat_drops_msgs_with_a_stale_receipt_handle(heartbeat, sqs):
+    consumer, hb = heartbeat
+    _send(sqs, 1)
+    msgs = sqs.receive_message(QueueUrl=sqs.q_url)["Messages"]
+    hb.track(msgs)
+    # Deleted behind its back, the extension fails & it stops being tracked
+    sqs.delete_message_batch(QueueUrl=sqs.q_url, Entries=[
+        {"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]} for m in msgs])
+    consumer.time.sleep(1.2)
+    assert hb.inflight() == 0
+
+
+def test_heartbeat_release_makes_msgs_visible(heartbeat, sqs):
+    consumer, hb = heartbeat
+    _send(sqs, 4)
+    msgs = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=4)["Messages"]
+    hb.track(msgs)
+    _entries = [{"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]} for m in msgs]
+    assert hb.release(_entries[:1]) == 1
+    assert (sqs.visible(), hb.inflight()) == (1, 3)
+    # All in-flight msgs by default
+    assert hb.release() == 3
+    assert (sqs.visible(), hb.inflight()) == (4, 0)
+
+
+def test_del_msgs_untracks_the_deleted(heartbeat, sqs):
+    consumer, hb = heartbeat
+    _send(sqs, 12)
+    msgs = []
+    while len(msgs) < 12:
+        msgs += sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=10)["Messages"]
+    hb.track(msgs)
+    consumer.del_msgs(sqs.q_url, [{"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]}
+                                  for m in msgs])
+    assert (hb.inflight(), sqs.depth()) == (0, 0)
+    assert sqs.api_calls["delete_message_batch"] == 2
+
+
+@pytest.fixture
+def signals():
+    """ run_consumers installs its SIGTERM & SIGINT handlers, put back pytest's """
+    _saved = {s: signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for s, h in _saved.items():
+        signal.signal(s, h)
+
+
+def test_shutdown_begins_once(load_consumer):
+    consumer = load_consumer(SHUTDOWN_GRACE_SECS=0.5, SHUTDOWN_FLUSH_SECS=0.2)
+    shutdown = consumer.ShutdownCoordinator()
+    assert not (shutdown.is_set() or shutdown.drain_expired())
+    shutdown.begin("SIGTERM")
+    _deadline = shutdown._deadline
+    # A second signal does not push the deadline out
+    time.sleep(0.1)
+    shutdown.begin("preStop")
+    assert shutdown._deadline == _deadline
+    assert shutdown.is_set() and not shutdown.drain_expired()
+    # The workers' share ends SHUTDOWN_FLUSH_SECS before the deadline
+    time.sleep(0.25)
+    assert shutdown.drain_expired()
+
+
+def test_sigterm_begins_the_drain(load_consumer, signals):
+    consumer = load_consumer()
+    consumer._shutdown.install()
+    os.kill(os.getpid(), signal.SIGTERM)
+    assert consumer._shutdown.is_set()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("", 0))
+        return s.getsockname()[1]
+
+
+def test_drain_endpoint_begins_the_drain(load_consumer):
+    consumer = load_consumer()
+    srv = consumer.start_metrics_server(_free_port())
+    try:
+        _url = f"http://127.0.0.1:{srv.server_address[1]}"
+        assert urllib.request.urlopen(f"{_url}/drain").status == 200
+        assert consumer._shutdown.is_set()
+        # Taken out of the service endpoints while it drains
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(f"{_url}/readyz")
+        assert e.value.code == 503
+    finally:
+        srv.shutdown()
+
+
+def test_run_consumers_drains_within_the_grace_period(load_consumer, sqs, s3, signals):
+    s3._latency.latency_ms = 50
+    consumer = load_consumer(CONSUMER_WORKERS=2, TOT_MSGS_TO_PROCESS=100000,
+                             SHUTDOWN_GRACE_SECS=3, SHUTDOWN_FLUSH_SECS=1.5)
+    _send(sqs, 500)
+    _sigterm_at = []
+
+    def _sigterm():
+        _sigterm_at.append(time.monotonic())
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Timer(0.5, _sigterm).start()
+    consumer.run_consumers()
+    assert time.monotonic() - _sigterm_at[0] < 3
+    # Every msg is either written & deleted, or visible again for another replica
+    assert 0 < sqs.depth() < 500
+    assert sqs.visible() == sqs.depth()
+    assert len(s3.objects) == 500 - sqs.depth()
+
+
+def _sigterm_after(secs):
+    _at = []
+
+    def _sigterm():
+        _at.append(time.monotonic())
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Timer(secs, _sigterm).start()
+    return _at
+
+
+@pytest.mark.parametrize("sink_format", ["json", "ndjson"])
+def test_run_consumers_does_not_wait_on_slow_writes_past_the_grace_period(
+        load_consumer, sqs, s3, signals, sink_format):
+    s3._latency.latency_ms = 4000
+    consumer = load_consumer(CONSUMER_WORKERS=2, TOT_MSGS_TO_PROCESS=100000,
+                             SHUTDOWN_GRACE_SECS=3, SHUTDOWN_FLUSH_SECS=1.5,
+                             S3_SINK_FORMAT=sink_format, SINK_MAX_EVNTS=5)
+    _send(sqs, 100)
+    _sigterm_at = _sigterm_after(0.5)
+    consumer.run_consumers()
+    assert time.monotonic() - _sigterm_at[0] < 3.2
+    # Nothing was written yet, every msg received is visible again
+    assert (sqs.depth(), sqs.visible()) == (100, 100)
+
+
+def test_a_worker_left_behind_writes_nothing_more(load_consumer, sqs, s3, signals, monkeypatch):
+    consumer = load_consumer(CONSUMER_WORKERS=1, MAX_MSGS_PER_BATCH=10, TOT_MSGS_TO_PROCESS=100000,
+                             SHUTDOWN_GRACE_SECS=1, SHUTDOWN_FLUSH_SECS=0.5)
+    _decode = consumer._decode
+
+    def _slow_decode(m):
+        time.sleep(0.3)
+        return _decode(m)
+
+    monkeypatch.setattr(consumer, "_decode", _slow_decode)
+    _send(sqs, 10)
+    _sigterm_after(0.1)
+    consumer.run_consumers()
+    _puts = s3.api_calls.get("put_object", 0)
+    # The worker is still decoding, it stops at the next msg
+    time.sleep(1)
+    assert s3.api_calls.get("put_object", 0) == _puts < 10
+    assert consumer._s3_writers._shutdown
+    assert sqs.visible() == sqs.depth() == 10 - _puts
+
+
+def test_a_drain_does_not_release_msgs_being_deleted(heartbeat, sqs, monkeypatch):
+    consumer, hb = heartbeat
+    _send(sqs, 3)
+    msgs = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=3)["Messages"]
+    hb.track(msgs)
+    _deleting, _release = threading.Event(), threading.Event()
+    _delete = sqs.delete_message_batch
+
+    def _blocked_delete(**kwargs):
+        _deleting.set()
+        _release.wait(5)
+        return _delete(**kwargs)
+
+    monkeypatch.setattr(sqs, "delete_message_batch", _blocked_delete)
+    _del = threading.Thread(target=consumer.del_msgs, args=(sqs.q_url, [
+        {"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]} for m in msgs]))
+    _del.start()
+    assert _deleting.wait(5)
+    assert hb.release() == 0
+    _release.set()
+    _del.join()
+    assert (sqs.depth(), sqs.api_calls.get("change_message_visibility_batch", 0)) == (0, 0)
+
+
+def test_a_job_ends_once_the_queue_is_drained(load_consumer, sqs, s3, signals):
+    consumer = load_consumer(CONSUMER_MODE="job", CONSUMER_WORKERS=2, LONG_POLL_SECS=1,
+                             MSG_PROCESS_DELAY=0, TOT_MSGS_TO_PROCESS=100000)
+    _send(sqs, 25)
+    consumer.run_consumers()
+    assert consumer._q_drained.is_set()
+    assert (sqs.depth(), len(s3.objects)) == (0, 25)
+
+
+def test_a_job_ends_after_tot_msgs_to_process(load_consumer, sqs, s3, signals):
+    consumer = load_consumer(CONSUMER_MODE="job", CONSUMER_WORKERS=1, MAX_MSGS_PER_BATCH=5,
+                             MSG_PROCESS_DELAY=0, TOT_MSGS_TO_PROCESS=10)
+    _send(sqs, 30)
+    consumer.run_consumers()
+    assert not consumer._q_drained.is_set()
+    assert (sqs.depth(), len(s3.objects)) == (20, 10)
+
+
+@pytest.mark.parametrize("sink_format", ["json", "ndjson"])
+def test_run_consumers_can_run_again(load_consumer, sqs, s3, signals, sink_format):
+    consumer = load_consumer(CONSUMER_MODE="job", CONSUMER_WORKERS=2, MAX_MSGS_PER_BATCH=5,
+                             MSG_PROCESS_DELAY=0, TOT_MSGS_TO_PROCESS=10,
+                             S3_SINK_FORMAT=sink_format, SINK_MAX_EVNTS=5)
+    _send(sqs, 20)
+    consumer.run_consumers()
+    # The writer pool, sink & heartbeat of the first run are not reused once shut down
+    consumer.run_consumers()
+    assert sqs.depth() == 0
+    assert len(s3.objects) == (20 if sink_format == "json" else 4)
+
+
+def _msg(body, e_type="sale_event"):
+    _attrs = {"event_type": {"DataType": "String", "StringValue": e_type}} if e_type else {}
+    return {"MessageId": "m", "ReceiptHandle": "r", "Body": body, "MessageAttributes": _attrs}
+
+
+@pytest.mark.parametrize("msg,err", [
+    (_msg('{"store_id": 1}'), None),
+    (_msg('{"store_id": 1}', e_type=None), "missing_event_type"),
+    (_msg("{not json"), "bad_json"),
+    (_msg("[1, 2]"), "bad_json"),
+    (_msg('{"price": 10}'), "missing_store_id"),
+])
+def test_decode(consumer, msg, err):
+    assert consumer._decode(msg)[2] == err
+
+
+@pytest.fixture
+def failing_puts(s3):
+    """ S3 puts of the events with these store ids fail """
+    store_ids = set()
+    _put = s3.put_object
+
+    def _put_object(Bucket, Key, Body, **kwargs):
+        if json.loads(Body)["store_id"] in store_ids:
+            raise ClientError({"Error": {"Code": "InternalError"}}, "PutObject")
+        return _put(Bucket=Bucket, Key=Key, Body=Body, **kwargs)
+
+    s3.put_object = _put_object
+    return store_ids
+
+
+def test_process_msgs_deletes_only_the_persisted(heartbeat, sqs, s3, failing_puts):
+    consumer, hb = heartbeat
+    _send(sqs, 4)
+    _send(sqs, 2, body="{not json")
+    failing_puts.add(1)
+    msg_batch = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=10)
+    hb.track(msg_batch["Messages"])
+    m_stats = consumer.process_msgs(msg_batch)
+    assert m_stats == {"msg_batch": 6, "s_msgs": 3, "f_msgs": 1, "p_msgs": 2}
+    assert len(s3.objects) == 3
+    # The poison & the failed write are released, not left to time out
+    assert (sqs.depth(), sqs.visible(), hb.inflight()) == (3, 3, 0)
+
+
+def test_poison_msgs_end_up_in_the_dlq(heartbeat, sqs, s3):
+    consumer, hb = heartbeat
+    _send(sqs, 1)
+    _send(sqs, 1, body='{"price": 10}')
+    for _ in range(sqs.max_receive_count + 1):
+        msg_batch = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=10)
+        if msg_batch:
+            hb.track(msg_batch["Messages"])
+            consumer.process_msgs(msg_batch)
+    assert [json.loads(m["Body"]) for m in sqs.dlq] == [{"price": 10}]
+    assert (sqs.depth(), len(s3.objects)) == (0, 1)
+
+
+def test_del_msgs_counts_the_failed_entries(consumer, sqs):
+    _send(sqs, 3)
+    msgs = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=3)["Messages"]
+    _entries = [{"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]} for m in msgs]
+    _entries[0]["ReceiptHandle"] = "stale"
+    consumer.del_msgs(sqs.q_url, _entries)
+    assert sqs.depth() == 1
+    assert consumer.metrics._counters[("consumer_delete_failures_total", ())] == 1
+
+
+def test_sink_flush_releases_a_partition_that_fails_to_encode(heartbeat, sqs, s3, monkeypatch):
+    consumer, hb = heartbeat
+    consumer.GlobalArgs.S3_SINK_FORMAT, consumer.GlobalArgs.S3_SINK_GZIP = "ndjson", True
+    _compress = consumer.gzip.compress
+
+    def _compress_or_fail(data):
+        if b"inventory" in data:
+            raise ValueError("encode failed")
+        return _compress(data)
+
+    monkeypatch.setattr(consumer.gzip, "compress", _compress_or_fail)
+    _send(sqs, 4)
+    msgs = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=4)["Messages"]
+    hb.track(msgs)
+    flushed = []
+    sink = consumer.S3EventSink(flushed.extend)
+    for i, m in enumerate(msgs):
+        _e_type = "sale_event" if i % 2 else "inventory_event"
+        sink.add(_e_type, {"store_id": i, "kind": _e_type},
+                 {"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]})
+    sink.close()
+    # The other partition is still written, the failed one is handed back
+    assert (sink.stats["flushes"], sink.stats["f_flushes"]) == (1, 1)
+    assert (len(flushed), len(s3.objects)) == (2, 1)
+    assert sqs.visible() == 2
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def deleted_q(sqs):
+    """ Sends to the returned url fail with QueueDoesNotExist, as they do once the queue is recreated """
+    stale_url = "https://sqs.local/000000000000/deleted_q"
+    _send = sqs.send_message
+
+    def _send_message(QueueUrl, **kwargs):
+        if QueueUrl == stale_url:
+            raise sqs.exceptions.QueueDoesNotExist(
+                {"Error": {"Code": "AWS.SimpleQueueService.NonExistentQueue"}}, "SendMessage")
+        return _send(QueueUrl=QueueUrl, **kwargs)
+
+    sqs.send_message = _send_message
+    return stale_url
+
+
+def test_get_q_url_is_seeded_from_the_env(load_producer, sqs):
+    producer = load_producer()
+    assert producer.get_q_url(sqs) == sqs.q_url
+    assert "get_queue_url" not in sqs.api_calls
+
+
+def test_send_msg_resolves_a_stale_q_url_again(load_producer, sqs, deleted_q):
+    producer = load_producer(RELIABLE_QUEUE_URL=deleted_q,
+                             RELIABLE_QUEUE_NAME="reliable_message_q")
+    producer.send_msg(sqs, producer.get_q_url(sqs), '{"n":1}')
+    assert producer._q_url == sqs.q_url
+    # Cached for the msgs after it
+    producer.send_msg(sqs, producer.get_q_url(sqs), '{"n":2}')
+    assert sqs.api_calls["get_queue_url"] == 1
+    assert sqs.depth() == 2
+
+
+def _entries(n):
+    return [{"Id": f"{i}", "MessageBody": f'{{"n":{i}}}', "MessageAttributes": {}}
+            for i in range(n)]
+
+
+@pytest.fixture
+def failing_sends(sqs):
+    """ Fails the entries listed for each send_message_batch call, in call order """
+    script, calls = [], []
+    _send = sqs.send_message_batch
+
+    def _send_batch(QueueUrl, Entries):
+        _fails = script.pop(0) if script else {}
+        calls.append([e["Id"] for e in Entries])
+        _r = _send(QueueUrl=QueueUrl, Entries=[e for e in Entries if e["Id"] not in _fails])
+        _r["Failed"] = [{"Id": e["Id"], "SenderFault": _fails[e["Id"]], "Code": "x"}
+                        for e in Entries if e["Id"] in _fails]
+        return _r
+
+    sqs.send_message_batch = _send_batch
+    return script, calls
+
+
+def test_send_msg_batch_sends_all_in_one_call(load_producer, sqs):
+    producer = load_producer()
+    api_calls, failed = producer.send_msg_batch(sqs, sqs.q_url, _entries(10))
+    assert (api_calls, failed) == (1, [])
+    assert sqs.depth() == 10
+
+
+def test_send_msg_batch_retries_only_the_failed_entries(load_producer, sqs, failing_sends):
+    producer = load_producer(SEND_BATCH_RETRIES=2)
+    script, calls = failing_sends
+    script.append({"2": False, "5": False})
+    api_calls, failed = producer.send_msg_batch(sqs, sqs.q_url, _entries(6))
+    assert (api_calls, failed) == (2, [])
+    assert calls[1] == ["2", "5"]
+    assert sqs.depth() == 6
+
+
+def test_send_msg_batch_does_not_retry_sender_faults(load_producer, sqs, failing_sends):
+    producer = load_producer(SEND_BATCH_RETRIES=2)
+    script, calls = failing_sends
+    script += [{"1": True, "3": False}, {}]
+    api_calls, failed = producer.send_msg_batch(sqs, sqs.q_url, _entries(4))
+    # The throttled entry is sent again, the malformed one is given up on
+    assert calls[1] == ["3"]
+    assert api_calls == 2
+    assert [m["Id"] for m in failed] == ["1"]
+    assert sqs.depth() == 3
+
+
+def test_send_msg_batch_gives_up_after_the_retries(load_producer, sqs, failing_sends):
+    producer = load_producer(SEND_BATCH_RETRIES=1)
+    script, calls = failing_sends
+    script += [{"0": False}, {"0": False}]
+    api_calls, failed = producer.send_msg_batch(sqs, sqs.q_url, _entries(2))
+    assert api_calls == 2
+    assert [m["Id"] for m in failed] == ["0"]
+
+
+@pytest.mark.parametrize("profile,t,rate", [
+    ("constant", 123, 100),
+    ("ramp", 0, 10),
+    ("ramp", 50, 55),
+    ("ramp", 500, 100),
+    ("step", 0, 28),
+    ("step", 99, 100),
+    ("sine", 50, 100),
+    ("burst", 10, 100),
+    ("burst", 40, 10),
+    ("burst", 110, 100),
+])
+def test_profile_rate(load_producer, profile, t, rate):
+    producer = load_producer(TARGET_EVNTS_PER_SEC=100, MIN_EVNTS_PER_SEC=10,
+                             PROFILE_PERIOD_SECS=100, PROFILE_STEPS=5, BURST_SECS=30)
+    assert producer._profile_rate(profile, t) == pytest.approx(rate)
+
+
+def test_profile_rate_unknown_profile(load_producer):
+    with pytest.raises(ValueError):
+        load_producer()._profile_rate("spiky", 0)
+
+
+def test_token_bucket_accrues_the_ramp_integral(load_producer):
+    producer = load_producer(TARGET_EVNTS_PER_SEC=100, MIN_EVNTS_PER_SEC=0,
+                             PROFILE_PERIOD_SECS=10)
+    bucket = producer.TokenBucket("ramp", capacity_secs=100)
+    # One refill over the whole ramp, the midpoint rate keeps it exact
+    bucket._refill(bucket.start + 10)
+    assert bucket.tokens == pytest.approx(500)
+
+
+def test_token_bucket_caps_the_catch_up(load_producer):
+    producer = load_producer(TARGET_EVNTS_PER_SEC=100)
+    bucket = producer.TokenBucket("constant", capacity_secs=0.5)
+    # A 10s stall only banks capacity_secs worth of events
+    bucket._refill(bucket.start + 10)
+    assert bucket.tokens == pytest.approx(50)
+
+
+def test_token_bucket_paces_to_the_rate(load_producer):
+    producer = load_producer(TARGET_EVNTS_PER_SEC=400)
+    bucket = producer.TokenBucket("constant")
+    _start = producer.time.perf_counter()
+    for _ in range(200):
+        bucket.acquire()
+    assert producer.time.perf_counter() - _start == pytest.approx(0.5, abs=0.1)
+
+
+@pytest.fixture(params=["numpy", "random"])
+def gen(request, load_producer, monkeypatch):
+    """ The producer, its EventGenerator drawing with numpy or with the random module """
+    producer = load_producer()
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(producer, "_load_numpy", lambda: None)
+    return producer
+
+
+def test_event_generator_is_reproducible_with_a_seed(gen):
+    assert gen.EventGenerator(7).batch(50) == gen.EventGenerator(7).batch(50)
+    assert gen.EventGenerator(7).batch(50) != gen.EventGenerator(8).batch(50)
+
+
+def test_event_generator_draws_within_the_field_ranges(gen):
+    evnts = gen.EventGenerator(7).batch(2000)
+    for e_type, e in evnts:
+        assert e_type in ("sale_event", "inventory_event")
+        assert uuid.UUID(e["request_id"]).version == 4
+        assert 0 <= e["price"] < 100 and 0 <= e["discount"] <= 20
+        assert 100 <= e["cust_id"] < 1000 and 1 <= e["qty"] < 39
+        assert 18981 <= e["sku"] < 189282
+        assert e["category"] in gen._CATEGORIES
+        assert e["variant"] in ("black", "red")
+        # Bad msgs are the ones without a store id
+        assert e.get("bad_msg") or 1 <= e["store_id"] <= 10
+        assert not e.get("bad_msg") or "store_id" not in e
+    _bad = sum(1 for _, e in evnts if e.get("bad_msg"))
+    assert 0.06 < _bad / len(evnts) < 0.14
+
+
+class _InlinePool:
+    """ Stands in for the spawn Pool, runs the slices one after the other in this process """
+
+    def __init__(self, procs):
+        self.procs = procs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def starmap(self, fn, args):
+        return [fn(*a) for a in args]
+
+
+@pytest.fixture
+def inline_pool(monkeypatch):
+    import multiprocessing
+    monkeypatch.setattr(multiprocessing, "get_context",
+                        lambda method: SimpleNamespace(Pool=_InlinePool))
+
+
+def test_run_producers_slices_the_msgs_and_sums_the_summaries(load_producer, monkeypatch,
+                                                              inline_pool):
+    producer = load_producer(TOT_MSGS_TO_PRODUCE=10)
+    slices = []
+
+    def _produce_slice(w_id, tot_msgs, procs):
+        slices.append((w_id, tot_msgs, procs))
+        return {"status": True, "tot_msgs": tot_msgs, "tot_sales": 1.5, "api_calls": 1}
+
+    monkeypatch.setattr(producer, "_produce_slice", _produce_slice)
+    resp = producer.run_producers(procs=3)
+    assert slices == [(0, 4, 3), (1, 3, 3), (2, 3, 3)]
+    assert (resp["status"], resp["procs"], resp["tot_msgs"]) == (True, 3, 10)
+    assert (resp["tot_sales"], resp["api_calls"], resp["failed_msgs"]) == (4.5, 3, 0)
+    assert "err_msg" not in resp
+
+
+def test_run_producers_caps_the_procs_and_keeps_the_errors(load_producer, monkeypatch,
+                                                           inline_pool):
+    producer = load_producer(TOT_MSGS_TO_PRODUCE=2)
+
+    def _produce_slice(w_id, tot_msgs, procs):
+        if w_id:
+            return {"status": False, "err_msg": "boom"}
+        return {"status": True, "tot_msgs": tot_msgs}
+
+    monkeypatch.setattr(producer, "_produce_slice", _produce_slice)
+    resp = producer.run_producers(procs=8)
+    # No more procs than msgs
+    assert (resp["procs"], resp["tot_msgs"]) == (2, 1)
+    assert (resp["status"], resp["err_msg"]) == (False, ["boom"])
+
+
+def test_produce_slice_sends_its_share(load_producer, sqs, tmp_path):
+    producer = load_producer(TARGET_EVNTS_PER_SEC=90, MIN_EVNTS_PER_SEC=9, GEN_SEED=7,
+                             MSGS_PER_SEND_BATCH=10, WAIT_SECS_BETWEEN_MSGS=0,
+                             RECORD_FILE=str(tmp_path / "run.jsonl.gz"))
+    resp = producer._produce_slice(2, 5, 3)
+    assert (resp["status"], resp["tot_msgs"], sqs.depth()) == (True, 5, 5)
+    _args = producer.GlobalArgs
+    assert (_args.TARGET_EVNTS_PER_SEC, _args.MIN_EVNTS_PER_SEC) == (30, 3)
+    # Seeded workers each send their own stream
+    assert _args.GEN_SEED == 9
+    assert _args.RECORD_FILE == str(tmp_path / "run.jsonl.2.gz")
+    assert (tmp_path / "run.jsonl.2.gz").exists()
+
+
+def _write_recording(path, recs):
+    with gzip.open(path, "wt", encoding="UTF-8") as f:
+        for t, attrs, body in recs:
+            f.write(json.dumps({"t": t, "attrs": attrs, "body": body}) + "\n")
+
+
+def _attrs(e_type):
+    return {"event_type": {"DataType": "String", "StringValue": e_type},
+            "priority_shipping": {"DataType": "String", "StringValue": "False"}}
+
+
+@pytest.mark.parametrize("speed,batch,secs", [(2, 1, 0.4), (0, 10, 0)])
+def test_replay_keeps_the_attributes_and_the_pace(load_producer, sqs, tmp_path,
+                                                  speed, batch, secs):
+    _rec = str(tmp_path / "run.jsonl.gz")
+    recs = [(i * 0.4, _attrs("sale_event" if i % 2 else "inventory_event"),
+             json.dumps({"store_id": i, "price": 1.5})) for i in range(3)]
+    _write_recording(_rec, recs)
+    producer = load_producer(REPLAY_FILE=_rec, REPLAY_SPEED=speed, MSGS_PER_SEND_BATCH=batch)
+    _start = time.perf_counter()
+    resp = json.loads(producer.lambda_handler({}, {})["body"])["message"]
+    # Sent at the recorded offsets, REPLAY_SPEED times faster. 0 does not wait
+    assert time.perf_counter() - _start == pytest.approx(secs, abs=0.15)
+    assert (resp["tot_msgs"], resp["sale_evnts"], resp["inventory_evnts"]) == (3, 1, 2)
+    msgs = sqs.receive_message(QueueUrl=sqs.q_url, MaxNumberOfMessages=10)["Messages"]
+    assert [(m["MessageAttributes"], m["Body"]) for m in msgs] == [(a, b) for _, a, b in recs]
+
+
+def test_recording_leaves_out_the_failed_entries(load_producer, sqs, failing_sends, tmp_path):
+    _rec = str(tmp_path / "run.jsonl.gz")
+    producer = load_producer(RECORD_FILE=_rec, TOT_MSGS_TO_PRODUCE=5, MSGS_PER_SEND_BATCH=5,
+                             WAIT_SECS_BETWEEN_MSGS=0)
+    script, calls = failing_sends
+    script.append({"2": True})
+    resp = json.loads(producer.lambda_handler({}, {})["body"])["message"]
+    assert resp["failed_msgs"] == 1
+    sent = [m["Body"] for m in sqs.receive_message(
+        QueueUrl=sqs.q_url, MaxNumberOfMessages=10)["Messages"]]
+    assert len(sent) == 4
+    assert [b for _, _, b in producer.read_recording(_rec)] == sent
+
+
+def test_read_recording_merges_the_per_process_files(load_producer, tmp_path):
+    producer = load_producer()
+    _attr = _attrs("sale_event")
+    _write_recording(str(tmp_path / "run.jsonl.0.gz"),
+                     [(t, _attr, f"w0_{t}") for t in (0.0, 0.2, 0.4)])
+    _write_recording(str(tmp_path / "run.jsonl.1.gz"),
+                     [(t, _attr, f"w1_{t}") for t in (0.1, 0.3)])
+    _rec = str(tmp_path / "run.jsonl.gz")
+    # The recording a PRODUCER_PROCS run left, in place of run.jsonl.gz
+    assert producer.recording_paths(_rec) == [
+        str(tmp_path / "run.jsonl.0.gz"), str(tmp_path / "run.jsonl.1.gz")]
+    assert producer.recording_paths(str(tmp_path / "run.jsonl.*.gz")) == producer.recording_paths(_rec)
+    assert [b for _, _, b in producer.read_recording(_rec)] == [
+        "w0_0.0", "w1_0.1", "w0_0.2", "w1_0.3", "w0_0.4"]
+    # A single file recording is read as is
+    _write_recording(_rec, [(0.0, _attr, "single")])
+    assert producer.recording_paths(_rec) == [_rec]
+    with pytest.raises(FileNotFoundError):
+        producer.recording_paths(str(tmp_path / "missing.jsonl.gz"))